@@ -0,0 +1,66 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_, assert_raises
+
+from xbgw.command.admission import AdmissionControl
+from xbgw.settings import BadSettings, SettingsRegistry
+
+
+def make_admission(**settings):
+    registry = SettingsRegistry()
+    registry.get_by_binding("rci").update(
+        dict((key.replace('_', ' '), value)
+             for key, value in settings.iteritems()))
+    return AdmissionControl(registry)
+
+
+def test_defaults():
+    uut = AdmissionControl()
+    for _ in xrange(32):
+        eq_(uut.acquire("test"), None)
+    eq_(uut.acquire("test"), "max in flight")
+
+
+def test_total_limit():
+    uut = make_admission(max_in_flight=2)
+    eq_(uut.acquire("a", received=0), None)
+    eq_(uut.acquire("b"), None)
+    eq_(uut.acquire("c"), "max in flight")
+
+    uut.release("a", dispatched=0)
+    eq_(uut.acquire("c"), None)
+
+    stats = uut.stats()
+    eq_(stats["in_flight"], 2)
+    eq_(stats["admitted"], 3)
+    eq_(stats["rejected"], 1)
+    eq_(stats["queue_time"].count, 1)
+    eq_(stats["service_time"].count, 1)
+
+
+def test_command_limits():
+    uut = make_admission(max_in_flight=0, max_in_flight_per_command=2,
+                         command_limits={"send_serial": 1})
+    eq_(uut.acquire("send_serial"), None)
+    eq_(uut.acquire("send_serial"), "limit for send_serial")
+    eq_(uut.acquire("echo"), None)
+    eq_(uut.acquire("echo"), None)
+    eq_(uut.acquire("echo"), "limit for echo")
+
+    uut.release("send_serial")
+    eq_(uut.acquire("send_serial"), None)
+
+    stats = uut.stats()
+    eq_(stats["rejected_send_serial"], 1)
+    # Only commands with their own limit, or registered, are counted alone
+    assert "rejected_echo" not in stats
+    eq_(stats["rejected"], 2)
+
+
+def test_bad_settings():
+    with assert_raises(BadSettings):
+        make_admission(command_limits={"echo": -1})
@@ -0,0 +1,54 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from mock import Mock, patch
+from nose.tools import eq_
+
+from util import get_pubsub_listener
+from xbgw.command.cache import ResponseCache
+
+
+def test_cache_expiry():
+    uut = ResponseCache()
+    key = ("test", "<test />")
+    uut.put(key, "<responses />", 10, now=100)
+    eq_(uut.get(key, now=105), "<responses />")
+    eq_(uut.get(key, now=110), None)
+    eq_(len(uut), 0)
+    eq_((uut.hits, uut.misses), (1, 1))
+
+
+def test_cache_bounded():
+    uut = ResponseCache(max_entries=2)
+    for n in xrange(3):
+        uut.put(("test", str(n)), "response", 10)
+    eq_(len(uut), 1)
+
+
+def test_invalidate():
+    uut = ResponseCache()
+    uut.put(("a", "1"), "response", 10)
+    uut.put(("b", "1"), "response", 10)
+    generation = uut.generation("a")
+    uut.invalidate("a")
+    eq_(uut.get(("a", "1")), None)
+    eq_(uut.get(("b", "1")), "response")
+
+    # A response computed before the invalidation is not cached
+    uut.put(("a", "1"), "stale", 10, generation)
+    eq_(uut.get(("a", "1")), None)
+
+
+@patch("pubsub.pub")
+def test_watch_topic(pubmock):
+    uut = ResponseCache()
+    uut.watch("xbee.analog", "last_values")
+    uut.put(("last_values", ""), "response", 10)
+
+    listener = get_pubsub_listener(pubmock, "xbee.analog")
+    listener(topic=Mock(), ident=("node",), value=1)
+    eq_(len(uut), 0)
+    eq_(uut.invalidations, 1)
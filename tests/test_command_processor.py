@@ -5,6 +5,8 @@
 # Copyright (c) 2016 Digi International Inc. All Rights Reserved.
 
 import sys
+import threading
+import time
 from mock import Mock, patch, call
 import xml.etree.ElementTree as ET
 from hamcrest import instance_of, assert_that, equal_to
@@ -20,7 +22,11 @@ rcimock = Mock()
 sys.modules['rci_nonblocking'] = rcimock
 # pylint: disable=import-error
 from xbgw.command.rci import (RCICommandProcessor, PutOnlyQueue,
-                              ResponsePending, DeferredResponse)
+                              ResponsePending, DeferredResponse,
+                              PendingResponse, ErrorResponse)
+from xbgw.command.admission import AdmissionControl
+from xbgw.command.cache import response_cache
+from xbgw.command.registry import register_command, unregister_command
 del sys.modules['rci_nonblocking']
 
 
@@ -212,3 +218,393 @@ def test_delayed_response():
     assert_that(root.get("command"), equal_to("test"))
     assert_that(len(root), equal_to(1))  # Single response
     assert_that(root[0].tag, equal_to("response"))
+
+
+# When several commands are pending, all commands of the request are
+# published before the processor waits, so a later command may complete
+# an earlier one
+def test_pending_commands_run_concurrently():
+    pending = []
+
+    # pylint: disable=unused-argument
+    def handler(topic, element, response):
+        if topic == "command.finish":
+            for queue in pending:
+                queue.put(DeferredResponse("done"))
+            response.put("finished")
+        else:
+            pending.append(response)
+            response.put(ResponsePending)
+
+    previous = pubmock.sendMessage.side_effect
+    try:
+        pubmock.sendMessage.side_effect = handler
+        with captured_callback() as cb, \
+                patch("xbgw.command.rci.BLOCKING_LIMIT", 5):
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            start = time.time()
+            rtn = cb("<slow1/><slow2/><finish/>")
+            assert time.time() - start < 1
+    finally:
+        pubmock.sendMessage.side_effect = previous
+
+    root = ET.fromstring("<root>" + rtn + "</root>")
+    assert_that([(rsp.get("command"), rsp[0].text) for rsp in root],
+                equal_to([("slow1", "done"), ("slow2", "done"),
+                          ("finish", "finished")]))
+
+
+# A request shares one deadline between all of its commands
+def test_request_deadline_shared():
+    with captured_callback() as cb, captured_queue([ResponsePending]), \
+            patch("xbgw.command.rci.BLOCKING_LIMIT", 0.2):
+        # pylint: disable=unused-variable
+        uut = RCICommandProcessor()
+        start = time.time()
+        rtn = cb("<test1/><test2/><test3/>")
+        elapsed = time.time() - start
+
+    assert elapsed < 0.5
+    root = ET.fromstring("<root>" + rtn + "</root>")
+    assert_that(len(root), equal_to(3))
+    for rsp in root:
+        assert_command_error(rsp[0], "Timeout")
+
+
+# A deferred response may be completed from another thread
+def test_future_completed_from_thread():
+    # pylint: disable=unused-argument
+    def handler(topic, element, response):
+        pending = response.defer(timeout=5)
+        threading.Timer(0.05, pending.complete, args=("later",)).start()
+
+    previous = pubmock.sendMessage.side_effect
+    try:
+        pubmock.sendMessage.side_effect = handler
+        with captured_callback() as cb:
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            rtn = cb("<test/>")
+    finally:
+        pubmock.sendMessage.side_effect = previous
+
+    root = ET.fromstring(rtn)
+    assert_that(len(root), equal_to(1))
+    assert_that(root[0].text, equal_to("later"))
+
+
+# A deferred response which is not completed within its own timeout is
+# abandoned, without waiting for the request deadline
+def test_future_abandoned():
+    futures = []
+    abandoned = []
+
+    # pylint: disable=unused-argument
+    def handler(topic, element, response):
+        pending = response.defer(timeout=0.1)
+        pending.on_abandon(lambda: abandoned.append(element.tag))
+        futures.append(pending)
+
+    previous = pubmock.sendMessage.side_effect
+    try:
+        pubmock.sendMessage.side_effect = handler
+        with captured_callback() as cb, \
+                patch("xbgw.command.rci.BLOCKING_LIMIT", 5):
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            start = time.time()
+            rtn = cb("<test/>")
+            assert time.time() - start < 1
+    finally:
+        pubmock.sendMessage.side_effect = previous
+
+    root = ET.fromstring(rtn)
+    assert_command_error(root[0], "Timeout")
+    assert_that(abandoned, equal_to(["test"]))
+    assert futures[0].abandoned
+    assert_that(futures[0].complete("too late"), equal_to(False))
+
+
+# A deferred response may not wait past the request deadline, however long
+# its own timeout
+def test_future_capped_at_request_deadline():
+    futures = []
+
+    # pylint: disable=unused-argument
+    def handler(topic, element, response):
+        pending = response.defer(timeout=3600)
+        assert pending.remaining() < 1
+        futures.append(pending)
+
+    previous = pubmock.sendMessage.side_effect
+    try:
+        pubmock.sendMessage.side_effect = handler
+        with captured_callback() as cb, \
+                patch("xbgw.command.rci.BLOCKING_LIMIT", 0.2):
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            start = time.time()
+            rtn = cb("<test/>")
+            assert time.time() - start < 1
+    finally:
+        pubmock.sendMessage.side_effect = previous
+
+    root = ET.fromstring(rtn)
+    assert_command_error(root[0], "Timeout")
+    assert futures[0].abandoned
+
+
+def test_future_on_abandon_after_the_fact():
+    pending = PendingResponse(PutOnlyQueue(), timeout=0)
+    assert pending.abandon()
+    called = []
+    pending.on_abandon(lambda: called.append(True))
+    assert_that(called, equal_to([True]))
+
+
+# Responses arriving once the processor has finished are discarded
+def test_put_after_close():
+    queue = PutOnlyQueue()
+    queue.close()
+    queue.put(DeferredResponse("late"))
+    # pylint: disable=protected-access
+    assert queue._queue.empty()
+
+
+# Registered handlers are called directly, without publishing
+def test_registered_command():
+    def handler(element, response):
+        response.put("direct " + element.text)
+
+    register_command("direct", handler)
+    try:
+        pubmock.reset_mock()
+        with captured_callback() as cb:
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            rtn = cb("<direct>call</direct>")
+    finally:
+        unregister_command("direct", handler)
+
+    root = ET.fromstring(rtn)
+    assert_that(root[0].text, equal_to("direct call"))
+    assert not pubmock.sendMessage.called
+
+
+# Invalid command names are rejected before reaching pubsub
+def test_invalid_command_name():
+    pubmock.reset_mock()
+    with captured_callback() as cb:
+        # pylint: disable=unused-variable
+        uut = RCICommandProcessor()
+        rtn = cb("<a.b/>")
+
+    root = ET.fromstring(rtn)
+    assert_command_error(root[0], "Invalid command name", "a.b")
+    assert not pubmock.sendMessage.called
+
+
+# Commands without a handler or topic are not published, to avoid
+# creating a topic per unknown command
+def test_unknown_topic_not_published():
+    pubmock.reset_mock()
+    topic_mgr = pubmock.getDefaultTopicMgr.return_value
+    topic_mgr.getTopic.return_value = None
+    try:
+        with captured_callback() as cb:
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            rtn = cb("<nobody/>")
+    finally:
+        topic_mgr.getTopic.return_value = Mock()
+
+    root = ET.fromstring(rtn)
+    assert_command_error(root[0], "Command not handled", "nobody")
+    assert not pubmock.sendMessage.called
+    topic_mgr.getTopic.assert_called_once_with("command.nobody",
+                                               okIfNone=True)
+
+
+# A handler raising an exception is reported as an error
+def test_registered_command_fails():
+    def handler(element, response):
+        raise RuntimeError("broken")
+
+    register_command("broken", handler)
+    try:
+        with captured_callback() as cb:
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            rtn = cb("<broken/>")
+    finally:
+        unregister_command("broken", handler)
+
+    root = ET.fromstring(rtn)
+    assert_command_error(root[0], "Command handler failed", "broken")
+
+
+# Commands are published as the request is parsed, with their full
+# structure
+def test_streaming_parse():
+    seen = []
+
+    def handler(topic, element, response):
+        seen.append((topic, element.get("n"),
+                     [(child.tag, child.text) for child in element]))
+        response.put("ok")
+
+    previous = pubmock.sendMessage.side_effect
+    try:
+        pubmock.sendMessage.side_effect = handler
+        with captured_callback() as cb:
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            rtn = cb(' <a n="1"><x>1</x><y/></a>\n<b n="2">text</b> ')
+    finally:
+        pubmock.sendMessage.side_effect = previous
+
+    assert_that(seen, equal_to([("command.a", "1", [("x", "1"),
+                                                     ("y", None)]),
+                                ("command.b", "2", [])]))
+    root = ET.fromstring("<root>" + rtn + "</root>")
+    assert_that([rsp.get("command") for rsp in root], equal_to(["a", "b"]))
+
+
+# A malformed request still answers the commands before the error
+def test_malformed_request():
+    with captured_callback() as cb, captured_queue(["ok"]):
+        # pylint: disable=unused-variable
+        uut = RCICommandProcessor()
+        rtn = cb("<first/><second>")
+
+    root = ET.fromstring("<root>" + rtn + "</root>")
+    assert_that(len(root), equal_to(2))
+    assert_that(root[0].get("command"), equal_to("first"))
+    assert_that(root[0][0].text, equal_to("ok"))
+    assert_command_error(root[1][0], "Malformed request")
+
+
+# Responses to cacheable commands are reused, byte for byte, for identical
+# requests
+def test_cached_response():
+    calls = []
+
+    def handler(element, response):
+        calls.append(element.get("name"))
+        rsp = ET.Element("value", name=element.get("name"))
+        rsp.text = str(len(calls))
+        response.put(rsp)
+
+    register_command("cached", handler, cache_ttl=60)
+    try:
+        with captured_callback() as cb:
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            first = cb('<cached name="a"/>')
+            second = cb('<cached name="a"/>')
+            other = cb('<cached name="b"/>')
+            response_cache.invalidate("cached")
+            third = cb('<cached name="a"/>')
+    finally:
+        unregister_command("cached", handler)
+
+    assert_that(second, equal_to(first))
+    assert_that(calls, equal_to(["a", "b", "a"]))
+    assert_that(ET.fromstring(other)[0].text, equal_to("2"))
+    assert_that(ET.fromstring(third)[0].text, equal_to("3"))
+
+
+# Error responses are not cached
+def test_cached_command_error_not_cached():
+    calls = []
+
+    def handler(element, response):
+        calls.append(True)
+        response.put(ErrorResponse("command.unknown", {"command.unknown":
+                                                       "Failed"}))
+
+    register_command("failing", handler, cache_ttl=60)
+    try:
+        with captured_callback() as cb:
+            # pylint: disable=unused-variable
+            uut = RCICommandProcessor()
+            cb("<failing/>")
+            cb("<failing/>")
+    finally:
+        unregister_command("failing", handler)
+
+    assert_that(len(calls), equal_to(2))
+
+
+# Commands over the in-flight limit are rejected without being published
+def test_admission_limit():
+    limits = AdmissionControl()
+    limits.get_setting = {"max in flight": 2, "max in flight per command": 0,
+                          "command limits": {}}.get
+
+    with captured_callback() as cb, \
+            captured_queue(["ok", ResponsePending]), \
+            patch("xbgw.command.rci.admission", limits), \
+            patch("xbgw.command.rci.BLOCKING_LIMIT", 0.1):
+        # pylint: disable=unused-variable
+        uut = RCICommandProcessor()
+        pubmock.reset_mock()
+        rtn = cb("<test1/><test2/><test3/>")
+
+    root = ET.fromstring("<root>" + rtn + "</root>")
+    assert_that([rsp.get("command") for rsp in root],
+                equal_to(["test1", "test2", "test3"]))
+    assert_that(root[1][0].text, equal_to("ok"))
+    assert_command_error(root[1][1], "Timeout")
+    assert_command_error(root[2][0], "Too many commands", "max in flight")
+    assert_that(pubmock.sendMessage.call_count, equal_to(2))
+
+    stats = limits.stats()
+    assert_that(stats["in_flight"], equal_to(0))
+    assert_that(stats["rejected"], equal_to(1))
+
+
+# Commands answered during publication give their slot back at once, so a
+# request may have more of them than the in-flight limit
+def test_admission_released_for_immediate_responses():
+    limits = AdmissionControl()
+
+    with captured_callback() as cb, captured_queue(["pong"]), \
+            patch("xbgw.command.rci.admission", limits):
+        # pylint: disable=unused-variable
+        uut = RCICommandProcessor()
+        rtn = cb("<ping/>" * 40)
+
+    root = ET.fromstring("<root>" + rtn + "</root>")
+    assert_that([rsp[0].text for rsp in root], equal_to(["pong"] * 40))
+    stats = limits.stats()
+    assert_that(stats["admitted"], equal_to(40))
+    assert_that(stats["rejected"], equal_to(0))
+    assert_that(stats["in_flight"], equal_to(0))
+
+
+# Invalid and unknown commands are answered without taking admission slots
+def test_admission_skips_unhandled_commands():
+    limits = AdmissionControl()
+    limits.get_setting = {"max in flight": 1, "max in flight per command": 1,
+                          "command limits": {}}.get
+
+    with captured_callback() as cb, \
+            patch("xbgw.command.rci.admission", limits):
+        # pylint: disable=unused-variable
+        uut = RCICommandProcessor()
+        pubmock.getDefaultTopicMgr.return_value.getTopic.return_value = None
+        try:
+            rtn = cb('<x:a xmlns:x="u"/><x:a xmlns:x="u"/><missing/>')
+        finally:
+            pubmock.getDefaultTopicMgr.return_value.getTopic.return_value = \
+                Mock()
+
+    root = ET.fromstring("<root>" + rtn + "</root>")
+    assert_command_error(root[0][0], "Invalid command")
+    assert_command_error(root[1][0], "Invalid command")
+    assert_command_error(root[2][0], "Command not handled")
+    stats = limits.stats()
+    assert_that(stats["admitted"], equal_to(0))
+    assert_that(stats["rejected"], equal_to(0))
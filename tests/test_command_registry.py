@@ -0,0 +1,45 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_, assert_raises
+
+from xbgw.command.registry import CommandRegistry, is_valid_command
+
+
+def test_valid_command_names():
+    for tag in ("echo", "send_serial", "a1"):
+        assert is_valid_command(tag)
+    for tag in ("", "1a", "a.b", "_a", "a-b", "{urn:x}a", None):
+        assert not is_valid_command(tag), tag
+
+
+def test_register_and_unregister():
+    uut = CommandRegistry()
+
+    def first(element, response):
+        pass
+
+    def second(element, response):
+        pass
+
+    uut.register("test", first)
+    uut.register("test", second)
+    eq_(uut.handlers("test"), (first, second))
+    eq_(uut.commands(), ["test"])
+
+    uut.unregister("test", first)
+    eq_(uut.handlers("test"), (second,))
+    uut.unregister("test", second)
+    eq_(uut.handlers("test"), ())
+    eq_(uut.commands(), [])
+
+    with assert_raises(KeyError):
+        uut.unregister("test", second)
+
+
+def test_register_invalid_name():
+    with assert_raises(ValueError):
+        CommandRegistry().register("a.b", lambda element, response: None)
@@ -0,0 +1,108 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import sys
+import threading
+import time
+from mock import Mock
+from nose.tools import eq_, assert_raises
+
+from util import assert_command_error
+
+sys.modules['rci_nonblocking'] = Mock()
+from xbgw.command.rci import PutOnlyQueue, DeferredResponse
+from xbgw.command.workers import PoolSaturated, WorkerPool
+del sys.modules['rci_nonblocking']
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def deferred_result(responses):
+    # pylint: disable=protected-access
+    queue = responses._queue
+    pending = queue.get(timeout=1)
+    result = queue.get(timeout=5)
+    assert isinstance(result, DeferredResponse)
+    assert result.future is pending
+    return result.response
+
+########################################################################
+# Tests related to WorkerPool class.
+
+def test_submit_runs_work():
+    uut = WorkerPool(workers=2)
+    done = threading.Event()
+    uut.submit(done.set)
+    assert done.wait(5)
+    wait_for(lambda: uut.stats()["completed"] == 1)
+
+    stats = uut.stats()
+    eq_(stats["submitted"], 1)
+    eq_(stats["threads"], 1)
+    eq_(stats["queue_wait"].count, 1)
+
+def test_saturated_pool_rejects():
+    uut = WorkerPool(workers=1, queue_limit=1)
+    release = threading.Event()
+    uut.submit(release.wait)
+    uut.submit(release.wait)
+    with assert_raises(PoolSaturated):
+        uut.submit(release.wait)
+    eq_(uut.stats()["rejected"], 1)
+
+    release.set()
+    wait_for(lambda: uut.stats()["completed"] == 2)
+    # Capacity is available again
+    uut.submit(release.wait)
+
+def test_run_deferred():
+    uut = WorkerPool(workers=1)
+    responses = PutOnlyQueue()
+    uut.run_deferred(responses, lambda x: x * 2, 21, timeout=5)
+    eq_(deferred_result(responses), 42)
+
+def test_run_deferred_failure():
+    uut = WorkerPool(workers=1)
+    responses = PutOnlyQueue()
+
+    def broken():
+        raise ValueError("broken")
+
+    uut.run_deferred(responses, broken)
+    assert_command_error(deferred_result(responses), "Request failed",
+                         "broken")
+    wait_for(lambda: uut.stats()["failed"] == 1)
+
+def test_run_deferred_saturated():
+    uut = WorkerPool(workers=1, queue_limit=0)
+    release = threading.Event()
+    uut.submit(release.wait)
+
+    responses = PutOnlyQueue()
+    uut.run_deferred(responses, lambda: "never")
+    assert_command_error(deferred_result(responses), "Too many requests")
+    release.set()
+
+def test_abandoned_work_skipped():
+    uut = WorkerPool(workers=1)
+    release = threading.Event()
+    uut.submit(release.wait)
+
+    called = []
+    pending = uut.run_deferred(PutOnlyQueue(), called.append, True)
+    pending.abandon()
+    release.set()
+    wait_for(lambda: uut.stats()["skipped"] == 1)
+    eq_(called, [])
+    # Counted once, as skipped; the blocking work completed
+    wait_for(lambda: uut.stats()["active"] == 0)
+    stats = uut.stats()
+    eq_((stats["completed"], stats["skipped"], stats["failed"]), (1, 1, 0))
@@ -9,6 +9,10 @@ import gc
 import sys
 import threading
 import base64
+import json
+import os
+import shutil
+import tempfile
 import time
 
 from util import MatchCallable
@@ -20,11 +24,15 @@ idigimock = Mock()
 pubpatch = patch("pubsub.pub", pubmock)
 
 sys.modules['idigidata'] = idigimock
-from xbgw.reporting.device_cloud import DeviceCloudReporter
+from xbgw.reporting.device_cloud import DeviceCloudReporter, BACKOFF_TOPIC
 del sys.modules['idigidata']
 
 
 from xbgw.settings.registry import SettingsRegistry
+from xbgw.settings import BadSettings
+from xbgw.reporting.transport import MemoryTransport
+from xbgw.reporting.backoff import Backoff
+from nose.tools import assert_raises
 
 
 registry = None
@@ -42,7 +50,10 @@ def setup():
     # populate the settings registry.
     registry_values = {
         "device cloud": {
-            "encode serial": True
+            "encode serial": True,
+            # Keep tests from writing files
+            "spool file": "",
+            "sequence file": ""
         }
     }
     import json
@@ -61,6 +72,24 @@ def teardown():
     pubpatch.stop()
 
 
+class override_settings(object):
+    # Temporarily replace reporter settings in the shared registry
+    def __init__(self, values):
+        self._values = values
+        self._previous = {}
+
+    def __enter__(self):
+        settings = registry.get_by_binding("device cloud")
+        self._previous = dict(settings)
+        settings.update(self._values)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        settings = registry.get_by_binding("device cloud")
+        settings.clear()
+        settings.update(self._previous)
+
+
 def test_creation():
     reset_mocks()
 
@@ -192,7 +221,7 @@ def test_report_to_device_cloud_no_encoding_serial():
 
         yield (report_to_device_cloud, timeMock, "Hello!", "Hello!", "STRING")
 
-@patch("time.sleep")
+@patch.object(DeviceCloudReporter, "_sleep")
 @patch("time.time")
 def test_sleep_between_uploads(timeMock, sleepMock):
     reset_mocks()
@@ -205,87 +234,832 @@ def test_sleep_between_uploads(timeMock, sleepMock):
     old_se = pubmock.subscribe.side_effect
     try:
         pubmock.subscribe.side_effect = capture_listener
+        # Set specifically so we can ensure they are different
+        rate_limit = 10
+        retry_time = 5
+        with override_settings({"rate limit": rate_limit,
+                                "retry time": retry_time}):
+            uut = DeviceCloudReporter(registry)
+            # No jitter, for predictable delays
+            uut._backoff = Backoff(rand=lambda: 1.0)
+            # Previous upload at time 0
+            uut._limiter.record(0)
+
+            uut.start_reporting("example.topic")
+
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            # Less than rate limit to trigger sleep path, should cause a
+            # ~3.14 second sleep to occur
+            _time = [rate_limit - 3.14]
+
+            def my_sleep(*args):
+                _time[0] = _time[0] + args[0]
+
+            def my_time(*args):
+                return _time[0]
+
+            timeMock.side_effect = my_time
+            sleepMock.side_effect = my_sleep
+
+            bodies = []
+            def idigi_side_effect(*args):
+                bodies.append(args[0])
+                if len(bodies) == 1:
+                    return (False, 3, "Request throttled. For test")
+                else:
+                    idigi_send_event.set()
+                    return (True, 0, "Success")
+
+            idigimock.send_to_idigi.side_effect = idigi_side_effect
+
+            listener[0](topicMock, ident=("ident1",), value="hello")
+
+            idigi_send_event.wait(10)
+            idigimock.send_to_idigi.side_effect = None
+
+            assert_equal(sleepMock.call_count, 2)
+            # First call, positional argument 0, sleep based on the
+            # previous upload
+            assert abs(sleepMock.mock_calls[0][1][0] - 3.14) < 0.001
+            assert_equal(idigimock.send_to_idigi.call_count, 2)
+
+            # Second call, wait due to throttling. The rate limit has been
+            # stretched, which outlasts the retry time.
+            assert sleepMock.mock_calls[1][1][0] >= retry_time
+            assert_equal(sleepMock.mock_calls[1][1][0], rate_limit * 1.5)
+
+            # Throttled data was retained and sent again
+            assert_equal(bodies[0], bodies[1])
+
+            pubmock.sendMessage.assert_any_call(
+                BACKOFF_TOPIC, state="closed", failures=1,
+                delay=retry_time, rate_limit=rate_limit * 1.5)
+
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
+
+@patch("threading.Thread")
+def test_queue_overflow(threadMock):
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        max_queue_size = 10
+        with override_settings({"max queue size": max_queue_size}):
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+
+            for item in xrange(max_queue_size):
+                listener[0](topicMock, ident=("dummy",), value="hello")
+
+            # Verify that max queue size is reached exactly
+            assert_equal(len(uut._work), max_queue_size)
+
+            listener[0](topicMock, ident=("dummy,"), value="hello")
+            # Queue should have been purged and the single item just
+            # inserted should be the only thing present
+            assert_equal(len(uut._work), 1)
+
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
+
+
+
+def publish_and_capture_uploads(settings, count, prior_upload=None):
+    # Publish 'count' data points and return the upload bodies produced
+    # before the reporter goes idle
+    reset_mocks()
+    listener = []
+    bodies = []
+    done = threading.Event()
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    def idigi_side_effect(body, filename):
+        bodies.append(body)
+        if sum(len(b.split('\n')) - 1 for b in bodies) >= count:
+            done.set()
+        return (True, 0, "Success")
+
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings):
+            uut = DeviceCloudReporter(registry)
+            if prior_upload is not None:
+                uut._limiter.record(prior_upload)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+
+            idigimock.send_to_idigi.side_effect = idigi_side_effect
+            # Hold the queue lock so the reporter sees all points at once
+            with uut._work_lock:
+                for item in xrange(count):
+                    listener[0](topicMock, ident=("dummy",), value=item)
+
+            done.wait(2)
+            idigimock.send_to_idigi.side_effect = None
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
+    return bodies
+
+
+def test_burst_uploads_drain_backlog():
+    # A backlog of several full batches is sent back to back when the
+    # tier allows more than one upload per window
+    settings = {"rate limit": 60, "burst uploads": 3, "max per upload": 2}
+    bodies = publish_and_capture_uploads(settings, 6, prior_upload=0)
+
+    assert_equal(len(bodies), 3)
+    for body in bodies:
+        assert_equal(len(body.split('\n')), 3)
+
+
+def test_flush_count_trigger():
+    # Data is held until the configured number of points is queued
+    settings = {"rate limit": 0, "flush count": 4}
+    bodies = publish_and_capture_uploads(settings, 4)
+
+    assert_equal(len(bodies), 1)
+    assert_equal(len(bodies[0].split('\n')), 5)
+
+
+def test_concurrent_upload_workers():
+    # With several upload workers, the next body is handed off while the
+    # previous upload is still in flight
+    reset_mocks()
+    listener = []
+    in_flight = []
+    overlapped = threading.Event()
+    release = threading.Event()
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    def idigi_side_effect(body, filename):
+        in_flight.append(body)
+        if len(in_flight) == 2:
+            overlapped.set()
+        release.wait(2)
+        return (True, 0, "Success")
+
+    settings = {"rate limit": 0, "burst uploads": 2, "max per upload": 1,
+                "upload workers": 2}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings):
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+
+            idigimock.send_to_idigi.side_effect = idigi_side_effect
+            with uut._work_lock:
+                listener[0](topicMock, ident=("dummy",), value=1)
+                listener[0](topicMock, ident=("dummy",), value=2)
+
+            overlapped.wait(2)
+            release.set()
+            idigimock.send_to_idigi.side_effect = None
+
+            assert overlapped.is_set()
+            assert_equal(len(uut._upload_threads), 2)
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
 
+@patch("threading.Thread")
+def test_memory_transport_setting(threadMock):
+    reset_mocks()
+    with override_settings({"transport": "memory",
+                            "transport options": {"latency": 0}}):
         uut = DeviceCloudReporter(registry)
-        # Set specifically so we can ensure they are different
-        uut._RATE_LIMIT = 10
-        uut._RETRY_TIME = 5
 
-        uut.start_reporting("example.topic")
+        assert isinstance(uut._transport, MemoryTransport)
+        assert_equal(uut._upload("body", "DataPoint/upload.csv"), (True, ""))
+        assert_equal(list(uut._transport.uploads),
+                     [("DataPoint/upload.csv", "body")])
+        assert_equal(idigimock.send_to_idigi.call_count, 0)
 
-        topicMock = Mock()
-        topicMock.getName.return_value = "example.topic"
-        # Less than rate limit to trigger sleep path, should cause a
-        # ~3.14 second sleep to occur
-        _time = [uut._RATE_LIMIT - 3.14]
 
-        def my_sleep(*args):
-            _time[0] = _time[0] + args[0]
+@patch("threading.Thread")
+def test_bad_transport_options(threadMock):
+    reset_mocks()
+    with override_settings({"transport": "file",
+                            "transport options": {}}):
+        with assert_raises(BadSettings):
+            DeviceCloudReporter(registry)
 
-        def my_time(*args):
-            return _time[0]
 
-        timeMock.side_effect = my_time
-        sleepMock.side_effect = my_sleep
+@patch("threading.Thread")
+def test_aggregated_stream(threadMock):
+    reset_mocks()
+    listener = []
 
-        throttled = [False]
-        def idigi_side_effect(*args):
-            if throttled[0] is False:
-                throttled[0] = True
-                return (False, 3, "Request throttled. For test")
-            else:
-                idigi_send_event.set()
-                return (True, 0, "Success")
+    def capture_listener(*args):
+        listener.append(args[0])
 
-        idigimock.send_to_idigi.side_effect = idigi_side_effect
+    settings = {"aggregation": [{"streams": "example.topic/avg*",
+                                 "window": 60,
+                                 "statistics": ["mean", "count"]}]}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings), patch("time.time") as timeMock:
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+
+            timeMock.return_value = 120
+            for value in (1, 2, 3, 6):
+                listener[0](topicMock, ident=("avg",), value=value)
+            listener[0](topicMock, ident=("raw",), value=7)
+            # Only the stream not being aggregated is queued right away
+            assert_equal(len(uut._work), 1)
+
+            timeMock.return_value = 180
+            uut._close_windows()
+            assert_equal(len(uut._work), 3)
+            body = uut._build_body(uut._take_batch())
+
+        assert_equal(body.split('\n')[1:], [
+            "120000,7,INTEGER,example.topic/raw",
+            "120000,3.0,DOUBLE,example.topic/avg/mean",
+            "120000,4,INTEGER,example.topic/avg/count",
+        ])
+    finally:
+        pubmock.subscribe.side_effect = old_se
 
-        listener[0](topicMock, ident=("ident1",), value="hello")
 
-        idigi_send_event.wait(10)
-        idigimock.send_to_idigi.side_effect = None
+@patch("threading.Thread")
+def test_priority_lane_fills_batch_first(threadMock):
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    settings = {"max per upload": 2,
+                "lanes": [{"name": "alarms", "capacity": 10,
+                           "streams": "example.topic/alarm*"}]}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings), patch("time.time") as timeMock:
+            timeMock.return_value = 1
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+
+            for value in xrange(5):
+                listener[0](topicMock, ident=("analog",), value=value)
+            listener[0](topicMock, ident=("alarm",), value=1)
+
+            body = uut._build_body(uut._take_batch())
+
+        assert_equal(body.split('\n')[1:], [
+            "1000,1,INTEGER,example.topic/alarm",
+            "1000,0,INTEGER,example.topic/analog",
+        ])
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
+
+@patch("threading.Thread")
+def test_failed_upload_retains_data(threadMock):
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings({"breaker threshold": 2}), \
+                patch("time.time") as timeMock:
+            timeMock.return_value = 1
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            for value in xrange(3):
+                listener[0](topicMock, ident=("dummy",), value=value)
+
+            points = uut._take_batch()
+            listener[0](topicMock, ident=("dummy",), value=3)
+            uut._upload_done(points, False, "Connection refused")
+
+            # Failed data is back at the head of the queue
+            assert_equal([uut._work.popleft()[1] for _ in xrange(4)],
+                         [0, 1, 2, 3])
+            assert uut._next_report() > 0
+            assert_equal(uut.backoff_state()["state"], "closed")
+
+            # Consecutive failures open the breaker
+            uut._upload_done([], False, "Connection refused")
+            assert_equal(uut.backoff_state()["state"], "open")
+
+            uut._upload_done([], True, "")
+            state = uut.backoff_state()
+            assert_equal(state["state"], "closed")
+            assert_equal(state["failures"], 0)
+            assert_equal(state["delay"], 0)
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
+
+@patch.object(DeviceCloudReporter, "_DeviceCloudReporter__upload_fn")
+@patch.object(DeviceCloudReporter, "_DeviceCloudReporter__thread_fn")
+def test_failed_upload_withdraws_waiting_body(threadFnMock, uploadFnMock):
+    reset_mocks()
+    listener = []
 
-        assert_equal(sleepMock.call_count, 2)
-        # First call, positional argument 0, sleep based on initial last_upload
-        assert abs(sleepMock.mock_calls[0][1][0] - 3.14) < 0.001
-        assert_equal(idigimock.send_to_idigi.call_count, 2)
+    def capture_listener(*args):
+        listener.append(args[0])
 
-        # Second call, wait due to throttling
-        assert_equal(sleepMock.mock_calls[1][1][0], uut._RETRY_TIME)
+    def publish(*values):
+        for value in values:
+            listener[0](topicMock, ident=("dummy",), value=value)
+        uut._publish_stream()
+        return uut._ready.get_nowait()[1]
+
+    settings = {"rate limit": 0, "max per upload": 2, "retry time": 60}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings):
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+
+            first = publish(0, 1)
+            assert uut._claim_upload_slot(first)
+            # The next body is formatted while the first is in flight
+            second = publish(2, 3)
+
+            # The first upload fails. The waiting body is withdrawn rather
+            # than sent at once, and its data queued behind the failed batch
+            uut._upload_done(first, False, "Connection refused")
+            assert not uut._claim_upload_slot(second)
+            with uut._work_lock:
+                assert_equal([uut._work.popleft()[1] for _ in xrange(4)],
+                             [0, 1, 2, 3])
+
+            # The next body waits for the backoff delay, or an upload
+            # result ending it
+            third = publish(4)
+            claimed = []
+            claimer = threading.Thread(
+                target=lambda: claimed.append(uut._claim_upload_slot(third)))
+            claimer.start()
+            claimer.join(0.2)
+            assert_equal(claimed, [])
+            uut._upload_done([], True, "")
+            claimer.join(2)
+            assert_equal(claimed, [True])
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
+
+@patch.object(DeviceCloudReporter, "_DeviceCloudReporter__upload_fn")
+def test_reporting_continues_while_body_waits(uploadFnMock):
+    # The reporting thread keeps closing windows and reporting metrics
+    # while no upload worker has taken the formatted body
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
 
+    settings = {"rate limit": 0, "metrics interval": 0.05}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings):
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            listener[0](topicMock, ident=("dummy",), value=1)
+
+            # Wait for metrics queued after the body was formatted
+            deadline = time.time() + 2
+            while time.time() < deadline and not (uut._body_waiting() and
+                                                  len(uut._work)):
+                time.sleep(0.01)
+
+            assert uut._body_waiting()
+            with uut._work_lock:
+                stream = uut._work.popleft()[0]
+            assert stream.startswith("reporter.metrics/")
+            uut.shutdown(timeout=0)
     finally:
         pubmock.subscribe.side_effect = old_se
 
 
 @patch("threading.Thread")
-def test_queue_overflow(threadMock):
+def test_throttled_trial_upload(threadMock):
+    reset_mocks()
+    with override_settings({"breaker threshold": 1,
+                            "breaker cooldown": 60}), \
+            patch("time.time") as timeMock:
+        timeMock.return_value = 1
+        uut = DeviceCloudReporter(registry)
+        uut._upload_done([], False, "Connection refused")
+        assert_equal(uut.backoff_state()["state"], "open")
+
+        # Cooldown over, the trial upload is throttled
+        timeMock.return_value = 100
+        uut._next_report()
+        uut._breaker.dispatched()
+        uut._upload_done([], False, "Request throttled.")
+        assert_equal(uut.backoff_state()["state"], "half-open")
+
+        # Another upload is allowed once the backoff delay has passed
+        timeMock.return_value = 1000
+        assert_equal(uut._next_report(), 0)
+
+
+@patch("threading.Thread")
+def test_reporter_metrics(threadMock):
     reset_mocks()
     listener = []
 
     def capture_listener(*args):
         listener.append(args[0])
 
+    settings = {"lanes": [{"name": "small", "capacity": 2,
+                           "drop policy": "purge",
+                           "streams": "example.topic/small"}],
+                "metrics interval": 10}
     old_se = pubmock.subscribe.side_effect
     try:
         pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings), patch("time.time") as timeMock:
+            timeMock.return_value = 1
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            for value in xrange(3):
+                listener[0](topicMock, ident=("small",), value=value)
+
+            points = uut._take_batch()
+            uut._record_upload(len(points), 100, 0.2)
+            uut._upload_done(points, False, "Request throttled.")
+
+            timeMock.return_value = 3
+            stats = uut.stats()
+            assert_equal(stats["queue_depth"], 1)
+            assert_equal(stats["oldest_age"], 2.0)
+            assert_equal(stats["queued"], 3)
+            assert_equal(stats["dropped"], 2)
+            assert_equal(stats["purges"], 1)
+            assert_equal(stats["uploads"], 1)
+            assert_equal(stats["uploaded_bytes"], 100)
+            assert_equal(stats["throttled"], 1)
+            assert_equal(stats["failures"], 1)
+            assert_equal(stats["upload_latency"].count, 1)
+
+            # The first call schedules the report, which is due later
+            assert_equal(uut._report_metrics(), 10)
+            uut._work.clear()
+            timeMock.return_value = 13
+            assert_equal(uut._report_metrics(), 10)
+            body = uut._build_body(uut._take_batch())
+            streams = [line.split(',')[3] for line in body.split('\n')[1:]]
+            assert "reporter.metrics/queue_depth" in streams
+            assert "reporter.metrics/upload_latency/mean" in streams
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
 
+@patch("threading.Thread")
+def test_shutdown_spools_leftover_data(threadMock):
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    spool_dir = tempfile.mkdtemp()
+    spool_file = os.path.join(spool_dir, "spool.dat")
+    sequence_file = os.path.join(spool_dir, "sequence.json")
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings({"spool file": spool_file,
+                                "sequence file": sequence_file,
+                                "max per upload": 1}), \
+                patch("time.time") as timeMock:
+            timeMock.return_value = 1
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            for value in xrange(3):
+                listener[0](topicMock, ident=("dummy",), value=value)
+            # An upload is in flight, its data is spooled too
+            with uut._work_lock:
+                in_flight = uut._take_batch()
+                uut._in_flight[id(in_flight)] = in_flight
+
+            uut.shutdown(timeout=0)
+
+            assert_equal(uut._topic_registry, {})
+            assert_equal(len(uut._work), 0)
+            assert os.path.exists(spool_file)
+
+            # Spooled data is queued again on the next start, and the
+            # spool file kept until it has been uploaded
+            restarted = DeviceCloudReporter(registry)
+            assert os.path.exists(spool_file)
+            assert_equal(len(restarted._work), 3)
+            points = restarted._take_batch()
+            assert_equal(points, [("example.topic/dummy", 0, 1000, 1)])
+            restarted._upload_done(points, True, "")
+
+            # After a crash, only data not yet uploaded is replayed, and
+            # new data continues the sequence
+            crashed = DeviceCloudReporter(registry)
+            assert_equal([crashed._work.popleft() for _ in xrange(2)],
+                         [("example.topic/dummy", value, 1000, value + 1)
+                          for value in (1, 2)])
+            crashed.start_reporting("example.topic")
+            listener[-1](topicMock, ident=("dummy",), value=3)
+            assert_equal(crashed._work.popleft()[3], 4)
+
+            # Nothing left over, so the spool file is removed
+            crashed.shutdown(timeout=0)
+            assert not os.path.exists(spool_file)
+    finally:
+        pubmock.subscribe.side_effect = old_se
+        shutil.rmtree(spool_dir)
+
+
+@patch("threading.Thread")
+def test_lost_points_do_not_hold_up_sequence(threadMock):
+    reset_mocks()
+    spool_dir = tempfile.mkdtemp()
+    sequence_file = os.path.join(spool_dir, "sequence.json")
+    try:
+        # Point 1 was queued but neither uploaded nor spooled before a crash
+        with open(sequence_file, "w") as f:
+            json.dump({"high water": 0, "settled": [[2, 9]]}, f)
+
+        with override_settings({"sequence file": sequence_file}):
+            uut = DeviceCloudReporter(registry)
+            assert_equal(uut._sequence.high_water, 9)
+            assert_equal(len(uut._sequence), 0)
+
+            # Without a spool file, leftover data is lost at shutdown
+            with uut._work_lock:
+                uut._enqueue("example.topic/dummy", 1, 1000)
+            uut.shutdown(timeout=0)
+            assert_equal(uut._sequence.high_water, 10)
+            with open(sequence_file) as f:
+                assert_equal(json.load(f)["high water"], 10)
+    finally:
+        shutil.rmtree(spool_dir)
+
+
+@patch("threading.Thread")
+@patch("xbgw.reporting.device_cloud.save_state")
+def test_sequence_file_writes_limited(saveMock, threadMock):
+    reset_mocks()
+    spooled = [("example.topic/dummy", value, 1000, value + 1)
+               for value in xrange(3)]
+    with override_settings({"spool file": "spool.dat",
+                            "sequence file": "sequence.json",
+                            "max per upload": 1}), \
+            patch.object(DeviceCloudReporter, "_read_spool",
+                         return_value=spooled), \
+            patch("time.time") as timeMock:
+        timeMock.return_value = 1
         uut = DeviceCloudReporter(registry)
-        uut._MAX_QUEUE_SIZE = 10
-        uut.start_reporting("example.topic")
-        topicMock = Mock()
-        topicMock.getName.return_value = "example.topic"
 
-        for item in xrange(uut._MAX_QUEUE_SIZE):
-            listener[0](topicMock, ident=("dummy",), value="hello")
+        # Written while uploading spooled data, at most every few seconds
+        for _ in xrange(2):
+            uut._upload_done(uut._take_batch(), True, "")
+        assert_equal(saveMock.call_count, 1)
+
+        timeMock.return_value = 10
+        uut._upload_done(uut._take_batch(), True, "")
+        assert_equal(saveMock.call_count, 2)
+        assert_equal(saveMock.call_args[0][0]["high water"], 3)
+
+        # Not written for new data, once the spooled data is uploaded
+        with uut._work_lock:
+            uut._enqueue("example.topic/dummy", 3, 1000)
+        timeMock.return_value = 20
+        uut._upload_done(uut._take_batch(), True, "")
+        assert_equal(saveMock.call_count, 2)
+
+
+def test_shutdown_drains_queue():
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    spool_dir = tempfile.mkdtemp()
+    spool_file = os.path.join(spool_dir, "spool.dat")
+    settings = {"spool file": spool_file, "rate limit": 0,
+                "flush count": 1000, "transport": "memory",
+                "transport options": {"latency": 0}}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings):
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            for value in xrange(3):
+                listener[0](topicMock, ident=("dummy",), value=value)
+
+            # Flush triggers are ignored while draining
+            uut.shutdown(timeout=10)
+
+            assert_equal(len(uut._transport.uploads), 1)
+            assert not os.path.exists(spool_file)
+    finally:
+        pubmock.subscribe.side_effect = old_se
+        shutil.rmtree(spool_dir)
 
-        # Verify that max queue size is reached exactly
-        assert_equal(len(uut._work), uut._MAX_QUEUE_SIZE)
 
-        listener[0](topicMock, ident=("dummy,"), value="hello")
-        # Queue should have been purged and the single item just
-        # inserted should be the only thing present
-        assert_equal(len(uut._work), 1)
+@patch("threading.Thread")
+def test_sinks_receive_shared_lines(threadMock):
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
 
+    sinks = [{"name": "all", "transport": "memory"},
+             {"name": "digital", "transport": "memory",
+              "streams": "example.topic/digital*"}]
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings({"sinks": sinks, "encode serial": True}), \
+                patch("time.time") as timeMock:
+            timeMock.return_value = 1
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            listener[0](topicMock, ident=("analog",), value=1)
+            listener[0](topicMock, ident=("digital",), value="on")
+
+        every, digital = uut._sinks
+        assert_equal(list(every._lines), [
+            "1000,1,INTEGER,example.topic/analog",
+            "1000,b24=,STRING,example.topic/digital",
+        ])
+        # The line is encoded once and shared
+        assert digital._lines[0] is every._lines[1]
+        # Device Cloud queue is unaffected
+        assert_equal(len(uut._work), 2)
     finally:
         pubmock.subscribe.side_effect = old_se
 
 
+@patch("threading.Thread")
+def test_bad_sinks(threadMock):
+    reset_mocks()
+    with override_settings({"sinks": [{"name": "x"}]}):
+        with assert_raises(BadSettings):
+            DeviceCloudReporter(registry)
+
+
+@patch("threading.Thread")
+def test_json_encoding(threadMock):
+    reset_mocks()
+    settings = {"encode serial": False, "encoding": "json",
+                "transport": "memory", "compress": True}
+    with override_settings(settings), patch("time.time") as timeMock:
+        timeMock.return_value = 1
+        uut = DeviceCloudReporter(registry)
+        with uut._work_lock:
+            uut._report([("s", 1, 1000), ("t", "x", 1000),
+                         ("s", 2, 2000)])
+
+        points = uut._take_batch()
+        body = json.loads(uut._build_body(points))
+        # Points are grouped by stream
+        assert_equal([(point["streamId"], point["data"]) for point in body],
+                     [("s", 1), ("s", 2), ("t", "x")])
+        assert_equal(uut._encoder.filename(uut._compress),
+                     "DataPoint/upload.json.gz")
+
+
+@patch("threading.Thread")
+def test_compress_requires_transport_support(threadMock):
+    reset_mocks()
+    with override_settings({"compress": True, "transport": "idigidata"}):
+        with assert_raises(BadSettings):
+            DeviceCloudReporter(registry)
+
+
+@patch("threading.Thread")
+def test_report_by_exception(threadMock):
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    settings = {"encode serial": False,
+                "report by exception": [{"streams": "example.topic/*",
+                                         "heartbeat": 60}]}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings), patch("time.time") as timeMock:
+            timeMock.return_value = 1
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            for value in ("a", "a", "a"):
+                listener[0](topicMock, ident=("serial",), value=value)
+            assert_equal(len(uut._work), 1)
+            assert_equal(uut.stats()["suppressed"], 2)
+
+            # The unchanged value is sent again as a heartbeat
+            timeMock.return_value = 61
+            assert_equal(uut._close_windows(), 60)
+            body = uut._build_body(uut._take_batch())
+
+        assert_equal(body.split('\n')[1:], [
+            "1000,a,STRING,example.topic/serial",
+            "61000,a,STRING,example.topic/serial",
+        ])
+    finally:
+        pubmock.subscribe.side_effect = old_se
+
+
+@patch("threading.Thread")
+def test_byte_budget_batches(threadMock):
+    reset_mocks()
+    listener = []
+
+    def capture_listener(*args):
+        listener.append(args[0])
+
+    # Header (33) plus two 37 byte lines, each with a newline separator
+    settings = {"encode serial": False, "max upload bytes": 33 + 2 * 38}
+    old_se = pubmock.subscribe.side_effect
+    try:
+        pubmock.subscribe.side_effect = capture_listener
+        with override_settings(settings), patch("time.time") as timeMock:
+            timeMock.return_value = 1
+            uut = DeviceCloudReporter(registry)
+            uut.start_reporting("example.topic")
+            topicMock = Mock()
+            topicMock.getName.return_value = "example.topic"
+            for value in ("a" * 4, "b" * 4, "c" * 100, "d" * 4):
+                listener[0](topicMock, ident=("serial",), value=value)
+
+            lines = []
+            points = uut._take_batch(lines)
+            body = uut._build_body(points, lines)
+            assert_equal(len(body), settings["max upload bytes"])
+            assert_equal([point[1] for point in points], ["aaaa", "bbbb"])
+
+            # The oversized point is dropped, and settled so as not to
+            # hold up the sequence
+            assert_equal([point[1] for point in uut._take_batch()],
+                         ["dddd"])
+            assert_equal(uut.stats()["oversized"], 1)
+            uut._sequence.settle([1, 2, 4])
+            assert_equal(uut._sequence.high_water, 4)
+
+            # Nothing is sent when every point is oversized
+            listener[0](topicMock, ident=("serial",), value="e" * 100)
+            uut._ready = Mock()
+            uut._publish_stream()
+            assert_equal(uut._ready.put.call_count, 0)
+            assert_equal(len(uut._work), 0)
+    finally:
+        pubmock.subscribe.side_effect = old_se
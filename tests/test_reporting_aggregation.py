@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_, assert_raises
+from xbgw.reporting.aggregation import StreamAggregator, parse_rules
+
+
+def make_uut(**rule):
+    rule.setdefault("streams", "xbee.analog/*")
+    rule.setdefault("window", 60)
+    return StreamAggregator([rule])
+
+
+def test_parse_rules():
+    rules = parse_rules([{u"streams": [u"a/*", u"b"], u"window": 1.5}])
+    eq_(rules[0].patterns, ["a/*", "b"])
+    eq_(rules[0].window, 1500)
+    eq_(rules[0].statistics, ("min", "max", "mean", "count", "last"))
+
+
+def test_parse_rules_invalid():
+    def check(rule):
+        with assert_raises(ValueError):
+            parse_rules([rule])
+
+    yield check, {"window": 60}
+    yield check, {"streams": "a", "window": 0}
+    yield check, {"streams": "a", "window": 60, "statistics": ["median"]}
+    yield check, {"streams": "a", "window": 60, "bogus": 1}
+    yield check, "not a dict"
+
+
+def test_unmatched_streams_pass_through():
+    uut = make_uut()
+    eq_(uut.process("xbee.digitalIn/node/DIO0", 1, 0), None)
+    # Non-numeric values are never aggregated
+    eq_(uut.process("xbee.analog/node/AD0", "text", 0), None)
+    eq_(len(uut), 0)
+
+
+def test_no_rules():
+    uut = StreamAggregator([])
+    eq_(uut.process("xbee.analog/node/AD0", 1, 0), None)
+
+
+def test_window_statistics():
+    uut = make_uut()
+    for ts, value in ((60000, 5), (70000, 1), (119999, 9)):
+        eq_(uut.process("xbee.analog/n/AD0", value, ts), [])
+
+    eq_(uut.next_deadline(), 120000)
+    # First sample of the next window closes the previous one
+    points = uut.process("xbee.analog/n/AD0", 4, 120000)
+    eq_(sorted(points), sorted([
+        ("xbee.analog/n/AD0/min", 1, 60000),
+        ("xbee.analog/n/AD0/max", 9, 60000),
+        ("xbee.analog/n/AD0/mean", 5.0, 60000),
+        ("xbee.analog/n/AD0/count", 3, 60000),
+        ("xbee.analog/n/AD0/last", 9, 60000),
+    ]))
+
+
+def test_selected_statistics():
+    uut = make_uut(statistics=["max"])
+    uut.process("xbee.analog/n/AD0", 3, 0)
+    uut.process("xbee.analog/n/AD0", 7, 1)
+    eq_(uut.close_all(), [("xbee.analog/n/AD0/max", 7, 0)])
+    eq_(len(uut), 0)
+
+
+def test_close_expired():
+    uut = make_uut(statistics=["count"])
+    uut.process("xbee.analog/n/AD0", 3, 0)
+    uut.process("xbee.analog/n/AD1", 3, 60000)
+    eq_(uut.close_expired(59999), [])
+    eq_(uut.close_expired(60000), [("xbee.analog/n/AD0/count", 1, 0)])
+    eq_(len(uut), 1)
+    eq_(uut.next_deadline(), 120000)
@@ -0,0 +1,97 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_
+from xbgw.reporting.backoff import AdaptiveRate, Backoff, CircuitBreaker
+
+########################################################################
+# Tests related to Backoff class.
+
+def test_backoff_doubles():
+    uut = Backoff(rand=lambda: 1.0)
+    eq_(uut.failure(5, 300, now=0), 5)
+    eq_(uut.failure(5, 300, now=0), 10)
+    eq_(uut.failure(5, 300, now=0), 20)
+    eq_(uut.failures, 3)
+    eq_(uut.remaining(now=15), 5)
+
+def test_backoff_capped():
+    uut = Backoff(rand=lambda: 1.0)
+    for _ in xrange(20):
+        delay = uut.failure(5, 300, now=0)
+    eq_(delay, 300)
+
+def test_backoff_jitter():
+    """Jitter keeps the delay between half and all of the nominal delay."""
+    eq_(Backoff(rand=lambda: 0.0).failure(8, 300, now=0), 4)
+    eq_(Backoff(rand=lambda: 0.5).failure(8, 300, now=0), 6)
+
+def test_backoff_success_resets():
+    uut = Backoff(rand=lambda: 1.0)
+    uut.failure(5, 300, now=0)
+    uut.success()
+    eq_(uut.failures, 0)
+    eq_(uut.remaining(now=0), 0)
+    eq_(uut.failure(5, 300, now=0), 5)
+
+########################################################################
+# Tests related to CircuitBreaker class.
+
+def test_breaker_opens_at_threshold():
+    uut = CircuitBreaker()
+    eq_(uut.failure(3, 60, now=0), False)
+    eq_(uut.failure(3, 60, now=0), False)
+    eq_(uut.remaining(now=0), 0)
+    eq_(uut.failure(3, 60, now=0), True)
+    eq_(uut.state, CircuitBreaker.OPEN)
+    eq_(uut.remaining(now=10), 50)
+
+def test_breaker_half_open_trial():
+    uut = CircuitBreaker()
+    uut.failure(1, 60, now=0)
+    # Cooldown over, a single trial is allowed
+    eq_(uut.remaining(now=60), 0)
+    eq_(uut.state, CircuitBreaker.HALF_OPEN)
+    uut.dispatched()
+    eq_(uut.remaining(now=61), None)
+    # Failed trial re-opens the breaker
+    eq_(uut.failure(5, 60, now=62), True)
+    eq_(uut.remaining(now=62), 60)
+
+def test_breaker_throttled_trial():
+    uut = CircuitBreaker()
+    uut.failure(1, 60, now=0)
+    uut.remaining(now=60)
+    uut.dispatched()
+    # A throttled trial allows another trial, without re-opening
+    uut.throttled()
+    eq_(uut.state, CircuitBreaker.HALF_OPEN)
+    eq_(uut.remaining(now=61), 0)
+
+def test_breaker_success_closes():
+    uut = CircuitBreaker()
+    eq_(uut.success(), False)
+    uut.failure(1, 60, now=0)
+    uut.remaining(now=60)
+    uut.dispatched()
+    eq_(uut.success(), True)
+    eq_(uut.state, CircuitBreaker.CLOSED)
+    eq_(uut.remaining(), 0)
+
+########################################################################
+# Tests related to AdaptiveRate class.
+
+def test_adaptive_rate():
+    uut = AdaptiveRate(increase=2, decrease=0.5)
+    eq_(uut.interval(5), 5)
+    uut.throttled(maximum_factor=3)
+    eq_(uut.interval(5), 10)
+    uut.throttled(maximum_factor=3)
+    eq_(uut.interval(5), 15)
+    uut.succeeded()
+    eq_(uut.interval(5), 7.5)
+    uut.succeeded()
+    eq_(uut.interval(5), 5)
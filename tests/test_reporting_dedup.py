@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_, assert_raises
+from xbgw.reporting.dedup import (ChangeFilter, ExceptionRule,
+                                  parse_exception_rules)
+
+########################################################################
+# Tests related to rule parsing.
+
+def test_parse_rules():
+    rules = parse_exception_rules([{u"streams": u"a/*", u"deadband": 2,
+                                    u"heartbeat": 1.5}])
+    eq_(rules[0].patterns, ["a/*"])
+    eq_(rules[0].deadband, 2)
+    eq_(rules[0].heartbeat, 1500)
+
+def test_parse_invalid_rules():
+    def check(rules):
+        with assert_raises(ValueError):
+            parse_exception_rules(rules)
+
+    yield check, [{"streams": []}]
+    yield check, [{"streams": "*", "deadband": -1}]
+    yield check, [{"streams": "*", "colour": "red"}]
+    yield check, ["*"]
+
+def test_rule_changed():
+    rule = ExceptionRule("*", deadband=1)
+    assert not rule.changed(10, 11)
+    assert rule.changed(10, 11.5)
+    assert not rule.changed("abc", "abc")
+    assert rule.changed("abc", "abd")
+    assert rule.changed(1, "1")
+
+########################################################################
+# Tests related to ChangeFilter class.
+
+def test_filter_suppresses_repeats():
+    uut = ChangeFilter([{"streams": "serial/*"}])
+    eq_([uut.process("serial/a", value, 0)
+         for value in ("x", "x", "y", "y", "x")],
+        [True, False, True, False, True])
+    eq_(uut.suppressed, 2)
+    # Unmatched streams always pass
+    assert uut.process("other", 1, 0)
+    assert uut.process("other", 1, 0)
+
+def test_filter_deadband_compares_last_reported():
+    uut = ChangeFilter([{"streams": "*", "deadband": 5}])
+    eq_([uut.process("s", value, 0) for value in (0, 3, 6, 9, 12)],
+        [True, False, True, False, True])
+
+def test_filter_heartbeat():
+    uut = ChangeFilter([{"streams": "*", "heartbeat": 10}])
+    uut.process("s", 1, 0)
+    uut.process("s", 1, 2000)
+    eq_(uut.next_deadline(), 10000)
+    eq_(uut.heartbeats(9999), [])
+    eq_(uut.heartbeats(10000), [("s", 1, 10000)])
+    eq_(uut.next_deadline(), 20000)
+
+    # A reported change postpones the heartbeat
+    assert uut.process("s", 2, 15000)
+    eq_(uut.heartbeats(20000), [])
+    eq_(uut.next_deadline(), 25000)
+
+def test_filter_bounded():
+    uut = ChangeFilter([{"streams": "*"}], max_entries=2)
+    for stream in ("a", "b", "c"):
+        uut.process(stream, 1, 0)
+    eq_(len(uut), 1)
@@ -0,0 +1,81 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import gzip
+import json
+from StringIO import StringIO
+from xml.etree.ElementTree import fromstring
+from nose.tools import eq_, assert_raises
+
+from xbgw.reporting.encoders import get_encoder, group_by_stream, gzip_body
+
+POINTS = [("a", 1, 1000), ("b", 2.5, 1000), ("a", True, 2000)]
+
+
+def encode(name, points=POINTS, encode_serial=False, framed=True):
+    encoder = get_encoder(name)
+    fragments = [encoder.fragment(stream_id, value, ts, encode_serial)
+                 for stream_id, value, ts in points]
+    return encoder.join(fragments, [point[0] for point in points], framed)
+
+########################################################################
+# Tests related to encoders.
+
+def test_unknown_encoding():
+    with assert_raises(ValueError):
+        get_encoder("yaml")
+
+def test_group_by_stream():
+    eq_(group_by_stream([1, 2, 3, 4], ["a", "b", "a", "c"]), [1, 3, 2, 4])
+
+def test_csv_encoder():
+    eq_(encode("csv"), "#TIMESTAMP,DATA,DATATYPE,STREAMID\n"
+                       "1000,1,INTEGER,a\n"
+                       "1000,2.5,DOUBLE,b\n"
+                       "2000,1,INTEGER,a")
+    # Unframed bodies leave out the header
+    eq_(encode("csv", framed=False).split("\n")[0], "1000,1,INTEGER,a")
+
+def test_csv_encoder_quotes_strings():
+    eq_(encode("csv", [("s", 'x,"y"', 5)], framed=False),
+        '5,"x,""y""",STRING,s')
+    eq_(encode("csv", [("s", 'x,y', 5)], encode_serial=True, framed=False),
+        '5,eCx5,STRING,s')
+
+def test_xml_encoder():
+    root = fromstring(encode("xml", [("a", "<&>", 1000), ("b", 2, 1000),
+                                     ("a", 3, 2000)]))
+    eq_(root.tag, "list")
+    # Points are grouped by stream
+    eq_([point.findtext("streamId") for point in root], ["a", "a", "b"])
+    eq_(root[0].findtext("data"), "<&>")
+    eq_(root[0].findtext("streamType"), "STRING")
+    eq_(root[1].findtext("timestamp"), "2000")
+
+def test_json_encoder():
+    eq_(json.loads(encode("json")), [
+        {"streamId": "a", "data": 1, "streamType": "INTEGER",
+         "timestamp": 1000},
+        {"streamId": "a", "data": 1, "streamType": "INTEGER",
+         "timestamp": 2000},
+        {"streamId": "b", "data": 2.5, "streamType": "DOUBLE",
+         "timestamp": 1000},
+    ])
+
+def test_overhead_matches_empty_body():
+    for name in ("csv", "xml", "json"):
+        encoder = get_encoder(name)
+        for framed in (True, False):
+            eq_(encoder.overhead(framed), len(encoder.join([], [], framed)))
+
+def test_filename():
+    eq_(get_encoder("json").filename(), "DataPoint/upload.json")
+    eq_(get_encoder("csv").filename(True), "DataPoint/upload.csv.gz")
+
+def test_gzip_body():
+    body = encode("xml")
+    compressed = gzip_body(body)
+    eq_(gzip.GzipFile(fileobj=StringIO(compressed)).read(), body)
@@ -0,0 +1,131 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import sys
+import xml.etree.ElementTree as ET
+from mock import Mock, patch
+from nose.tools import eq_
+
+from util import assert_command_error, get_pubsub_listener
+
+pubmock = Mock()
+pubpatch = patch("pubsub.pub", pubmock)
+
+sys.modules['rci_nonblocking'] = Mock()
+from xbgw.reporting.history import (StreamHistory, StreamRing, downsample,
+                                    parse_query)
+del sys.modules['rci_nonblocking']
+
+from xbgw.command.registry import registry
+from xbgw.settings import SettingsRegistry
+
+
+def setup():
+    pubpatch.start()
+
+
+def teardown():
+    pubpatch.stop()
+
+
+def make_history(**settings):
+    registry = SettingsRegistry()
+    registry.get_by_binding("history").update(settings)
+    pubmock.reset_mock()
+    return StreamHistory(registry)
+
+
+def run_command(uut, xml):
+    listener = registry.handlers(StreamHistory.HISTORY_COMMAND)[-1]
+    response = Mock()
+    listener(ET.fromstring(xml), response)
+    return response.put.call_args[0][0]
+
+########################################################################
+# Tests related to StreamRing and downsample.
+
+def test_ring_wraps():
+    uut = StreamRing(3)
+    for t in xrange(5):
+        uut.append(t * 1000, t)
+    eq_(len(uut), 3)
+    eq_(uut.samples(), [(2000, 2), (3000, 3), (4000, 4)])
+    eq_(uut.samples(start=2500, end=3000), [(3000, 3)])
+
+def test_downsample():
+    samples = [(0, 1.0), (500, 3.0), (1000, 5.0), (2500, 7.0)]
+    eq_(downsample(samples, 1000),
+        [(0, 2.0, 2, 1.0, 3.0), (1000, 5.0, 1, 5.0, 5.0),
+         (2000, 7.0, 1, 7.0, 7.0)])
+
+def test_parse_query():
+    args = parse_query({"stream": "s", "last": "60", "interval": "10",
+                        "limit": "5"}, 100)
+    eq_(args, {"stream_id": "s", "start": 40000, "end": None,
+               "interval": 10000, "limit": 5})
+    for attrib in ({"limit": "many"}, {"start": "-1"}, {"limit": "inf"},
+                   {"interval": "nan"}):
+        try:
+            parse_query(attrib, 100)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("%r accepted" % attrib)
+
+########################################################################
+# Tests related to StreamHistory class.
+
+def test_record_and_query():
+    uut = make_history(**{"points per stream": 4})
+    for t in xrange(6):
+        uut.record("a", t, t * 1000)
+    uut.record("b", True, 0)
+    uut.record("serial", "text", 0)
+
+    eq_(uut.streams(), {"a": 4, "b": 1})
+    eq_(uut.skipped, 1)
+    eq_(uut.query("a", limit=2), [(4000, 4), (5000, 5)])
+    eq_(uut.query("a", limit=6), [(t * 1000, t) for t in xrange(2, 6)])
+    eq_(uut.query("a", limit=0), [])
+    eq_(uut.query("a", start=3000, interval=2000),
+        [(2000, 3.0, 1, 3.0, 3.0), (4000, 4.5, 2, 4.0, 5.0)])
+
+def test_max_streams():
+    uut = make_history(**{"max streams": 1})
+    uut.record("a", 1, 0)
+    uut.record("b", 1, 0)
+    eq_(uut.streams(), {"a": 1})
+    eq_(uut.skipped, 1)
+
+@patch("time.time")
+def test_recording_topics(timeMock):
+    timeMock.return_value = 1
+    uut = make_history()
+    uut.start_recording("xbee.analog")
+    listener = get_pubsub_listener(pubmock, "xbee.analog")
+    topic = Mock()
+    topic.getName.return_value = "xbee.analog"
+    listener(topic, ident=("[00:11]!", "AD1"), value=512)
+    eq_(uut.query("xbee.analog/[00:11]!/AD1"), [(1000, 512)])
+
+def test_history_command():
+    uut = make_history()
+    uut.record("a", 1, 1000)
+    uut.record("a", 2.5, 2000)
+
+    response = run_command(uut, '<stream_history stream="a" limit="1"/>')
+    eq_(response.get("stream"), "a")
+    eq_([(s.get("t"), s.text) for s in response], [("2000", "2.5")])
+
+    response = run_command(uut, '<stream_history/>')
+    eq_([(s.get("id"), s.get("samples")) for s in response], [("a", "2")])
+
+def test_history_command_errors():
+    uut = make_history()
+    response = run_command(uut, '<stream_history stream="missing"/>')
+    assert_command_error(response, "No history", "missing")
+    response = run_command(uut, '<stream_history stream="a" limit="x"/>')
+    assert_command_error(response, "Invalid", "limit")
@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import sys
+import xml.etree.ElementTree as ET
+from mock import Mock, patch
+from nose.tools import eq_
+
+from util import assert_command_error, get_pubsub_listener
+
+pubmock = Mock()
+pubpatch = patch("pubsub.pub", pubmock)
+
+sys.modules['rci_nonblocking'] = Mock()
+from xbgw.reporting.journal import ChangeJournal, parse_query
+del sys.modules['rci_nonblocking']
+
+from xbgw.command.registry import registry
+from xbgw.settings import SettingsRegistry
+
+
+def setup():
+    pubpatch.start()
+
+
+def teardown():
+    pubpatch.stop()
+
+
+def make_journal(**settings):
+    registry = SettingsRegistry()
+    registry.get_by_binding("journal").update(settings)
+    pubmock.reset_mock()
+    return ChangeJournal(registry)
+
+
+def run_command(uut, xml):
+    listener = registry.handlers(ChangeJournal.CHANGES_COMMAND)[-1]
+    response = Mock()
+    listener(ET.fromstring(xml), response)
+    return response.put.call_args[0][0]
+
+
+def sequences(result):
+    return [event[0] for event in result[3]]
+
+
+def test_parse_query():
+    eq_(parse_query({"since": "10", "limit": "5"}),
+        {"since": 10, "limit": 5})
+    eq_(parse_query({}), {"since": None, "limit": None})
+    for attrib in ({"since": "x"}, {"limit": "-1"}):
+        try:
+            parse_query(attrib)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("%r accepted" % attrib)
+
+
+def test_empty_journal():
+    uut = make_journal()
+    eq_(uut.changes(), (False, 1, 0, []))
+    eq_(uut.changes(since=0), (False, 1, 0, []))
+    eq_(uut.changes(since=5), (True, 1, 0, []))
+
+
+def test_changes_since():
+    uut = make_journal()
+    for value in xrange(5):
+        eq_(uut.record("s", value, 1000), value + 1)
+
+    eq_(sequences(uut.changes()), [1, 2, 3, 4, 5])
+    result = uut.changes(since=3)
+    eq_(result[:3], (False, 1, 5))
+    eq_(result[3], [(4, "s", 3, 1000), (5, "s", 4, 1000)])
+    eq_(sequences(uut.changes(since=5)), [])
+    eq_(sequences(uut.changes(since=1, limit=2)), [2, 3])
+
+
+def test_wrapped_journal_gap():
+    uut = make_journal(**{"max events": 3})
+    for value in xrange(7):
+        uut.record("s", value, 1000)
+
+    eq_(sequences(uut.changes()), [5, 6, 7])
+    eq_(sequences(uut.changes(since=5)), [6, 7])
+    result = uut.changes(since=4)
+    eq_(result[0], False)
+    eq_(sequences(result), [5, 6, 7])
+
+    # Events 3 and 4 were dropped
+    result = uut.changes(since=2)
+    eq_(result[:3], (True, 5, 7))
+    eq_(sequences(result), [5, 6, 7])
+
+    # Journal restarted since the client last polled
+    eq_(uut.changes(since=100)[0], True)
+
+
+def test_max_events_grows():
+    registry = SettingsRegistry()
+    settings = registry.get_by_binding("journal")
+    settings["max events"] = 3
+    pubmock.reset_mock()
+    uut = ChangeJournal(registry)
+    for value in xrange(5):
+        uut.record("s", value, 1000)
+
+    settings["max events"] = 6
+    uut.record("s", 5, 1000)
+    eq_(sequences(uut.changes(since=3)), [4, 5, 6])
+    eq_(sequences(uut.changes()), [3, 4, 5, 6])
+
+
+def test_max_results():
+    uut = make_journal(**{"max results": 2})
+    for value in xrange(5):
+        uut.record("s", value, 1000)
+    eq_(sequences(uut.changes()), [1, 2])
+    eq_(sequences(uut.changes(limit=10)), [1, 2])
+
+
+@patch("time.time")
+def test_recording_topics(timeMock):
+    timeMock.return_value = 1
+    uut = make_journal()
+    uut.start_recording("xbee.analog")
+    listener = get_pubsub_listener(pubmock, "xbee.analog")
+    topic = Mock()
+    topic.getName.return_value = "xbee.analog"
+    listener(topic, ident=("[00:11]!", "AD1"), value=512)
+    eq_(uut.changes()[3], [(1, "xbee.analog/[00:11]!/AD1", 512, 1000)])
+
+
+def test_changes_command():
+    uut = make_journal(**{"max events": 2})
+    uut.record("a", 1, 1000)
+    uut.record("b", "hi", 2000)
+
+    response = run_command(uut, '<changes since="1"/>')
+    eq_((response.get("first"), response.get("last"), response.get("next")),
+        ("1", "2", "2"))
+    eq_(response.get("gap"), None)
+    eq_([(e.get("s"), e.get("id"), e.get("t"), e.get("enc"), e.text)
+         for e in response],
+        [("2", "b", "2000", "base64", "aGk=")])
+
+    response = run_command(uut, '<changes since="2"/>')
+    eq_((len(response), response.get("next")), (0, "2"))
+
+    uut.record("c", 3, 3000)
+    uut.record("d", 4, 4000)
+    response = run_command(uut, '<changes since="1" limit="1"/>')
+    eq_(response.get("gap"), "true")
+    eq_([e.get("s") for e in response], ["3"])
+    eq_(response.get("next"), "3")
+
+
+def test_changes_command_errors():
+    uut = make_journal()
+    response = run_command(uut, '<changes since="soon"/>')
+    assert_command_error(response, "Invalid", "since")
@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_, assert_raises
+from xbgw.reporting.lanes import Lane, LaneQueue, parse_lanes
+
+
+def make_uut(default_capacity=100, **lane):
+    lane.setdefault("name", "alarms")
+    lane.setdefault("streams", "alarm/*")
+    lane.setdefault("capacity", 3)
+    return LaneQueue([lane], lambda: default_capacity)
+
+
+def test_parse_lanes():
+    lanes = parse_lanes([{u"name": u"a", u"streams": u"x/*",
+                          u"capacity": 5, u"drop policy": u"newest"}])
+    eq_(lanes[0].name, "a")
+    eq_(lanes[0].patterns, ["x/*"])
+    eq_(lanes[0].drop_policy, "newest")
+    eq_(lanes[0].urgent, False)
+
+
+def test_parse_lanes_invalid():
+    def check(lane):
+        with assert_raises(ValueError):
+            parse_lanes([lane])
+
+    yield check, {"name": "a", "streams": "x", "capacity": 0}
+    yield check, {"name": "a", "streams": "x", "capacity": 1,
+                  "drop policy": "random"}
+    yield check, {"name": "a", "capacity": 1}
+    yield check, ["not", "a", "dict"]
+
+
+def test_priority_order():
+    uut = make_uut()
+    uut.append("analog/1", 1, 100)
+    uut.append("analog/2", 2, 200)
+    uut.append("alarm/1", 3, 300)
+    eq_(len(uut), 3)
+    eq_(uut.oldest_timestamp(), 100)
+    eq_(uut.popleft(), ("alarm/1", 3, 300, 0))
+    eq_(uut.popleft(), ("analog/1", 1, 100, 0))
+    eq_(uut.popleft(), ("analog/2", 2, 200, 0))
+    with assert_raises(IndexError):
+        uut.popleft()
+
+
+def test_drop_policies():
+    def check(policy, expected, dropped, dropped_seqs):
+        lane = Lane("lane", "*", 2, policy)
+        eq_(lane.append("s", 0, 0, 1), None)
+        eq_(lane.append("s", 1, 1, 2), None)
+        # Sequence numbers of dropped points are returned
+        eq_(lane.append("s", 2, 2, 3), dropped_seqs)
+        eq_([lane.points.popleft()[1] for _ in xrange(len(lane.points))],
+            expected)
+        eq_(lane.dropped, dropped)
+
+    yield check, "oldest", [1, 2], 1, [1]
+    yield check, "newest", [0, 1], 1, [3]
+    yield check, "purge", [2], 2, [1, 2]
+
+
+def test_default_lane_capacity_follows_setting():
+    capacity = [2]
+    uut = LaneQueue([], lambda: capacity[0])
+    for i in xrange(2):
+        uut.append("s", i, i)
+    capacity[0] = 3
+    uut.append("s", 2, 2)
+    eq_(len(uut), 3)
+    # Default lane purges itself when full
+    uut.append("s", 3, 3)
+    eq_(len(uut), 1)
+
+
+def test_urgent_lane():
+    uut = make_uut(urgent=True)
+    uut.append("analog/1", 1, 100)
+    eq_(uut.urgent(), False)
+    uut.append("alarm/1", 1, 100)
+    eq_(uut.urgent(), True)
+    uut.clear()
+    eq_(uut.urgent(), False)
+    eq_(len(uut), 0)
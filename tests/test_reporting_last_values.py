@@ -0,0 +1,150 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import sys
+import xml.etree.ElementTree as ET
+from mock import Mock, patch
+from nose.tools import eq_
+
+from util import assert_command_error, get_pubsub_listener
+
+pubmock = Mock()
+pubpatch = patch("pubsub.pub", pubmock)
+
+sys.modules['rci_nonblocking'] = Mock()
+from xbgw.reporting.last_values import LastValueTable, parse_query
+del sys.modules['rci_nonblocking']
+
+from xbgw.command.registry import registry
+from xbgw.settings import SettingsRegistry
+
+NODE1 = "[00:13:a2:00:00:00:00:01]!"
+NODE2 = "[00:13:a2:00:00:00:00:02]!"
+
+
+def setup():
+    pubpatch.start()
+
+
+def teardown():
+    pubpatch.stop()
+
+
+def make_table(**settings):
+    registry = SettingsRegistry()
+    registry.get_by_binding("last_values").update(settings)
+    pubmock.reset_mock()
+    return LastValueTable(registry)
+
+
+def make_populated_table(**settings):
+    uut = make_table(**settings)
+    uut.record("xbee.analog", (NODE1, "AD1"), 512, 1000)
+    uut.record("xbee.analog", (NODE1, "AD2"), 0, 1000)
+    uut.record("xbee.digitalIn", (NODE1, "DIO1"), 1, 1000)
+    uut.record("xbee.analog", (NODE2, "AD1"), 100, 1000)
+    uut.record("xbee.serialIn", (NODE2,), "hi", 2000)
+    return uut
+
+
+def run_command(uut, xml):
+    listener = registry.handlers(LastValueTable.LAST_VALUES_COMMAND)[-1]
+    response = Mock()
+    listener(ET.fromstring(xml), response)
+    return response.put.call_args[0][0]
+
+
+def test_parse_query():
+    eq_(parse_query({"node": "n", "pin": "AD", "limit": "5"}),
+        {"node": "n", "pin": "AD", "topic": None, "limit": 5})
+    for attrib in ({"limit": "many"}, {"limit": "-1"}):
+        try:
+            parse_query(attrib)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("%r accepted" % attrib)
+
+
+def test_record_replaces_value():
+    uut = make_table()
+    uut.record("xbee.analog", (NODE1, "AD1"), 1, 1000)
+    uut.record("xbee.analog", (NODE1, "AD1"), 2, 2000)
+    eq_(len(uut), 1)
+    eq_(uut.query(), (1, [(NODE1, "AD1", "xbee.analog", 2, 2000)]))
+
+
+def test_query_filters():
+    uut = make_populated_table()
+
+    eq_([v[1] for v in uut.query(node=NODE1)[1]], ["AD1", "AD2", "DIO1"])
+    eq_([(v[0], v[1]) for v in uut.query(pin="AD1")[1]],
+        [(NODE1, "AD1"), (NODE2, "AD1")])
+    eq_([v[1] for v in uut.query(pin="D")[1]], ["DIO1"])
+    eq_([v[1] for v in uut.query(node=NODE1, pin="AD")[1]], ["AD1", "AD2"])
+    eq_([v[1] for v in uut.query(topic="xbee.serialIn")[1]], ["serialIn"])
+    eq_(uut.query(node=NODE2, topic="xbee.digitalIn"), (0, []))
+    eq_(uut.query(node="unknown"), (0, []))
+
+
+def test_query_bounds():
+    uut = make_populated_table(**{"max results": 2})
+    count, values = uut.query()
+    eq_(count, 5)
+    eq_(len(values), 2)
+    eq_(len(uut.query(limit=1)[1]), 1)
+    eq_(len(uut.query(limit=10)[1]), 2)
+
+
+def test_record_non_tuple_ident():
+    uut = make_table()
+    uut.record("xbee.serialIn", NODE1, "a", 1000)
+    uut.record("xbee.serialIn", None, "b", 1000)
+    eq_([(v[0], v[1]) for v in uut.query()[1]],
+        [("None", "serialIn"), (NODE1, "serialIn")])
+
+
+def test_max_entries():
+    uut = make_table(**{"max entries": 1})
+    uut.record("xbee.analog", (NODE1, "AD1"), 1, 1000)
+    uut.record("xbee.analog", (NODE1, "AD2"), 1, 1000)
+    uut.record("xbee.analog", (NODE1, "AD1"), 2, 2000)
+    eq_(len(uut), 1)
+    eq_(uut.skipped, 1)
+
+
+@patch("time.time")
+def test_recording_topics(timeMock):
+    timeMock.return_value = 1
+    uut = make_table()
+    uut.start_recording("xbee.analog")
+    listener = get_pubsub_listener(pubmock, "xbee.analog")
+    topic = Mock()
+    topic.getName.return_value = "xbee.analog"
+    listener(topic, ident=(NODE1, "AD1"), value=512)
+    eq_(uut.query(), (1, [(NODE1, "AD1", "xbee.analog", 512, 1000)]))
+
+
+def test_last_values_command():
+    uut = make_populated_table()
+
+    response = run_command(uut, '<last_values pin="AD1" limit="1"/>')
+    eq_(response.get("matches"), "2")
+    eq_([node.get("id") for node in response], [NODE1])
+    eq_([(v.get("p"), v.get("t"), v.text) for v in response[0]],
+        [("AD1", "1000", "512")])
+
+    response = run_command(uut, '<last_values node="%s"/>' % NODE2)
+    values = response[0]
+    eq_(values[1].get("p"), "serialIn")
+    eq_(values[1].get("enc"), "base64")
+    eq_(values[1].text, "aGk=")
+
+
+def test_last_values_command_errors():
+    uut = make_table()
+    response = run_command(uut, '<last_values limit="x"/>')
+    assert_command_error(response, "Invalid", "limit")
@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from mock import Mock
+from nose.tools import eq_
+
+from xbgw.command.registry import registry
+from xbgw.reporting.metrics import (Histogram, ReporterStatsCommand,
+                                    metrics_element)
+
+########################################################################
+# Tests related to Histogram class.
+
+def test_histogram_buckets():
+    uut = Histogram((1, 10))
+    for value in (0.5, 1, 5, 10, 11, 100):
+        uut.observe(value)
+    # Bounds are inclusive, larger values go to the overflow bucket
+    eq_(uut.counts, [2, 2, 2])
+    eq_(uut.count, 6)
+    eq_(uut.total, 127.5)
+    eq_(uut.mean(), 127.5 / 6)
+
+def test_histogram_empty_mean():
+    eq_(Histogram((1,)).mean(), 0.0)
+
+def test_histogram_snapshot():
+    uut = Histogram((1,))
+    uut.observe(1)
+    snapshot = uut.snapshot()
+    uut.observe(2)
+    eq_(snapshot.counts, [1, 0])
+    eq_(snapshot.count, 1)
+
+########################################################################
+# Tests related to metrics_element and ReporterStatsCommand.
+
+def test_metrics_element():
+    histogram = Histogram((1,))
+    histogram.observe(0.5)
+    element = metrics_element({"uploads": 3, "upload_latency": histogram})
+
+    eq_(element.tag, "response")
+    eq_(element.find("uploads").text, "3")
+    latency = element.find("upload_latency")
+    eq_(latency.get("count"), "1")
+    eq_([(b.get("le"), b.text) for b in latency.findall("bucket")],
+        [("1", "1"), ("inf", "0")])
+
+def test_stats_command():
+    reporter = Mock()
+    reporter.stats.return_value = {"queue_depth": 7}
+    uut = ReporterStatsCommand(reporter)
+
+    listener = registry.handlers("reporter_stats")[-1]
+    registry.unregister("reporter_stats", uut.stats_listener)
+    response = Mock()
+    listener(Mock(), response)
+
+    element = response.put.call_args[0][0]
+    eq_(element.find("queue_depth").text, "7")
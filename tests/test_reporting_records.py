@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_, assert_raises
+from xbgw.reporting.records import PointQueue, StreamIdCache
+
+########################################################################
+# Tests related to PointQueue class.
+
+def test_point_queue_fifo():
+    uut = PointQueue()
+    uut.append("a", 1, 1000, 7)
+    uut.append("b", "two", 2000, 8)
+    eq_(len(uut), 2)
+    eq_(uut.oldest_timestamp(), 1000)
+    eq_(uut.popleft(), ("a", 1, 1000, 7))
+    eq_(uut.popleft(), ("b", "two", 2000, 8))
+    eq_(len(uut), 0)
+    eq_(uut.oldest_timestamp(), None)
+
+def test_point_queue_empty_pop():
+    uut = PointQueue()
+    with assert_raises(IndexError):
+        uut.popleft()
+
+def test_point_queue_grows_across_wrap():
+    """Order is kept when the ring grows after wrapping around."""
+    uut = PointQueue(capacity=4)
+    for i in xrange(3):
+        uut.append("s", i, i)
+    uut.popleft()
+    uut.popleft()
+    for i in xrange(3, 10):
+        uut.append("s", i, i)
+    eq_([uut.popleft()[1] for _ in xrange(len(uut))], range(2, 10))
+
+def test_point_queue_timestamps_are_ints():
+    uut = PointQueue()
+    uut.append("s", 0, 1400000000123)
+    timestamp = uut.popleft()[2]
+    eq_(timestamp, 1400000000123)
+    assert isinstance(timestamp, (int, long))
+
+def test_point_queue_clear():
+    uut = PointQueue(capacity=2)
+    for i in xrange(10):
+        uut.append("s", i, i)
+    uut.clear()
+    eq_(len(uut), 0)
+    uut.append("s", 1, 1)
+    eq_(uut.popleft(), ("s", 1, 1, 0))
+
+def test_point_queue_sequences():
+    uut = PointQueue(capacity=2)
+    for i in xrange(3):
+        uut.append("s", i, i, i + 10)
+    uut.popleft()
+    uut.appendleft("s", 0, 0, 5)
+    eq_(uut.sequences(), [5, 11, 12])
+
+########################################################################
+# Tests related to StreamIdCache class.
+
+def test_stream_id_cache_shares_strings():
+    calls = []
+
+    def convert(topic, ident):
+        calls.append((topic, ident))
+        return "%s/%s" % (topic, '/'.join(ident))
+
+    uut = StreamIdCache(convert)
+    first = uut.get("topic", ("a", "b"))
+    second = uut.get("topic", ["a", "b"])
+    eq_(first, "topic/a/b")
+    assert first is second
+    eq_(len(calls), 1)
+
+def test_stream_id_cache_unhashable():
+    uut = StreamIdCache(lambda topic, ident: "x")
+    eq_(uut.get("topic", ({},)), "x")
+    eq_(len(uut), 0)
+
+def test_stream_id_cache_bounded():
+    uut = StreamIdCache(lambda topic, ident: str(ident), max_entries=3)
+    for i in xrange(10):
+        uut.get("topic", (i,))
+    assert len(uut) <= 3
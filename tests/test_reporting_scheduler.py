@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+from nose.tools import eq_
+from xbgw.reporting.scheduler import RateLimiter, flush_delay
+
+########################################################################
+# Tests related to RateLimiter class.
+
+def test_rate_limiter_initially_open():
+    """An upload is allowed right away when none has happened yet."""
+    uut = RateLimiter()
+    eq_(uut.delay(5, now=100), 0)
+    eq_(uut.last(), None)
+
+def test_rate_limiter_delay():
+    """After an upload, the next one must wait for the window to pass."""
+    uut = RateLimiter()
+    uut.record(100)
+    eq_(uut.delay(5, now=102), 3)
+    eq_(uut.delay(5, now=105), 0)
+    eq_(uut.last(), 100)
+
+def test_rate_limiter_burst():
+    """With a burst allowance, several uploads may share one window."""
+    uut = RateLimiter()
+    uut.record(100)
+    uut.record(101)
+    eq_(uut.delay(5, burst=3, now=101), 0)
+    uut.record(101)
+    eq_(uut.delay(5, burst=3, now=101), 4)
+    # Only the most recent upload matters without a burst allowance
+    eq_(uut.delay(5, burst=1, now=101), 5)
+
+def test_rate_limiter_history_limit():
+    """The limiter only remembers as many uploads as it is told to."""
+    uut = RateLimiter()
+    for when in xrange(10):
+        uut.record(when, limit=2)
+    eq_(uut.delay(5, burst=2, now=10), 3)
+
+########################################################################
+# Tests related to flush_delay function.
+
+def test_flush_delay_empty():
+    eq_(flush_delay(0, 0, 249), None)
+
+def test_flush_delay_no_triggers():
+    """Without triggers, any queued data is ready."""
+    eq_(flush_delay(1, 0, 249), 0)
+
+def test_flush_delay_full_batch():
+    """A full batch is always ready, regardless of triggers."""
+    eq_(flush_delay(249, 0, 249, flush_count=1000, flush_age=60), 0)
+
+def test_flush_delay_count():
+    eq_(flush_delay(9, 0, 249, flush_count=10), None)
+    eq_(flush_delay(10, 0, 249, flush_count=10), 0)
+
+def test_flush_delay_age():
+    eq_(flush_delay(1, 2.5, 249, flush_age=10), 7.5)
+    eq_(flush_delay(1, 12, 249, flush_age=10), 0)
+
+def test_rate_limiter_reserve():
+    """Reserving a slot records it, and later reservations must wait."""
+    uut = RateLimiter()
+    eq_(uut.reserve(5, now=100), 0)
+    eq_(uut.last(), 100)
+    eq_(uut.reserve(5, now=101), 4)
+    # A refused reservation is not recorded
+    eq_(uut.last(), 100)
+    eq_(uut.reserve(5, now=105), 0)
+    eq_(uut.last(), 105)
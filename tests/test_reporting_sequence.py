@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import os
+import shutil
+import tempfile
+from nose.tools import eq_
+
+from xbgw.reporting.sequence import SequenceTracker, format_ranges, ranges
+
+########################################################################
+# Tests related to range helpers.
+
+def test_ranges():
+    eq_(ranges([5, 1, 2, 3, 7, 8]), [[1, 3], [5, 5], [7, 8]])
+    eq_(ranges([]), [])
+
+def test_format_ranges():
+    eq_(format_ranges(iter([1, 2, 3, 5])), "1-3,5")
+
+########################################################################
+# Tests related to SequenceTracker class.
+
+def test_tracker_settles_out_of_order():
+    uut = SequenceTracker()
+    seqs = [uut.next() for _ in xrange(5)]
+    eq_(seqs, [1, 2, 3, 4, 5])
+
+    uut.settle([2, 4])
+    eq_(uut.high_water, 0)
+    assert uut.is_settled(4)
+    assert not uut.is_settled(3)
+
+    uut.settle([1, 3])
+    eq_(uut.high_water, 4)
+    eq_(len(uut), 0)
+
+def test_tracker_settle_except():
+    uut = SequenceTracker(high_water=0, settled=[2, 5])
+    uut.reserve(7)
+    # 1, 3, 4 and 6 were lost, except 4 which is still pending
+    uut.settle_except([4])
+    eq_(uut.high_water, 3)
+    eq_(uut.state(), {"high water": 3, "settled": [[5, 7]]})
+    eq_(uut.next(), 8)
+
+def test_tracker_state_round_trip():
+    uut = SequenceTracker(high_water=10, settled=[12, 13, 15])
+    eq_(uut.state(), {"high water": 10, "settled": [[12, 13], [15, 15]]})
+
+    copy = SequenceTracker.from_state(uut.state())
+    assert copy.is_settled(13)
+    assert not copy.is_settled(14)
+    # Numbers handed out continue past everything seen
+    eq_(copy.next(), 16)
+
+def test_tracker_save_load():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "sequence.json")
+        eq_(SequenceTracker.load(path).high_water, 0)
+
+        uut = SequenceTracker()
+        uut.settle([1, 2, 3])
+        uut.save(path)
+        eq_(SequenceTracker.load(path).high_water, 3)
+
+        with open(path, "w") as f:
+            f.write("not json")
+        eq_(SequenceTracker.load(path).high_water, 0)
+    finally:
+        shutil.rmtree(directory)
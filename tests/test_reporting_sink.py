@@ -0,0 +1,130 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import gzip
+import json
+import time
+from StringIO import StringIO
+from mock import Mock, patch
+from nose.tools import eq_, assert_raises
+
+from xbgw.reporting.sink import Sink, parse_sinks, verify_sinks
+from xbgw.reporting.transport import MemoryTransport
+
+########################################################################
+# Tests related to Sink class.
+
+def test_sink_matches():
+    uut = Sink("test", Mock(), streams=["xbee.analog/*", "other"])
+    assert uut.matches("xbee.analog/[00:11]!/AD0")
+    assert uut.matches("other")
+    assert not uut.matches("xbee.digitalIn/[00:11]!/DIO0")
+
+def test_sink_drops_oldest():
+    uut = Sink("test", Mock(), capacity=2)
+    for line in ("a", "b", "c"):
+        uut.append(line)
+    eq_(list(uut._lines), ["b", "c"])
+    eq_(uut.dropped, 1)
+
+def test_sink_send_batch():
+    transport = MemoryTransport()
+    uut = Sink("test", transport, max_per_upload=2)
+    for line in ("a", "b", "c"):
+        uut.append(line)
+    uut._send_batch()
+    eq_(list(transport.uploads), [("DataPoint/upload.csv", "a\nb")])
+    eq_(len(uut), 1)
+
+def test_sink_byte_budget():
+    transport = MemoryTransport()
+    uut = Sink("test", transport, max_upload_bytes=7)
+    for line in ("aaa", "bbb", "c", "dddddddd", "e"):
+        uut.append(line)
+    uut._send_batch()
+    uut._send_batch()
+    # The oversized line is dropped rather than sent
+    uut._send_batch()
+    eq_([body for _, body in transport.uploads], ["aaa\nbbb", "c", "e"])
+    eq_(uut.oversized, 1)
+
+def test_sink_json_compressed():
+    transport = MemoryTransport()
+    uut = Sink("test", transport, encoding="json", compress=True)
+    for value in (1, 2):
+        uut.append(uut.encoder.fragment("s", value, 1000))
+    uut._send_batch()
+
+    filename, body = transport.uploads[0]
+    eq_(filename, "DataPoint/upload.json.gz")
+    body = gzip.GzipFile(fileobj=StringIO(body)).read()
+    eq_([point["data"] for point in json.loads(body)], [1, 2])
+
+def test_sink_failure_retains_data():
+    transport = Mock()
+    transport.send.return_value = (False, "Connection refused")
+    uut = Sink("test", transport, retry_time=5)
+    uut.append("a")
+    uut.append("b")
+    uut._send_batch()
+
+    eq_(list(uut._lines), ["a", "b"])
+    eq_(uut.failures, 1)
+    assert uut._backoff.remaining() > 0
+
+    transport.send.side_effect = IOError("Broken")
+    uut._send_batch()
+    eq_(uut.failures, 2)
+    eq_(len(uut), 2)
+
+def test_sink_drain():
+    transport = MemoryTransport()
+    uut = Sink("test", transport)
+    uut.start()
+    uut.append("a")
+    eq_(uut.drain(time.time() + 5), 0)
+    eq_(list(transport.uploads), [("DataPoint/upload.csv", "a")])
+
+########################################################################
+# Tests related to parse_sinks.
+
+def test_parse_sinks():
+    sinks = parse_sinks([{u"name": u"mem", u"transport": u"memory",
+                          u"transport options": {u"latency": 0},
+                          u"max per upload": 10}])
+    eq_(len(sinks), 1)
+    eq_(sinks[0].name, "mem")
+    eq_(sinks[0].max_per_upload, 10)
+
+INVALID_SINKS = (
+    [{"name": "x"}],
+    [{"name": "x", "transport": "no such transport"}],
+    [{"transport": "memory"}],
+    [{"name": "x", "transport": "memory", "capacity": 0}],
+    [{"name": "x", "transport": "memory", "colour": "red"}],
+    [{"name": "x", "transport": "memory", "encoding": "yaml"}],
+    [{"name": "x", "transport": "udp", "compress": True,
+      "transport options": {"host": "127.0.0.1"}}],
+    [{"name": "x", "transport": "udp", "encoding": "json",
+      "transport options": {"host": "127.0.0.1"}}],
+    ["memory"],
+)
+
+def test_parse_sinks_invalid():
+    for sinks in INVALID_SINKS:
+        with assert_raises(ValueError):
+            parse_sinks(sinks)
+
+@patch("xbgw.reporting.sink.create_transport")
+def test_verify_sinks(createMock):
+    eq_(verify_sinks([{u"name": u"log", u"transport": u"rotating file",
+                       u"transport options": {u"path": u"/tmp/x/data.csv"},
+                       u"max per upload": 10}]), True)
+    for sinks in INVALID_SINKS:
+        with assert_raises(ValueError):
+            verify_sinks(sinks)
+    # Verification never creates transports
+    eq_(createMock.call_count, 0)
@@ -0,0 +1,176 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+import os
+import shutil
+import tempfile
+from mock import Mock, patch
+from nose.tools import eq_, assert_raises
+
+import xbgw.reporting.transport as transport
+from xbgw.reporting.transport import (
+    THROTTLED, FileTransport, HttpTransport, IdigidataTransport,
+    MemoryTransport, RotatingFileTransport, TcpTransport, UdpTransport,
+    create_transport)
+
+
+def test_create_transport():
+    uut = create_transport("memory", {u"latency": 0})
+    assert isinstance(uut, MemoryTransport)
+
+
+def test_create_unknown_transport():
+    with assert_raises(ValueError):
+        create_transport("carrier pigeon")
+
+
+def test_create_transport_bad_options():
+    with assert_raises(ValueError):
+        create_transport("memory", {"no such option": 1})
+
+
+def test_idigidata_transport():
+    idigimock = Mock()
+    idigimock.send_to_idigi.return_value = (False, 3, "Some error")
+    with patch.object(transport, "idigidata", idigimock):
+        uut = IdigidataTransport()
+        eq_(uut.send("body", "DataPoint/upload.csv"), (False, "Some error"))
+
+    idigimock.send_to_idigi.assert_called_once_with(
+        "body", "DataPoint/upload.csv")
+
+
+def test_idigidata_transport_unavailable():
+    with patch.object(transport, "idigidata", None):
+        with assert_raises(ValueError):
+            IdigidataTransport()
+
+
+def test_file_transport():
+    directory = tempfile.mkdtemp()
+    try:
+        target = os.path.join(directory, "uploads")
+        uut = FileTransport(target)
+        eq_(uut.send("first", "DataPoint/upload.csv"), (True, ""))
+        eq_(uut.send("second", "DataPoint/upload.csv"), (True, ""))
+
+        names = sorted(os.listdir(target))
+        eq_(len(names), 2)
+        assert names[0].endswith("-000001-upload.csv")
+        with open(os.path.join(target, names[1])) as f:
+            eq_(f.read(), "second")
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_memory_transport():
+    uut = MemoryTransport(max_uploads=2)
+    for body in ("a", "b", "c"):
+        eq_(uut.send(body, "file.csv"), (True, ""))
+    eq_(list(uut.uploads), [("file.csv", "b"), ("file.csv", "c")])
+
+
+@patch("time.time")
+def test_memory_transport_throttle(timeMock):
+    uut = MemoryTransport(min_interval=5)
+    timeMock.return_value = 100
+    eq_(uut.send("a", "file.csv"), (True, ""))
+    timeMock.return_value = 103
+    success, errmsg = uut.send("b", "file.csv")
+    eq_(success, False)
+    assert errmsg.startswith(THROTTLED)
+    eq_(uut.throttled, 1)
+    timeMock.return_value = 105
+    eq_(uut.send("c", "file.csv"), (True, ""))
+
+
+def test_http_transport_bad_url():
+    with assert_raises(ValueError):
+        HttpTransport("ftp://example.com/")
+
+
+def do_http_transport(status, expected_success, throttled=False):
+    with patch("httplib.HTTPConnection") as connMock:
+        response = connMock.return_value.getresponse.return_value
+        response.status = status
+        response.reason = "Reason"
+
+        uut = HttpTransport("http://127.0.0.1:8080/upload/")
+        success, errmsg = uut.send("body", "DataPoint/upload.csv")
+
+        connMock.assert_called_once_with("127.0.0.1:8080", timeout=30.0)
+        connMock.return_value.request.assert_called_once_with(
+            "POST", "/upload/DataPoint/upload.csv", "body",
+            {"Content-Type": "text/plain"})
+        eq_(success, expected_success)
+        eq_(errmsg.startswith(THROTTLED), throttled)
+
+
+def test_http_transport():
+    yield do_http_transport, 200, True
+    yield do_http_transport, 429, False, True
+    yield do_http_transport, 503, False, True
+    yield do_http_transport, 500, False
+
+
+def test_http_transport_gzip():
+    with patch("httplib.HTTPConnection") as connMock:
+        connMock.return_value.getresponse.return_value.status = 200
+
+        uut = HttpTransport("http://127.0.0.1:8080/upload")
+        uut.send("body", "DataPoint/upload.json.gz")
+
+        connMock.return_value.request.assert_called_once_with(
+            "POST", "/upload/DataPoint/upload.json.gz", "body",
+            {"Content-Type": "text/plain", "Content-Encoding": "gzip"})
+
+
+def test_rotating_file_transport():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "logs", "data.csv")
+        uut = RotatingFileTransport(path, max_bytes=10, backups=2)
+        for body in ("first", "second", "third", "fourth"):
+            eq_(uut.send(body, "DataPoint/upload.csv"), (True, ""))
+
+        # Each body is appended with a newline, and the file rotated once
+        # it reaches max_bytes. Only two rotated files are kept.
+        eq_(sorted(os.listdir(os.path.dirname(path))),
+            ["data.csv.1", "data.csv.2"])
+        with open(path + ".1") as f:
+            eq_(f.read(), "third\nfourth\n")
+        with open(path + ".2") as f:
+            eq_(f.read(), "first\nsecond\n")
+    finally:
+        shutil.rmtree(directory)
+
+
+@patch("socket.socket")
+def test_udp_transport_syslog(socketMock):
+    uut = UdpTransport("127.0.0.1", syslog=True)
+    eq_(uut.send("#HEADER\n1,2,INTEGER,a\n3,4,INTEGER,b", "x.csv"),
+        (True, ""))
+    eq_(socketMock.return_value.sendto.call_args_list, [
+        ((("<14>xbgw: 1,2,INTEGER,a"), ("127.0.0.1", 514)),),
+        ((("<14>xbgw: 3,4,INTEGER,b"), ("127.0.0.1", 514)),),
+    ])
+
+
+@patch("socket.create_connection")
+def test_tcp_transport_reconnects(connectMock):
+    import socket
+    uut = TcpTransport("127.0.0.1", 5140)
+    eq_(uut.send("a", "x.csv"), (True, ""))
+    connectMock.return_value.sendall.assert_called_once_with("a\n")
+
+    connectMock.return_value.sendall.side_effect = socket.error("reset")
+    success, errmsg = uut.send("b", "x.csv")
+    eq_(success, False)
+    connectMock.return_value.close.assert_called_once_with()
+
+    connectMock.return_value.sendall.side_effect = None
+    eq_(uut.send("c", "x.csv"), (True, ""))
+    eq_(connectMock.call_count, 2)
@@ -0,0 +1,179 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Unit tests of reloading the settings file while components are running.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+from mock import Mock, patch
+from nose.tools import eq_, assert_raises
+
+from xbgw.settings import (BadSettings, Setting, SettingsMixin,
+                           SettingsRegistry, SettingsWatcher)
+
+pubmock = Mock()
+pubpatch = patch("pubsub.pub", pubmock)
+
+tmpdir = None
+
+
+def setup():
+    global tmpdir
+    tmpdir = tempfile.mkdtemp()
+    pubpatch.start()
+
+
+def teardown():
+    pubpatch.stop()
+    shutil.rmtree(tmpdir)
+
+
+class UUTClass(SettingsMixin):
+    def __init__(self, registry, binding):
+        SettingsMixin.__init__(self)
+        self.register_settings(registry, binding, [
+            Setting(name="change", type=int, required=False,
+                    default_value=1, verify_function=lambda x: x > 0),
+            Setting(name="enabled", type=bool, required=True),
+            Setting(name="port", type=int, required=False,
+                    default_value=80, restart_required=True),
+        ])
+
+
+def write_settings(settings, mtime):
+    path = os.path.join(tmpdir, "settings.json")
+    with open(path, "w") as f:
+        json.dump(settings, f)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def make_registry():
+    path = write_settings({"a": {"change": 5, "enabled": True},
+                           "b": {"enabled": False}}, 1000)
+    registry = SettingsRegistry()
+    registry.load_from_json(path)
+    uut_a = UUTClass(registry, "a")
+    uut_b = UUTClass(registry, "b")
+    pubmock.reset_mock()
+    return registry, uut_a, uut_b
+
+
+def test_reload_applies_changes():
+    registry, uut_a, uut_b = make_registry()
+    path = write_settings({"a": {"enabled": True},
+                           "b": {"change": "7", "enabled": False}}, 2000)
+
+    with patch.object(uut_a, "check_settings",
+                      wraps=uut_a.check_settings) as check:
+        eq_(sorted(registry.reload_from_json(path)), ["a", "b"])
+    eq_(check.call_count, 1)
+
+    # Removed settings revert to their defaults; values are parsed
+    eq_(uut_a.get_setting("change"), 1)
+    eq_(uut_b.get_setting("change"), 7)
+    pubmock.sendMessage.assert_any_call("settings.changed", binding="a",
+                                        changed=["change"])
+    pubmock.sendMessage.assert_any_call("settings.changed", binding="b",
+                                        changed=["change"])
+
+
+def test_reload_replaces_binding():
+    registry, uut_a, _ = make_registry()
+    old_values = uut_a.get_settings()
+    before = registry.get_by_binding("a")
+    path = write_settings({"a": {"change": 2, "enabled": False},
+                           "b": {"enabled": False}}, 2000)
+    registry.reload_from_json(path)
+
+    # The old dictionary is left untouched, for readers still holding it
+    eq_(before, {"change": 5, "enabled": True, "port": 80})
+    eq_(old_values, {"change": 5, "enabled": True, "port": 80})
+    eq_(uut_a.get_settings(), {"change": 2, "enabled": False, "port": 80})
+    eq_(registry.get_by_binding("a"),
+        {"change": 2, "enabled": False, "port": 80})
+
+
+def test_reload_keeps_restart_settings():
+    registry, uut_a, _ = make_registry()
+    path = write_settings({"a": {"change": 2, "enabled": True, "port": 8080},
+                           "b": {"enabled": False}}, 2000)
+
+    with patch("xbgw.settings.registry.logger") as logger:
+        eq_(registry.reload_from_json(path), ["a"])
+    eq_(logger.warning.call_count, 1)
+    assert "port" in logger.warning.call_args[0]
+
+    # Only read at startup, so the running value is kept
+    eq_(uut_a.get_setting("port"), 80)
+    eq_(uut_a.get_setting("change"), 2)
+    pubmock.sendMessage.assert_called_once_with(
+        "settings.changed", binding="a", changed=["change"])
+
+    # A change of nothing else is not announced at all
+    path = write_settings({"a": {"change": 2, "enabled": True, "port": 8081},
+                           "b": {"enabled": False}}, 3000)
+    pubmock.reset_mock()
+    eq_(registry.reload_from_json(path), [])
+    eq_(uut_a.get_setting("port"), 80)
+    eq_(pubmock.sendMessage.call_count, 0)
+
+
+def test_reload_validates_only_changed_bindings():
+    registry, uut_a, uut_b = make_registry()
+    path = write_settings({"a": {"change": 5, "enabled": True},
+                           "b": {"enabled": True}}, 2000)
+
+    with patch.object(uut_a, "check_settings") as check:
+        eq_(registry.reload_from_json(path), ["b"])
+    eq_(check.call_count, 0)
+    eq_(uut_b.get_setting("enabled"), True)
+    eq_(pubmock.sendMessage.call_count, 1)
+
+
+def test_reload_rejects_invalid_settings():
+    registry, uut_a, uut_b = make_registry()
+    path = write_settings({"a": {"change": 0, "enabled": True},
+                           "b": {"change": 3}}, 2000)
+
+    with assert_raises(BadSettings) as caught:
+        registry.reload_from_json(path)
+    eq_(sorted(caught.exception.rejected), ["a.change"])
+    eq_(sorted(caught.exception.missing), ["b.enabled"])
+
+    # Nothing is applied, not even the valid change to "b"
+    eq_(uut_a.get_setting("change"), 5)
+    eq_(uut_b.get_setting("change"), 1)
+    eq_(pubmock.sendMessage.call_count, 0)
+
+
+def test_watcher():
+    registry, uut_a, _ = make_registry()
+    path = os.path.join(tmpdir, "settings.json")
+    watcher = SettingsWatcher(registry, path)
+    eq_(watcher.check(), False)
+
+    write_settings({"a": {"change": 9, "enabled": True},
+                    "b": {"enabled": False}}, 2000)
+    eq_(watcher.check(), True)
+    eq_(uut_a.get_setting("change"), 9)
+    eq_(watcher.check(), False)
+
+    with open(path, "w") as f:
+        f.write("{not json")
+    os.utime(path, (3000, 3000))
+    eq_(watcher.check(), False)
+    eq_(uut_a.get_setting("change"), 9)
+
+    write_settings({"a": {"change": -1, "enabled": True},
+                    "b": {"enabled": False}}, 4000)
+    eq_(watcher.check(), False)
+    eq_(uut_a.get_setting("change"), 9)
@@ -0,0 +1,88 @@
+#!/usr/bin/python2.7
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Compare upload encodings on a synthetic batch of data points
+
+Prints the body size and encoding time of each encoder, with and without
+gzip compression. The batch imitates a gateway with a few XBee nodes
+reporting analog, digital and serial data.
+
+Usage: encoder_benchmark.py [points per batch] [repetitions]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from xbgw.reporting.encoders import ENCODERS, gzip_body
+
+
+def synthetic_batch(count, seed=0):
+    rand = random.Random(seed)
+    nodes = ["[00:13:a2:00:40:%02x:%02x:%02x]!" %
+             (rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255))
+             for _ in xrange(4)]
+    points = []
+    timestamp = 1400000000000
+    for _ in xrange(count):
+        node = rand.choice(nodes)
+        kind = rand.random()
+        if kind < 0.6:
+            points.append(("xbee.analog/%s/AD%d" % (node, rand.randint(0, 3)),
+                           rand.randint(0, 1023), timestamp))
+        elif kind < 0.9:
+            points.append(("xbee.digitalIn/%s/DIO%d" %
+                           (node, rand.randint(0, 3)),
+                           rand.random() < 0.5, timestamp))
+        else:
+            points.append(("xbee.serialIn/%s" % node,
+                           "T=%.1f,H=%d" % (rand.uniform(15, 30),
+                                            rand.randint(20, 80)),
+                           timestamp))
+        timestamp += rand.randint(10, 1000)
+    return points
+
+
+def encode(encoder, points):
+    fragments = [encoder.fragment(stream_id, value, timestamp, True)
+                 for stream_id, value, timestamp in points]
+    return encoder.join(fragments, [point[0] for point in points])
+
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 249
+    repetitions = int(argv[2]) if len(argv) > 2 else 100
+    points = synthetic_batch(count)
+
+    print "%d data points, %d repetitions" % (count, repetitions)
+    print "%-6s %10s %10s %12s %12s" % ("", "bytes", "gzip bytes",
+                                        "ms/encode", "ms/gzip")
+    for name in sorted(ENCODERS):
+        encoder = ENCODERS[name]
+
+        start = time.time()
+        for _ in xrange(repetitions):
+            body = encode(encoder, points)
+        encode_ms = (time.time() - start) * 1000 / repetitions
+
+        start = time.time()
+        for _ in xrange(repetitions):
+            compressed = gzip_body(body)
+        gzip_ms = (time.time() - start) * 1000 / repetitions
+
+        print "%-6s %10d %10d %12.3f %12.3f" % (name, len(body),
+                                                len(compressed), encode_ms,
+                                                gzip_ms)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
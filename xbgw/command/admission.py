@@ -0,0 +1,154 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Admission control for RCI command processing
+
+Every command dispatched by the command processor (see xbgw.command.rci)
+is "in flight" until its responses have been collected, or, if none was
+deferred, until it has been published. AdmissionControl bounds the number
+of commands in flight, in total and per command, so that a burst of slow
+commands cannot tie up every RCI thread. A command over a
+limit is not dispatched; it is answered at once with a 'command.busy'
+error.
+
+AdmissionControl counts admitted and rejected commands (in total and per
+command), and records how long commands waited between the arrival of
+their request and their dispatch ("queue_time") and how long they were in
+flight ("service_time"). The "rci_stats" RCI command reports these.
+"""
+
+import threading
+import time
+
+from xbgw.command.registry import registry
+from xbgw.reporting.metrics import Histogram
+from xbgw.settings import Setting, SettingsMixin, SettingsRegistry
+
+# Histogram bucket bounds for queue and service time (seconds)
+TIME_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30)
+
+
+def verify_limits(limits):
+    return all(isinstance(limit, int) and limit >= 0
+               for limit in limits.itervalues())
+
+
+class AdmissionControl(SettingsMixin):
+    """Limits the number of commands in flight
+
+    Settings:
+
+        * "max in flight": Maximum number of commands in flight, or 0 for
+                           no limit (Default: 32)
+        * "max in flight per command": Maximum number of commands with the
+                                       same tag in flight, or 0 for no
+                                       limit (Default: 0)
+        * "command limits": Dictionary of limits for individual commands,
+                            overriding "max in flight per command", e.g.
+                            {"send_serial": 4} (Default: {})
+
+    Without a settings registry, the defaults apply.
+    """
+
+    def __init__(self, settings_registry=None, settings_binding="rci"):
+        if settings_registry is None:
+            settings_registry = SettingsRegistry()
+        settings_list = [
+            Setting(name="max in flight", type=int, required=False,
+                    default_value=32, verify_function=lambda x: x >= 0),
+            Setting(name="max in flight per command", type=int,
+                    required=False, default_value=0,
+                    verify_function=lambda x: x >= 0),
+            Setting(name="command limits", type=dict, required=False,
+                    default_value={}, verify_function=verify_limits),
+        ]
+        SettingsMixin.__init__(self)
+        self.register_settings(settings_registry, settings_binding,
+                               settings_list)
+
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # tag -> commands in flight, only for tags with any in flight
+        self._in_flight_by_tag = {}
+
+        # Metrics, guarded by _lock
+        self._admitted = 0
+        self._rejected = 0
+        # tag -> rejections, only for tags accepted by _counted
+        self._rejected_by_tag = {}
+        self._queue_time = Histogram(TIME_BUCKETS)
+        self._service_time = Histogram(TIME_BUCKETS)
+
+    def _limit(self, tag):
+        limits = self.get_setting("command limits")
+        if tag in limits:
+            return limits[tag]
+        return self.get_setting("max in flight per command")
+
+    def _counted(self, tag):
+        # Rejections are counted per command only for commands with their
+        # own limit or a registered handler, so that arbitrary command
+        # names do not accumulate
+        return (tag in self.get_setting("command limits") or
+                bool(registry.handlers(tag)))
+
+    def acquire(self, tag, received=None):
+        """
+        Admit a command, received (as part of its request) at time
+        'received'.
+
+        Returns None if admitted, otherwise a hint naming the limit
+        reached. Every admitted command must be released with `release`.
+        """
+        now = time.time()
+        total_limit = self.get_setting("max in flight")
+        tag_limit = self._limit(tag)
+        with self._lock:
+            if total_limit and self._in_flight >= total_limit:
+                self._rejected += 1
+                return "max in flight"
+            if tag_limit and self._in_flight_by_tag.get(tag, 0) >= tag_limit:
+                self._rejected += 1
+                if self._counted(tag):
+                    self._rejected_by_tag[tag] = (
+                        self._rejected_by_tag.get(tag, 0) + 1)
+                return "limit for %s" % tag
+
+            self._in_flight += 1
+            self._in_flight_by_tag[tag] = (
+                self._in_flight_by_tag.get(tag, 0) + 1)
+            self._admitted += 1
+            if received is not None:
+                self._queue_time.observe(now - received)
+        return None
+
+    def release(self, tag, dispatched=None):
+        """Mark a command admitted (at time 'dispatched') as finished"""
+        now = time.time()
+        with self._lock:
+            self._in_flight -= 1
+            count = self._in_flight_by_tag[tag] - 1
+            if count:
+                self._in_flight_by_tag[tag] = count
+            else:
+                del self._in_flight_by_tag[tag]
+            if dispatched is not None:
+                self._service_time.observe(now - dispatched)
+
+    def stats(self):
+        """Return a dictionary of admission metrics"""
+        with self._lock:
+            stats = {
+                "in_flight": self._in_flight,
+                "admitted": self._admitted,
+                "rejected": self._rejected,
+                "queue_time": self._queue_time.snapshot(),
+                "service_time": self._service_time.snapshot(),
+            }
+            for tag, count in self._rejected_by_tag.iteritems():
+                stats["rejected_" + tag] = count
+        return stats
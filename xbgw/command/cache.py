@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Cache of serialized responses to idempotent RCI commands
+
+Commands which only read state may be registered as cacheable (see
+xbgw.command.registry):
+
+    register_command("settings_example", listener, cache_ttl=60,
+                     invalidate_on=["settings.changed"])
+
+The command processor then answers a repeated command, with the same tag
+and the same attributes and contents, with a byte-identical copy of the
+first response for up to 'cache_ttl' seconds, without publishing the
+command again. Responses containing errors are not cached. Publishing a
+message on any of the 'invalidate_on' topics discards the cached
+responses of the command.
+"""
+
+import threading
+import time
+
+import pubsub.pub
+
+
+class ResponseCache(object):
+    """Bounded cache of serialized responses, keyed by (tag, command)
+
+    Once 'max_entries' responses are cached the cache is emptied and starts
+    over.
+    """
+
+    def __init__(self, max_entries=64):
+        self._max_entries = max_entries
+        # key -> (expiry time, serialized response)
+        self._entries = {}
+        # tag -> number of invalidations, so that a response computed while
+        # its command was invalidated is not cached
+        self._generations = {}
+        self._lock = threading.Lock()
+        # Invalidation listeners, referenced here since pubsub does not
+        # hold strong references
+        self._listeners = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now=None):
+        """Return the cached response for 'key', or None"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def generation(self, tag):
+        with self._lock:
+            return self._generations.get(tag, 0)
+
+    def put(self, key, response, ttl, generation=None, now=None):
+        """
+        Cache 'response' for 'ttl' seconds, unless the command ('key[0]')
+        has been invalidated since `generation` returned 'generation'.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if (generation is not None and
+                    self._generations.get(key[0], 0) != generation):
+                return
+            if len(self._entries) >= self._max_entries:
+                self._entries.clear()
+            self._entries[key] = (now + ttl, response)
+
+    def invalidate(self, tag):
+        """Discard every cached response of the command 'tag'"""
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            for key in [key for key in self._entries if key[0] == tag]:
+                del self._entries[key]
+            self.invalidations += 1
+
+    def watch(self, topic, tag):
+        """Invalidate the command 'tag' on every message on 'topic'"""
+        def listener(topic=pubsub.pub.AUTO_TOPIC, **kwargs):
+            self.invalidate(tag)
+
+        self._listeners[(topic, tag)] = listener
+        pubsub.pub.subscribe(listener, topic)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits,
+                    "misses": self.misses,
+                    "invalidations": self.invalidations}
+
+
+# Cache used by the command processor
+response_cache = ResponseCache()
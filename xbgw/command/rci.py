@@ -24,6 +24,13 @@ string "command." concatenated with the top-level tag name under
 do_command. For example the command "echo" would become the topic
 "command.echo".
 
+Handlers may instead register with xbgw.command.registry, in which case
+they are called directly rather than through pubsub. Commands whose tag
+is not a valid command name (see xbgw.command.registry), or which have
+neither a registered handler nor an existing "command." topic, are
+answered with an error without publishing anything, so that bad
+requests cannot grow the pubsub topic tree.
+
 The MDS for these topics requires two arguments:
 
 | element  | An ElementTree Element, the command element itself  |
@@ -78,10 +85,50 @@ retrieval when commands are received.
 What if I need to report status immediately
 -------------------------------------------
 
-If you need to block command processing, use the ResponsePending and
-DeferredResponse objects to handshake with the command processor and
-allow it to block the system RCI thread rather than application
-threads. See the doc-strings of these objects for the expected protocol.
+If you need to block command processing, call the 'defer' method of
+the response queue. It returns a PendingResponse, which you complete
+later, from any thread, with the real response:
+
+    def send_listener(element, response):
+        pending = response.defer(timeout=10)
+        pending.on_abandon(cancel_retries)
+        start_send(element, pending)   # later calls pending.complete(...)
+
+The processor blocks the system RCI thread rather than application
+threads until the response is completed or its timeout (Default:
+BLOCKING_LIMIT seconds) expires, but no later than the deadline of the
+request (see below). Once the processor has stopped waiting, the
+response is "abandoned": 'complete' returns False, the 'abandoned'
+attribute is set and any 'on_abandon' callbacks run, so that handlers
+can stop retrying and release resources early. See the doc-string of
+PendingResponse.
+
+The older handshake, putting ResponsePending and later a matching
+DeferredResponse, is still supported and waits until the request's
+deadline.
+
+Every command of a do_command request is published before the
+processor waits for any response, so that pending commands complete
+concurrently and a request of many slow commands takes about as long
+as the slowest of them. Responses are still returned in the order of
+the commands, and the whole request shares one deadline of
+BLOCKING_LIMIT seconds from its arrival, which no response extends: a
+PendingResponse still outstanding at the deadline is abandoned and
+answered with a 'command.timeout' error. Consequently a listener must
+not rely on an earlier command of the same request having completed.
+
+A command is "in flight" from its publication until its responses have
+been collected, or only until publication returns if none of its
+responses were deferred. The number of commands in flight is limited, in
+total and per command (see xbgw.command.admission); commands over a
+limit are not published, and are answered with a 'command.busy' error
+instead.
+
+Requests are parsed incrementally: each command is published as soon as
+its end tag has been parsed, and each command's responses are serialized
+once collected. If the request turns out to be malformed, the commands
+before the error are still processed and answered, followed by a
+'command.malformed' error.
 
 Message Conventions
 ===================
@@ -119,8 +166,7 @@ do not intend to wait on that deferred processing to finish, consider
 adding a response value indicating the action taken so far. For
 example, the response may be the string "Request queued", "Task
 scheduled", etc. (If you DO intend to wait for the deferred processing
-to finish, use the ResponsePending/DeferredResponse mechanism described
-earlier.)
+to finish, use the 'defer' mechanism described earlier.)
 
 Indicating Error
 ----------------
@@ -155,48 +201,285 @@ ensure that errors from each module can be recognized and are unique.
 """
 import xml.etree.ElementTree as ET
 import Queue
+import threading
+import time
+from collections import deque
+from cStringIO import StringIO
 import pubsub.pub as pub
 # pylint: disable=import-error
 from rci_nonblocking import RciCallback
 import logging
 
+from xbgw.command.admission import AdmissionControl
+from xbgw.command.cache import response_cache
+from xbgw.command.registry import is_valid_command, registry
+from xbgw.reporting.metrics import metrics_element
+
 logger = logging.getLogger(__name__)
 
-BLOCKING_LIMIT = 30  # Don't let bad commands block forever
+BLOCKING_LIMIT = 30  # Don't let bad requests block forever
 
 errors = {
     'command.unknown': "Command not handled",
+    'command.invalid': "Invalid command name",
+    'command.failed': "Command handler failed",
+    'command.malformed': "Malformed request",
     'command.timeout': "Timeout or unexpected exit waiting for response",
+    'command.busy': "Too many commands in progress",
 }
 
+# Limits on commands in flight, replaced when configured through
+# RCICommandProcessor
+admission = AdmissionControl()
 
-def RCICommandProcessor():
+
+def RCICommandProcessor(settings_registry=None, settings_binding="rci"):
+    """
+    Start handling 'do_command' requests. With a settings registry, limits
+    on commands in flight are read from 'settings_binding' (see
+    xbgw.command.admission).
+    """
+    global admission
+    if settings_registry is not None:
+        admission = AdmissionControl(settings_registry, settings_binding)
     logger.info("RCICommandProcessor initialized")
     return RciCallback("xbgw", _handle_rci)
 
 
+def rci_stats_listener(element, response):
+    """Implements the "rci_stats" RCI command"""
+    response.put(metrics_element(admission.stats()))
+
+
 def _handle_rci(body):
-    # Wrap in a fake top level element
-    body = "".join(["<root>", body, "</root>"])
-    root = ET.fromstring(body)
+    # Publish everything first, then wait on all commands together.
+    # Commands are published as soon as the parser completes them, and
+    # neither the request nor the response is held as a whole document.
+    received = time.time()
+    deadline = received + BLOCKING_LIMIT
+    limits = admission
+    # (command element, (responses, cache entry, dispatch time)) for
+    # dispatched commands, (serialized responses, None) for the others.
+    # The dispatch time is None once the command's slot is released.
+    pending = deque()
+
+    def dispatch(command_element):
+        tag = command_element.tag
+        ttl = registry.cache_ttl(tag)
+        if ttl:
+            key = (tag, ET.tostring(command_element))
+            cached = response_cache.get(key)
+            if cached is not None:
+                logger.debug("Cached response for command: %s", tag)
+                pending.append((cached, None))
+                return
+            cache_entry = (key, ttl, response_cache.generation(tag))
+        else:
+            cache_entry = None
+
+        if not has_handler(tag):
+            # Answered at once, without taking a slot
+            if is_valid_command(tag):
+                code = "command.unknown"
+            else:
+                logger.warning("Rejecting invalid command name %r", tag)
+                code = "command.invalid"
+            pending.append((error_responses(tag, code, tag), None))
+            return
+
+        busy = limits.acquire(tag, received)
+        if busy is not None:
+            logger.warning("Rejecting command %s: %s", tag, busy)
+            pending.append((error_responses(tag, "command.busy", busy), None))
+            return
+
+        dispatched = time.time()
+        try:
+            responses = dispatch_command(command_element, deadline)
+        except Exception:
+            limits.release(tag)
+            raise
+        if is_settled(responses):
+            # Nothing left to wait for, so that later commands of the same
+            # request can have the slot
+            limits.release(tag, dispatched)
+            dispatched = None
+        pending.append((command_element,
+                        (responses, cache_entry, dispatched)))
+
+    out = StringIO()
+    try:
+        parse_error = None
+        parser = ET.XMLParser(target=CommandTreeBuilder(dispatch))
+        try:
+            # Wrap in a fake top level element, without copying the body
+            parser.feed("<root>")
+            parser.feed(body)
+            parser.feed("</root>")
+            parser.close()
+        except ET.ParseError, e:
+            logger.error("Malformed do_command request: %s", e)
+            parse_error = e
+
+        while pending:
+            command_element, dispatched = pending.popleft()
+            if dispatched is None:
+                # Already serialized: cached, or rejected
+                out.write(command_element)
+                continue
+
+            responses, cache_entry, dispatched_at = dispatched
+            try:
+                resp_xml = collect_responses(command_element, responses,
+                                             deadline)
+            finally:
+                if dispatched_at is not None:
+                    limits.release(command_element.tag, dispatched_at)
+            if (cache_entry is not None and
+                    resp_xml.find("response/error") is None):
+                key, ttl, generation = cache_entry
+                serialized = ET.tostring(resp_xml)
+                response_cache.put(key, serialized, ttl, generation)
+                out.write(serialized)
+            else:
+                ET.ElementTree(resp_xml).write(out)
+    finally:
+        # Commands left behind by an exception no longer count as in flight
+        for command_element, dispatched in pending:
+            if dispatched is not None and dispatched[2] is not None:
+                limits.release(command_element.tag)
+
+    if parse_error is not None:
+        # Commands before the error have been processed, report the rest
+        resp_xml = ET.Element("responses")
+        resp_xml.append(ErrorResponse("command.malformed", errors,
+                                      hint=str(parse_error)))
+        ET.ElementTree(resp_xml).write(out)
+
+    return out.getvalue()
+
+
+def error_responses(tag, code, hint):
+    """Return a serialized 'responses' element holding a single error"""
+    resp_xml = ET.Element("responses")
+    resp_xml.set("command", tag)
+    resp_xml.append(ErrorResponse(code, errors, hint=hint))
+    return ET.tostring(resp_xml)
 
-    return_list = []
 
-    for command_element in root:
-        resp_xml = process_command(command_element)
-        return_list.append(ET.tostring(resp_xml))
+class CommandTreeBuilder(object):
+    """Parser target building the children of the root element one by one
 
-    return "".join(return_list)
+    Each command element (a child of the wrapping root element) is passed
+    to 'on_command' as soon as its end tag is parsed, and is not attached
+    to the root, so that only the command being parsed is held in memory.
+    """
+
+    def __init__(self, on_command):
+        self._on_command = on_command
+        self._builder = None
+        self._depth = 0
+
+    def start(self, tag, attrib):
+        self._depth += 1
+        if self._depth == 2:
+            self._builder = ET.TreeBuilder()
+        if self._depth >= 2:
+            self._builder.start(tag, attrib)
+
+    def end(self, tag):
+        self._depth -= 1
+        if self._depth >= 1:
+            element = self._builder.end(tag)
+            if self._depth == 1:
+                self._builder = None
+                self._on_command(element)
+
+    def data(self, data):
+        # Text directly under the root is ignored
+        if self._builder is not None:
+            self._builder.data(data)
+
+    def close(self):
+        return None
+
+
+def process_command(command_element, deadline=None):
+    """Publish a single command and wait for its responses"""
+    if deadline is None:
+        deadline = time.time() + BLOCKING_LIMIT
+    return collect_responses(command_element,
+                             dispatch_command(command_element, deadline),
+                             deadline)
+
+
+def has_handler(tag):
+    """
+    Return True if 'tag' is a valid command name with a registered handler
+    or a pubsub topic
+    """
+    if not is_valid_command(tag):
+        return False
+    if registry.handlers(tag):
+        return True
+    return (pub.getDefaultTopicMgr().getTopic("command." + tag,
+                                              okIfNone=True) is not None)
 
 
-def process_command(command_element):
-    logger.info("Processing command: %s", command_element.tag)
+def is_settled(responses):
+    """
+    Return True if no response of a dispatched command's queue is still
+    to come, that is none has been deferred
+    """
+    # "Friends" with PutOnlyQueue
+    # pylint: disable=protected-access
+    queue = responses._queue
+    with queue.mutex:
+        items = list(queue.queue)
+    return not any(item is ResponsePending or
+                   isinstance(item, PendingResponse) for item in items)
 
-    # TODO: Sanitize the tag before topic generation
-    command = "command." + command_element.tag
-    responses = PutOnlyQueue()
-    pub.sendMessage(command, element=command_element, response=responses)
 
+def dispatch_command(command_element, deadline=None):
+    """
+    Publish a command, returning the queue receiving its responses.
+    Responses deferred by handlers are due by 'deadline' at the latest.
+    """
+    tag = command_element.tag
+    logger.info("Processing command: %s", tag)
+    responses = PutOnlyQueue(deadline)
+
+    if not is_valid_command(tag):
+        logger.warning("Rejecting invalid command name %r", tag)
+        responses.put(ErrorResponse("command.invalid", errors, hint=tag))
+        return responses
+
+    handlers = registry.handlers(tag)
+    if handlers:
+        for handler in handlers:
+            try:
+                handler(element=command_element, response=responses)
+            except Exception:
+                logger.exception("Handler of command %s failed", tag)
+                responses.put(ErrorResponse("command.failed", errors,
+                                            hint=tag))
+        return responses
+
+    # Only publish to existing topics, subscribed to by listeners, rather
+    # than create a topic per unknown command. An empty queue is reported
+    # as an unhandled command.
+    command = "command." + tag
+    if pub.getDefaultTopicMgr().getTopic(command, okIfNone=True) is not None:
+        pub.sendMessage(command, element=command_element, response=responses)
+    return responses
+
+
+def collect_responses(command_element, responses, deadline):
+    """
+    Build the 'responses' element of a dispatched command, waiting for
+    pending responses until time.time() passes 'deadline'. Responses still
+    pending then are abandoned, whatever their own timeout.
+    """
     # Format responses for sending to client
     resp_xml = ET.Element("responses")
     resp_xml.set("command", command_element.tag)
@@ -208,15 +491,34 @@ def process_command(command_element):
                                  hint=command_element.tag)
         resp_xml.append(response)
 
-    deferred = 0
-    while not responses._queue.empty() or deferred > 0:
+    deferred = 0  # ResponsePending handshakes, bounded by 'deadline'
+    pending = []  # PendingResponses, bounded by their own and 'deadline'
+    while not responses._queue.empty() or deferred > 0 or pending:
+        # Wake up in time for the earliest deadline still outstanding
+        deadlines = [future.deadline for future in pending]
+        if deferred > 0:
+            deadlines.append(deadline)
+        wait = min(deadlines) - time.time() if deadlines else 0
         try:
-            response = responses._queue.get(timeout=BLOCKING_LIMIT)
+            response = responses._queue.get(timeout=max(0, wait))
         except Queue.Empty:
-            # We gave up on any further deferrals, no one likely to respond.
-            logger.error("Unexpected exit/timeout while processing %s",
-                         command_element.tag)
-            break
+            now = time.time()
+            for future in [f for f in pending if f.deadline <= now]:
+                # A future completed just now is already queued
+                if future.abandon():
+                    logger.error("Timeout waiting for response to %s",
+                                 command_element.tag)
+                    pending.remove(future)
+                    resp_xml.append(ErrorResponse("command.timeout", errors))
+            if deferred > 0 and deadline <= now:
+                # We gave up on any further deferrals, no one likely to
+                # respond.
+                logger.error("Unexpected exit/timeout while processing %s",
+                             command_element.tag)
+                for _ in xrange(deferred):
+                    resp_xml.append(ErrorResponse("command.timeout", errors))
+                deferred = 0
+            continue
 
         if response is ResponsePending:
             logger.debug("Waiting for response")
@@ -224,12 +526,23 @@ def process_command(command_element):
             deferred += 1
             continue
 
+        if isinstance(response, PendingResponse):
+            # No response may hold the request past its deadline
+            response.deadline = min(response.deadline, deadline)
+            logger.debug("Waiting for response within %.1fs",
+                         response.remaining())
+            pending.append(response)
+            continue
+
         if isinstance(response, DeferredResponse):
             logger.debug("Got deferred response")
             # Type checked just above
             # pylint: disable=maybe-no-member
+            if response.future is None:
+                deferred -= 1
+            elif response.future in pending:
+                pending.remove(response.future)
             response = response.response  # Extract "real" response
-            deferred -= 1
 
         # Best effort to deal with "other" data
         if type(response) != ET.Element:
@@ -240,13 +553,7 @@ def process_command(command_element):
         response.tag = "response"
         resp_xml.append(response)
 
-    if deferred > 0:
-        # Exited the loop with outstanding commands, indicate as such to user
-        for _ in xrange(deferred):
-            response = ErrorResponse(
-                "command.timeout", errors)
-            resp_xml.append(response)
-
+    responses.close()
     return resp_xml
 
 
@@ -257,12 +564,117 @@ class PutOnlyQueue(object):
 
     """
 
-    def __init__(self):
+    def __init__(self, deadline=None):
         self._queue = Queue.Queue()
+        self._closed = False
+        # Latest deadline of deferred responses, if any
+        self._deadline = deadline
 
     def put(self, item):
+        if self._closed:
+            logger.warning("Discarding response after processing finished: "
+                           "%r", item)
+            return
         self._queue.put(item)
 
+    def defer(self, timeout=None):
+        """
+        Indicate that the response will be completed later, within
+        'timeout' seconds (Default: BLOCKING_LIMIT), but no later than the
+        deadline of the request.
+
+        Returns a PendingResponse to complete.
+        """
+        future = PendingResponse(self, timeout)
+        if self._deadline is not None:
+            future.deadline = min(future.deadline, self._deadline)
+        self._queue.put(future)
+        return future
+
+    def close(self):
+        # Called by the processor once it no longer reads the queue
+        self._closed = True
+
+
+class PendingResponse(object):
+    """Future-style handle on a response completed after publication
+
+    Created by PutOnlyQueue.defer. Call 'complete' exactly once, from any
+    thread, with the response (anything accepted by 'put', such as an
+    ErrorResponse element). If the processor stops waiting first, the
+    response is abandoned instead: 'complete' returns False, 'abandoned'
+    becomes True and any callbacks registered with 'on_abandon' are called.
+    Handlers may use this, or 'remaining', to give up on work nobody is
+    waiting for.
+    """
+
+    _PENDING, _COMPLETED, _ABANDONED = range(3)
+
+    def __init__(self, queue, timeout=None):
+        if timeout is None:
+            timeout = BLOCKING_LIMIT
+        self.deadline = time.time() + timeout
+        self._queue = queue
+        self._lock = threading.Lock()
+        self._state = self._PENDING
+        self._abandon_callbacks = []
+
+    @property
+    def done(self):
+        """True once completed or abandoned"""
+        return self._state != self._PENDING
+
+    @property
+    def abandoned(self):
+        return self._state == self._ABANDONED
+
+    def remaining(self):
+        """Return the number of seconds the processor will still wait"""
+        return max(0.0, self.deadline - time.time())
+
+    def complete(self, response):
+        """
+        Deliver the response. Returns False if it was already completed or
+        abandoned, in which case the response is discarded.
+        """
+        with self._lock:
+            if self._state != self._PENDING:
+                return False
+            self._state = self._COMPLETED
+        self._queue.put(DeferredResponse(response, self))
+        return True
+
+    def on_abandon(self, callback):
+        """
+        Call 'callback' (without arguments) if the response is abandoned,
+        immediately if it already has been.
+        """
+        with self._lock:
+            if self._state == self._PENDING:
+                self._abandon_callbacks.append(callback)
+                return
+            abandoned = self._state == self._ABANDONED
+        if abandoned:
+            callback()
+
+    def abandon(self):
+        """
+        Stop waiting for the response. Used by the processor; returns False
+        if it was already completed.
+        """
+        with self._lock:
+            if self._state != self._PENDING:
+                return self._state == self._ABANDONED
+            self._state = self._ABANDONED
+            callbacks, self._abandon_callbacks = self._abandon_callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Error in abandoned response callback")
+        return True
+
 
 # Sentinel to indicate that a command is in process, but incomplete
 #
@@ -286,11 +698,13 @@ class DeferredResponse(object):
     Used to encapsulate responses to the command processor that it had
     to wait for.  Having a distinct type for these responses allows it
     to identify them specifically in the stream and match them against
-    the initial ResponsePending indications.
+    the initial ResponsePending indications, or the PendingResponse
+    ('future') they complete.
 
     """
-    def __init__(self, response):
+    def __init__(self, response, future=None):
         self.response = response
+        self.future = future
 
 
 def ErrorResponse(errcode, errdb, hint=None):
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Registry of RCI command handlers
+
+Handlers registered here are called directly by the command processor
+(see xbgw.command.rci), without publishing a pubsub message:
+
+    from xbgw.command.registry import register_command
+
+    register_command("reporter_stats", self.stats_listener)
+
+Handlers take the same arguments as pubsub command listeners, 'element'
+and 'response'. Command names must start with a letter and contain only
+letters, digits and underscores; the processor rejects any other tag
+without creating a pubsub topic for it.
+
+Commands which only read state may be registered with a 'cache_ttl', and
+optionally topics which invalidate their cached responses (see
+xbgw.command.cache).
+
+This module does not depend on the RCI platform module, so components may
+register their commands whether or not the command processor is running.
+"""
+
+import re
+import threading
+
+from xbgw.command.cache import response_cache
+
+# Command names which are also safe to use in pubsub topic names
+VALID_COMMAND = re.compile(r"^[A-Za-z][A-Za-z0-9_]*$")
+
+
+def is_valid_command(tag):
+    return isinstance(tag, basestring) and bool(VALID_COMMAND.match(tag))
+
+
+class CommandRegistry(object):
+    """Maps command names to their handlers
+
+    Lookups take no lock; registration replaces the tuple of handlers of
+    a command rather than modifying it.
+    """
+
+    def __init__(self, cache=response_cache):
+        self._handlers = {}
+        self._cache_ttls = {}
+        self._cache = cache
+        self._lock = threading.Lock()
+
+    def register(self, tag, handler, cache_ttl=None, invalidate_on=()):
+        """
+        Call 'handler(element, response)' for each 'tag' command.
+
+        With 'cache_ttl', responses to the command may be reused for that
+        many seconds, until a message is published on any of the
+        'invalidate_on' topics.
+        """
+        if not is_valid_command(tag):
+            raise ValueError("Invalid command name %r" % tag)
+        with self._lock:
+            self._handlers[tag] = self._handlers.get(tag, ()) + (handler,)
+            if cache_ttl:
+                self._cache_ttls[tag] = float(cache_ttl)
+        for topic in invalidate_on:
+            self._cache.watch(topic, tag)
+
+    def unregister(self, tag, handler):
+        """
+        Remove a handler added by `register`. Raises KeyError if it is not
+        registered.
+        """
+        with self._lock:
+            handlers = list(self._handlers.get(tag, ()))
+            try:
+                handlers.remove(handler)
+            except ValueError:
+                raise KeyError(tag)
+            if handlers:
+                self._handlers[tag] = tuple(handlers)
+            else:
+                del self._handlers[tag]
+                self._cache_ttls.pop(tag, None)
+        self._cache.invalidate(tag)
+
+    def handlers(self, tag):
+        """Return the handlers of a command, possibly an empty tuple"""
+        return self._handlers.get(tag, ())
+
+    def cache_ttl(self, tag):
+        """Return the cache lifetime of a command, or None"""
+        return self._cache_ttls.get(tag)
+
+    def commands(self):
+        return sorted(self._handlers)
+
+
+# Registry used by the command processor
+registry = CommandRegistry()
+register_command = registry.register
+unregister_command = registry.unregister
@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Bounded worker pool for command handlers which need to block
+
+Command handlers must not block the thread publishing the command (see
+xbgw.command.rci). Rather than start a thread per command, a handler
+which has to wait on something submits the work to a WorkerPool, which
+runs it on one of a fixed number of threads and completes the deferred
+response with its result:
+
+    from xbgw.command.workers import shared_pool
+
+    def slow_listener(element, response):
+        shared_pool.run_deferred(response, slow_function, element)
+
+Work beyond what the threads and a bounded queue can hold is rejected:
+`submit` raises PoolSaturated, and `run_deferred` answers with a
+'workers.saturated' error, so that bursts of commands cannot exhaust the
+gateway's memory. Work whose response has been abandoned by the time a
+thread picks it up is skipped.
+
+Each pool counts submitted, completed, failed, rejected and skipped work,
+and records how long work waited in the queue and ran. The
+"worker_stats" RCI command reports the metrics of the shared pool.
+"""
+
+import logging
+import Queue
+import threading
+import time
+
+from xbgw.command.rci import ErrorResponse
+from xbgw.reporting.metrics import Histogram, metrics_element
+
+logger = logging.getLogger(__name__)
+
+errors = {
+    'workers.saturated': "Too many requests in progress",
+    'workers.failed': "Request failed",
+}
+
+# Histogram bucket bounds for queue wait and run time (seconds)
+TIME_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 10, 30)
+
+# Returned by work which was skipped rather than run
+_SKIPPED = object()
+
+
+class PoolSaturated(Exception):
+    """Raised by WorkerPool.submit when the queue is full"""
+    pass
+
+
+class WorkerPool(object):
+    """Runs submitted functions on a bounded number of threads
+
+    Arguments:
+        - workers: maximum number of threads, started as needed
+        - queue_limit: number of submitted functions which may wait for a
+                       thread before further submissions are rejected
+        - name: name used for threads and log messages
+    """
+
+    def __init__(self, workers=4, queue_limit=32, name="workers"):
+        if workers <= 0 or queue_limit < 0:
+            raise ValueError("Pool needs at least one worker and a "
+                             "non-negative queue limit")
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.name = name
+        # Unbounded; the limit is enforced by submit under _lock
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._idle = 0
+        self._queued = 0
+
+        # Metrics, guarded by _lock
+        self._counters = dict.fromkeys(
+            ("submitted", "completed", "failed", "rejected", "skipped"), 0)
+        self._queue_wait = Histogram(TIME_BUCKETS)
+        self._run_time = Histogram(TIME_BUCKETS)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue 'fn(*args, **kwargs)' to run on a worker thread.
+
+        Raises PoolSaturated if every thread is busy and the queue is full.
+        """
+        with self._lock:
+            # Idle threads, and threads not yet started, take work at once
+            spare = self._idle + self.workers - len(self._threads)
+            if self._queued >= spare + self.queue_limit:
+                self._counters["rejected"] += 1
+                raise PoolSaturated("%s: %d requests queued" %
+                                    (self.name, self._queued))
+            self._counters["submitted"] += 1
+            self._queued += 1
+            if (self._queued > self._idle and
+                    len(self._threads) < self.workers):
+                self._start_thread()
+        self._queue.put((time.time(), fn, args, kwargs))
+
+    def _start_thread(self):
+        # Caller must hold _lock
+        thread = threading.Thread(
+            target=self._run,
+            name="%s-%d" % (self.name, len(self._threads) + 1))
+        thread.daemon = True
+        self._threads.append(thread)
+        self._idle += 1
+        thread.start()
+
+    def _run(self):
+        while True:
+            submitted, fn, args, kwargs = self._queue.get()
+            start = time.time()
+            with self._lock:
+                self._queued -= 1
+                self._idle -= 1
+                self._queue_wait.observe(start - submitted)
+
+            counter = "completed"
+            try:
+                if fn(*args, **kwargs) is _SKIPPED:
+                    counter = "skipped"
+            except Exception:
+                logger.exception("%s: work failed", self.name)
+                counter = "failed"
+
+            with self._lock:
+                self._idle += 1
+                self._counters[counter] += 1
+                self._run_time.observe(time.time() - start)
+
+    def run_deferred(self, response, fn, *args, **kwargs):
+        """
+        Defer 'response' (see xbgw.command.rci.PutOnlyQueue.defer) and
+        complete it with the result of 'fn(*args, **kwargs)', run on a
+        worker thread.
+
+        The keyword argument 'timeout' is passed to 'defer' rather than to
+        'fn'. If the pool is saturated, or 'fn' raises, the response is
+        completed with an error.
+        """
+        pending = response.defer(kwargs.pop("timeout", None))
+        try:
+            self.submit(self._complete, pending, fn, args, kwargs)
+        except PoolSaturated, e:
+            logger.warning("Rejecting request: %s", e)
+            pending.complete(ErrorResponse("workers.saturated", errors,
+                                           hint=self.name))
+        return pending
+
+    def _complete(self, pending, fn, args, kwargs):
+        if pending.abandoned:
+            return _SKIPPED
+
+        try:
+            result = fn(*args, **kwargs)
+        except Exception, e:
+            pending.complete(ErrorResponse("workers.failed", errors,
+                                           hint=str(e)))
+            raise
+        pending.complete(result)
+
+    def stats(self):
+        """Return a dictionary of the pool's metrics"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update({
+                "threads": len(self._threads),
+                "active": len(self._threads) - self._idle,
+                "queued": self._queued,
+                "queue_wait": self._queue_wait.snapshot(),
+                "run_time": self._run_time.snapshot(),
+            })
+        return stats
+
+
+# Pool shared by command handlers
+shared_pool = WorkerPool(name="command-workers")
+
+
+def worker_stats_listener(element, response):
+    """Implements the "worker_stats" RCI command for the shared pool"""
+    response.put(metrics_element(shared_pool.stats()))
@@ -6,10 +6,9 @@
 
 import logging
 import time
-import threading
 
 import pubsub.pub as pub
-from xbgw.command.rci import DeferredResponse, ResponsePending
+from xbgw.command.workers import shared_pool
 
 
 logger = logging.getLogger(__name__)
@@ -17,8 +16,8 @@ logger = logging.getLogger(__name__)
 
 def do_echo(element, response):
     logger.debug("Queueing Element: %s", element)
-    threading.Thread(target=echo_later, args=(element, response)).start()
-    response.put(ResponsePending)
+    # Blocking work runs on the shared pool rather than a thread of its own
+    shared_pool.run_deferred(response, echo_later, element)
 
 
 class DelayedEchoCommand(object):
@@ -26,7 +25,6 @@ class DelayedEchoCommand(object):
         pub.subscribe(do_echo, "command.echo")
 
 
-def echo_later(element, response):
+def echo_later(element):
     time.sleep(5)
-    element = DeferredResponse(element)
-    response.put(element)
+    return element
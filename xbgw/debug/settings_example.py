@@ -14,8 +14,8 @@ of the application.
 import logging
 logger = logging.getLogger(__name__)
 
-import pubsub.pub as pub
-
+from xbgw.command.registry import register_command
+from xbgw.settings.registry import SETTINGS_CHANGED_TOPIC
 from xbgw.settings.settings_base import (
     Setting, SettingsMixin, SettingNotFound)
 
@@ -60,8 +60,12 @@ class SettingsExampleCommand(SettingsMixin):
         self.register_settings(settings_registry, settings_binding,
                                settings_list)
 
-        # Subscribe to "settings_example" RCI command
-        pub.subscribe(self.rci_listener, "command.settings_example")
+        # Register the "settings_example" RCI command. Settings only change
+        # when the settings file is reloaded, so identical requests may be
+        # answered from the response cache until then.
+        register_command("settings_example", self.rci_listener,
+                         cache_ttl=60,
+                         invalidate_on=[SETTINGS_CHANGED_TOPIC])
 
         # Log the value of "a required int" to show settings are working
         logger.debug("'a required int' is set to %d",
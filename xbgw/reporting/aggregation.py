@@ -0,0 +1,223 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define windowed aggregation of data streams before upload
+
+Aggregation is configured as a list of rules. Each rule is a dictionary
+with the following keys:
+
+    * "streams": A shell-style pattern (see the fnmatch module), or list of
+                 patterns, matched against stream ids such as
+                 "xbee.analog/[00:13:A2:00:40:A1:B2:C3]!/AD1" (required)
+    * "window": Length of the aggregation window in seconds (required)
+    * "statistics": List of statistics to report for each window, any of
+                    "min", "max", "mean", "count" and "last".
+                    (Default: all of them)
+
+The first rule matching a stream applies. Windows are aligned to multiples
+of their length since the epoch. When a window closes, one data point per
+statistic is produced on the stream "<stream id>/<statistic>", timestamped
+with the start of the window. Non-numeric values are never aggregated.
+"""
+
+import fnmatch
+
+STATISTICS = ("min", "max", "mean", "count", "last")
+
+
+class AggregationRule(object):
+    """A single parsed aggregation rule (see module docstring)"""
+
+    def __init__(self, streams, window, statistics=STATISTICS):
+        if isinstance(streams, basestring):
+            streams = [streams]
+        if not streams:
+            raise ValueError("Aggregation rule has no stream patterns")
+        window = float(window)
+        if window <= 0:
+            raise ValueError("Aggregation window must be positive")
+        if not statistics:
+            raise ValueError("Aggregation rule has no statistics")
+        for stat in statistics:
+            if stat not in STATISTICS:
+                raise ValueError("Unknown statistic '%s'" % stat)
+
+        self.patterns = [str(pattern) for pattern in streams]
+        self.window = int(window * 1000)  # milliseconds
+        self.statistics = tuple(str(stat) for stat in statistics)
+
+    def matches(self, stream_id):
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(stream_id, pattern):
+                return True
+        return False
+
+
+def parse_rules(rules):
+    """
+    Parse a list of rule dictionaries into AggregationRule objects.
+
+    Raises ValueError if any rule is invalid.
+    """
+    parsed = []
+    for rule in rules:
+        if not isinstance(rule, dict):
+            raise ValueError("Aggregation rule must be a dictionary")
+        kwargs = dict((str(key), value) for key, value in rule.iteritems())
+        try:
+            parsed.append(AggregationRule(**kwargs))
+        except TypeError, e:
+            raise ValueError("Invalid aggregation rule %r: %s" % (rule, e))
+    return parsed
+
+
+class Accumulator(object):
+    """Running statistics for one stream's current window"""
+
+    __slots__ = ('start', 'count', 'total', 'minimum', 'maximum', 'last')
+
+    def __init__(self, start, value):
+        self.start = start
+        self.count = 1
+        self.total = value
+        self.minimum = value
+        self.maximum = value
+        self.last = value
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        if value > self.maximum:
+            self.maximum = value
+        self.last = value
+
+    def statistic(self, name):
+        if name == "min":
+            return self.minimum
+        elif name == "max":
+            return self.maximum
+        elif name == "mean":
+            return float(self.total) / self.count
+        elif name == "count":
+            return self.count
+        return self.last
+
+
+class StreamAggregator(object):
+    """Aggregates matching data streams over tumbling windows
+
+    Samples are fed in with `process`, which either declines the sample
+    (it should be reported as-is) or folds it into the stream's running
+    accumulator in constant time. Closed windows are emitted as a list of
+    (stream_id, value, timestamp) points, either when a sample for a later
+    window arrives or when `close_expired` is called after the window end.
+
+    StreamAggregator is not thread safe.
+    """
+
+    def __init__(self, rules):
+        self._rules = parse_rules(rules)
+        # stream id -> matching rule (or None), cached
+        self._matches = {}
+        # stream id -> (rule, Accumulator) for open windows
+        self._open = {}
+        # (stream id, statistic) -> output stream id
+        self._names = {}
+
+    def __len__(self):
+        return len(self._open)
+
+    def _rule_for(self, stream_id):
+        try:
+            return self._matches[stream_id]
+        except KeyError:
+            pass
+
+        rule = None
+        for candidate in self._rules:
+            if candidate.matches(stream_id):
+                rule = candidate
+                break
+
+        if len(self._matches) >= 4096:
+            self._matches.clear()
+        self._matches[stream_id] = rule
+        return rule
+
+    def process(self, stream_id, value, timestamp):
+        """
+        Feed a sample (timestamp in milliseconds) to the aggregator.
+
+        Returns None if the sample is not aggregated. Otherwise returns a
+        list, usually empty, of points from windows closed by this sample.
+        """
+        if not self._rules:
+            return None
+        if type(value) not in (int, long, float):
+            return None
+
+        rule = self._rule_for(stream_id)
+        if rule is None:
+            return None
+
+        start = timestamp - timestamp % rule.window
+        emitted = []
+
+        entry = self._open.get(stream_id)
+        if entry is not None:
+            acc = entry[1]
+            if acc.start == start:
+                acc.add(value)
+                return emitted
+            # Sample belongs to a new window, close the current one
+            emitted = self._emit(stream_id, rule, acc)
+
+        self._open[stream_id] = (rule, Accumulator(start, value))
+        return emitted
+
+    def close_expired(self, now):
+        """
+        Close every window which ended at or before 'now' (milliseconds).
+
+        Returns a list of points for the closed windows.
+        """
+        emitted = []
+        for stream_id, (rule, acc) in self._open.items():
+            if acc.start + rule.window <= now:
+                del self._open[stream_id]
+                emitted.extend(self._emit(stream_id, rule, acc))
+        return emitted
+
+    def close_all(self):
+        """Close every open window, returning the points produced."""
+        emitted = []
+        for stream_id, (rule, acc) in self._open.items():
+            emitted.extend(self._emit(stream_id, rule, acc))
+        self._open.clear()
+        return emitted
+
+    def next_deadline(self):
+        """Return the end (milliseconds) of the earliest open window."""
+        if not self._open:
+            return None
+        return min(acc.start + rule.window
+                   for rule, acc in self._open.itervalues())
+
+    def _emit(self, stream_id, rule, acc):
+        points = []
+        for stat in rule.statistics:
+            key = (stream_id, stat)
+            name = self._names.get(key)
+            if name is None:
+                if len(self._names) >= 4096:
+                    self._names.clear()
+                name = intern("%s/%s" % (stream_id, stat))
+                self._names[key] = name
+            points.append((name, acc.statistic(stat), acc.start))
+        return points
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define retry backoff helpers for reporting managers
+"""
+
+import random
+import time
+
+
+class Backoff(object):
+    """Exponential backoff with jitter
+
+    Each consecutive failure doubles the delay before the next attempt,
+    starting from 'base' seconds and capped at 'maximum' seconds. The delay
+    is randomized between half and all of that value, so that gateways
+    failing together do not retry in lockstep.
+
+    Arguments:
+        - rand: function returning a float in [0, 1), for testing
+                (Default: random.random)
+    """
+
+    def __init__(self, rand=random.random):
+        self._random = rand
+        self.failures = 0
+        self._until = 0
+
+    def failure(self, base, maximum, now=None):
+        """Record a failure and return the delay before the next attempt"""
+        if now is None:
+            now = time.time()
+
+        self.failures += 1
+        delay = min(maximum, base * (2 ** (self.failures - 1)))
+        delay = delay / 2.0 + self._random() * delay / 2.0
+        self._until = now + delay
+        return delay
+
+    def success(self):
+        self.failures = 0
+        self._until = 0
+
+    def remaining(self, now=None):
+        """Return the seconds left until the next attempt is allowed"""
+        if now is None:
+            now = time.time()
+        return max(0, self._until - now)
+
+
+class CircuitBreaker(object):
+    """Pauses uploads during sustained outages
+
+    The breaker starts "closed", allowing uploads. After 'threshold'
+    consecutive failures it "opens" and refuses uploads for 'cooldown'
+    seconds. It then becomes "half-open" and lets a single trial upload
+    through: success closes the breaker again, failure re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_until = 0
+        self._trial_pending = False
+
+    def failure(self, threshold, cooldown, now=None):
+        """Record a failure. Returns True if the breaker (re)opened."""
+        if now is None:
+            now = time.time()
+
+        self.failures += 1
+        self._trial_pending = False
+        if self.state == self.HALF_OPEN or self.failures >= threshold:
+            self.state = self.OPEN
+            self._opened_until = now + cooldown
+            return True
+        return False
+
+    def success(self):
+        """Record a success. Returns True if the breaker was not closed."""
+        changed = self.state != self.CLOSED
+        self.state = self.CLOSED
+        self.failures = 0
+        self._trial_pending = False
+        return changed
+
+    def throttled(self):
+        """
+        Record a throttled upload. It neither closes nor re-opens the
+        breaker, but ends a half-open trial, so that another may be sent.
+        """
+        self._trial_pending = False
+
+    def dispatched(self):
+        """Record that an upload was started"""
+        if self.state == self.HALF_OPEN:
+            self._trial_pending = True
+
+    def remaining(self, now=None):
+        """
+        Return the seconds left until an upload is allowed.
+
+        Returns None while a half-open trial upload is awaiting its result.
+        """
+        if self.state == self.CLOSED:
+            return 0
+
+        if now is None:
+            now = time.time()
+
+        if self.state == self.OPEN:
+            wait = self._opened_until - now
+            if wait > 0:
+                return wait
+            self.state = self.HALF_OPEN
+
+        if self._trial_pending:
+            return None
+        return 0
+
+
+class AdaptiveRate(object):
+    """Stretches the upload interval in response to throttling
+
+    Each throttled upload multiplies the interval by 'increase'; each
+    successful upload shrinks it by 'decrease', never going below the
+    configured rate limit.
+    """
+
+    def __init__(self, increase=1.5, decrease=0.9):
+        self.factor = 1.0
+        self._increase = increase
+        self._decrease = decrease
+
+    def throttled(self, maximum_factor):
+        self.factor = min(maximum_factor, self.factor * self._increase)
+
+    def succeeded(self):
+        self.factor = max(1.0, self.factor * self._decrease)
+
+    def interval(self, rate_limit):
+        """Return the effective interval for the configured rate limit"""
+        return rate_limit * self.factor
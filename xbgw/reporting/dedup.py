@@ -0,0 +1,200 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define report-by-exception filtering of data streams
+
+Report-by-exception is configured as a list of rules. Each rule is a
+dictionary with the following keys:
+
+    * "streams": A shell-style pattern (see the fnmatch module), or list of
+                 patterns, matched against stream ids (required)
+    * "deadband": Numeric values are only reported once they differ from
+                  the last reported value by more than this amount. With
+                  the default of 0, any change is reported. Other values
+                  are reported whenever they are not equal to the last
+                  reported value. (Default: 0)
+    * "heartbeat": If non-zero, the latest value of a stream is reported
+                   again once nothing has been reported on the stream for
+                   this many seconds, so that consumers can tell a quiet
+                   stream from a dead one. (Default: 0)
+
+The first rule matching a stream applies; streams matching no rule are
+always reported.
+"""
+
+import fnmatch
+
+
+class ExceptionRule(object):
+    """A single parsed report-by-exception rule (see module docstring)"""
+
+    def __init__(self, streams, deadband=0, heartbeat=0):
+        if isinstance(streams, basestring):
+            streams = [streams]
+        if not streams:
+            raise ValueError("Report-by-exception rule has no stream "
+                             "patterns")
+        deadband = float(deadband)
+        heartbeat = float(heartbeat)
+        if deadband < 0 or heartbeat < 0:
+            raise ValueError("Deadband and heartbeat must not be negative")
+
+        self.patterns = [str(pattern) for pattern in streams]
+        self.deadband = deadband
+        self.heartbeat = int(heartbeat * 1000)  # milliseconds
+
+    def matches(self, stream_id):
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(stream_id, pattern):
+                return True
+        return False
+
+    def changed(self, previous, value):
+        """Return True if 'value' should be reported after 'previous'"""
+        if (type(value) in (int, long, float) and
+                type(previous) in (int, long, float)):
+            return abs(value - previous) > self.deadband
+        return type(value) != type(previous) or value != previous
+
+
+def parse_exception_rules(rules):
+    """
+    Parse a list of rule dictionaries into ExceptionRule objects.
+
+    Raises ValueError if any rule is invalid.
+    """
+    parsed = []
+    for rule in rules:
+        if not isinstance(rule, dict):
+            raise ValueError("Report-by-exception rule must be a dictionary")
+        kwargs = dict((str(key), value) for key, value in rule.iteritems())
+        try:
+            parsed.append(ExceptionRule(**kwargs))
+        except TypeError, e:
+            raise ValueError("Invalid report-by-exception rule %r: %s" %
+                             (rule, e))
+    return parsed
+
+
+class LastValue(object):
+    """Last reported and latest seen value of one stream"""
+
+    __slots__ = ('rule', 'reported', 'latest', 'reported_at')
+
+    def __init__(self, rule, value, timestamp):
+        self.rule = rule
+        self.reported = value
+        self.latest = value
+        self.reported_at = timestamp
+
+
+class ChangeFilter(object):
+    """Suppresses unchanged values and produces heartbeats
+
+    `process` decides whether a sample should be reported. `heartbeats`
+    returns points for streams which have been quiet for longer than their
+    heartbeat interval.
+
+    The last-value table is bounded; once 'max_entries' streams are known
+    it is emptied and starts over, at the cost of reporting the next value
+    of each stream even if unchanged.
+
+    ChangeFilter is not thread safe.
+    """
+
+    def __init__(self, rules, max_entries=4096):
+        self._rules = parse_exception_rules(rules)
+        self._max_entries = max_entries
+        # stream id -> matching rule (or None), cached
+        self._matches = {}
+        # stream id -> LastValue
+        self._values = {}
+        # No heartbeat is due before this time (milliseconds)
+        self._next_heartbeat = None
+        # Number of samples suppressed
+        self.suppressed = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def _rule_for(self, stream_id):
+        try:
+            return self._matches[stream_id]
+        except KeyError:
+            pass
+
+        rule = None
+        for candidate in self._rules:
+            if candidate.matches(stream_id):
+                rule = candidate
+                break
+
+        if len(self._matches) >= self._max_entries:
+            self._matches.clear()
+        self._matches[stream_id] = rule
+        return rule
+
+    def process(self, stream_id, value, timestamp):
+        """
+        Feed a sample (timestamp in milliseconds) to the filter.
+
+        Returns True if the sample should be reported.
+        """
+        if not self._rules:
+            return True
+
+        rule = self._rule_for(stream_id)
+        if rule is None:
+            return True
+
+        entry = self._values.get(stream_id)
+        if entry is None:
+            if len(self._values) >= self._max_entries:
+                self._values.clear()
+            self._values[stream_id] = LastValue(rule, value, timestamp)
+            self._schedule(rule, timestamp)
+            return True
+
+        entry.latest = value
+        if rule.changed(entry.reported, value):
+            entry.reported = value
+            entry.reported_at = timestamp
+            return True
+
+        self.suppressed += 1
+        return False
+
+    def _schedule(self, rule, reported_at):
+        if rule.heartbeat:
+            due = reported_at + rule.heartbeat
+            if self._next_heartbeat is None or due < self._next_heartbeat:
+                self._next_heartbeat = due
+
+    def heartbeats(self, now):
+        """
+        Return (stream_id, value, timestamp) points for every stream due a
+        heartbeat at 'now' (milliseconds), and mark them reported.
+        """
+        if self._next_heartbeat is None or now < self._next_heartbeat:
+            return []
+
+        points = []
+        self._next_heartbeat = None
+        for stream_id, entry in self._values.iteritems():
+            rule = entry.rule
+            if not rule.heartbeat:
+                continue
+            if entry.reported_at + rule.heartbeat <= now:
+                points.append((stream_id, entry.latest, now))
+                entry.reported = entry.latest
+                entry.reported_at = now
+            self._schedule(rule, entry.reported_at)
+        return points
+
+    def next_deadline(self):
+        """Return the time (milliseconds) the next heartbeat may be due"""
+        return self._next_heartbeat
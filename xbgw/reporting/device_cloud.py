@@ -8,17 +8,29 @@
 Define reporting manager for posting data points to Digi Device Cloud
 """
 
-# pylint: disable=import-error
-import idigidata  # Provided by XBee Gateway
 import pubsub.pub
+import cPickle
 import logging
+import os
+import Queue
 import re
 import threading
 import time
-import base64
-from collections import deque
 
-from xbgw.settings import Setting, SettingsMixin
+from xbgw.reporting.backoff import AdaptiveRate, Backoff, CircuitBreaker
+from xbgw.reporting.aggregation import StreamAggregator, parse_rules
+from xbgw.reporting.dedup import ChangeFilter, parse_exception_rules
+from xbgw.reporting.encoders import (ENCODERS, data_type, get_encoder,
+                                     gzip_body)
+from xbgw.reporting.lanes import LaneQueue, parse_lanes
+from xbgw.reporting.metrics import Histogram
+from xbgw.reporting.records import StreamIdCache
+from xbgw.reporting.scheduler import RateLimiter, flush_delay
+from xbgw.reporting.sequence import (SequenceTracker, format_ranges,
+                                    save_state)
+from xbgw.reporting.sink import parse_sinks, verify_sinks
+from xbgw.reporting.transport import THROTTLED, TRANSPORTS, create_transport
+from xbgw.settings import BadSettings, Setting, SettingsMixin
 
 logger = logging.getLogger(__name__)
 
@@ -65,17 +77,41 @@ def id_to_stream(ident):
     return escaped_stream
 
 
+def topic_to_stream(topic, ident):
+    """
+    Convert a topic name and message identity into a DataStream name
+    """
+    return "{}/{}".format(topic, id_to_stream(ident))
+
+
 def get_type(obj):
     """Return Device Cloud data point type for the given Python object"""
-    t = type(obj)
-    if t == int or t == bool:
-        return "INTEGER"
-    elif t == str:
-        return "STRING"
-    elif t == float:
-        return "DOUBLE"
+    return data_type(obj)
+
+
+# Topic on which DeviceCloudReporter publishes changes to its backoff state
+BACKOFF_TOPIC = "reporting.backoff"
+
+# Prefix of the streams on which DeviceCloudReporter reports its own metrics
+METRICS_STREAM = "reporter.metrics"
 
-    return "UNKNOWN"
+# Histogram bucket bounds for upload latency (seconds), points and bytes
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+POINTS_BUCKETS = (1, 10, 50, 100, 250, 500, 1000)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144)
+
+# Minimum number of seconds between writes of the sequence file while
+# uploading spooled data. Points settled since the last write may be
+# uploaded again after a crash.
+SEQUENCE_SAVE_INTERVAL = 5
+
+
+def earliest(*waits):
+    """Return the smallest of the given waits, ignoring None"""
+    waits = [wait for wait in waits if wait is not None]
+    if not waits:
+        return None
+    return min(waits)
 
 
 class DeviceCloudReporter(SettingsMixin):
@@ -103,19 +139,222 @@ class DeviceCloudReporter(SettingsMixin):
         pubsub.pub.sendMessage("example.stream",
                                ident=("one", 2), value="Hello world")
 
+    Uploads are scheduled so as to honor the Device Cloud rate limit. Queued
+    data is uploaded once the rate limit window opens and one of the
+    configured flush triggers fires (see "flush count" and "flush age"
+    below). While a backlog of full batches exists, up to "burst uploads"
+    batches are sent back to back within one rate limit window.
+
     Available settings:
 
         * "encode serial": If set to `true`, string values will be converted to
                            base64 encoding when uploaded to Device Cloud
+        * "encoding": Format of upload bodies, one of "csv", "xml" or
+                      "json". See xbgw.reporting.encoders. Only takes
+                      effect at startup. (Default: "csv")
+        * "compress": If set to `true`, upload bodies are gzip compressed.
+                      Only transports which accept compressed bodies may
+                      be used. Only takes effect at startup.
+                      (Default: false)
+        * "rate limit": Minimum number of seconds between uploads. Device
+                        Cloud Free/Developer tiers require 5 seconds, Standard
+                        tier and above can use 1 second. (Default: 5)
+        * "burst uploads": Number of full batches which may be uploaded
+                           within one rate limit window while a backlog
+                           exists. (Default: 1)
+        * "max per upload": Maximum number of data points per upload.
+                            (Default: 249)
+        * "max upload bytes": If non-zero, maximum size of an upload body
+                              in bytes. Batches are filled up to this size
+                              as well as to "max per upload". A single data
+                              point too large to fit is dropped, with an
+                              error logged. (Default: 65536)
+        * "max queue size": Number of data points which may be queued in the
+                            default lane before it is purged.
+                            (Default: 5000)
+        * "flush count": If non-zero, wait until at least this many data
+                         points are queued before uploading. (Default: 0)
+        * "flush age": If non-zero, wait until the oldest queued data point
+                       is this many seconds old before uploading. Combined
+                       with "flush count", whichever fires first triggers
+                       the upload. (Default: 0)
+        * "retry time": Seconds to wait after the first failed upload. The
+                        wait doubles with each consecutive failure.
+                        (Default: 5)
+        * "max backoff": Longest wait between upload attempts, in seconds.
+                         Also bounds how far throttling may stretch the
+                         rate limit. (Default: 300)
+        * "breaker threshold": Number of consecutive failed uploads (other
+                               than throttling) after which uploads are
+                               paused. (Default: 5)
+        * "breaker cooldown": Seconds to pause uploads once the breaker
+                              threshold is reached, before a single trial
+                              upload is attempted. (Default: 60)
+
+        * "upload workers": Number of uploads which may be in flight at the
+                            same time. Only takes effect at startup.
+                            (Default: 1)
+        * "transport": How upload bodies are delivered. One of "idigidata"
+                       (upload to Device Cloud), "http", "file" or "memory".
+                       See xbgw.reporting.transport. Only takes effect at
+                       startup. (Default: "idigidata")
+        * "transport options": Dictionary of options for the transport,
+                               e.g. {"directory": "/tmp/uploads"} for the
+                               "file" transport. Only takes effect at
+                               startup. (Default: {})
+        * "aggregation": List of rules for summarizing streams over time
+                         windows before upload, e.g.
+                         [{"streams": "xbee.analog/*", "window": 60,
+                           "statistics": ["min", "max", "mean"]}].
+                         See xbgw.reporting.aggregation. Only takes effect
+                         at startup. (Default: [])
+        * "report by exception": List of rules for suppressing repeated
+                                 values, e.g.
+                                 [{"streams": "xbee.serialIn/*",
+                                   "heartbeat": 600},
+                                  {"streams": "xbee.analog/*",
+                                   "deadband": 5}].
+                                 Values are only reported when they change
+                                 by more than the deadband, or when the
+                                 heartbeat interval passes without a report.
+                                 Applies after aggregation. See
+                                 xbgw.reporting.dedup. Only takes effect at
+                                 startup. (Default: [])
+        * "lanes": List of priority lanes, highest priority first, e.g.
+                   [{"name": "alarms", "streams": "xbee.digitalIn/*",
+                     "capacity": 500, "urgent": true}].
+                   Each upload batch is filled from the highest priority
+                   lane first. Streams not assigned to a lane share a
+                   default lane of "max queue size" points.
+                   See xbgw.reporting.lanes. Only takes effect at startup.
+                   (Default: [])
+        * "metrics interval": If non-zero, report the reporter's own metrics
+                              (see `stats`) as data points under
+                              "reporter.metrics/" every this many seconds.
+                              (Default: 0)
+        * "shutdown timeout": Seconds `shutdown` may spend uploading queued
+                              data before spilling the rest to the spool
+                              file. (Default: 10)
+        * "spool file": File holding data left over at shutdown, which is
+                        queued again on the next start. An empty string
+                        disables spooling. (Default: "xbgw_spool.dat")
+        * "sequence file": File recording which data points have been
+                           uploaded, so that spooled data is not uploaded
+                           twice. It is written at shutdown, and every
+                           SEQUENCE_SAVE_INTERVAL (5) seconds at most while
+                           data from the spool file is being uploaded, so
+                           after a crash the latest uploads may be
+                           repeated. An empty string disables it.
+                           (Default: "xbgw_sequence.json")
+        * "sinks": List of further destinations for the same data, e.g.
+                   [{"name": "historian", "transport": "tcp",
+                     "transport options": {"host": "10.0.0.2",
+                                           "port": 5140}}].
+                   Each sink has its own queue, rate limit and backoff.
+                   See xbgw.reporting.sink. Only takes effect at startup.
+                   (Default: [])
+
+    With neither "flush count" nor "flush age" set, data is uploaded as soon
+    as the rate limit window opens.
+
+    Data from a failed upload is returned to the head of the queue and
+    retried after an exponentially growing, randomized delay. Throttled
+    uploads also stretch the effective rate limit, which relaxes back to the
+    configured value as uploads succeed. Changes to the backoff state are
+    published on the BACKOFF_TOPIC topic (see `_publish_backoff`).
+
+    Uploads are performed in two stages. The reporting thread formats the
+    next upload body while the previous one is in flight, and hands it to
+    one of the upload threads once the rate limit window opens. The upload
+    thread sends it once the backoff state and rate limit allow. On slow
+    links this keeps the next body ready the moment an upload completes,
+    and with more than one upload worker, several uploads may be in flight
+    at once on tiers which allow it. If an upload fails, a body still
+    waiting to be sent is withdrawn, and its data queued again behind the
+    failed batch.
+
+    Call `shutdown` before the application exits, so that queued data is
+    uploaded or spooled rather than lost.
+
+    Every queued data point is given a sequence number. Uploads are logged
+    by sequence range, and the numbers of uploaded (or dropped) points are
+    recorded in the sequence file. The spool file is kept until the data it
+    holds has been uploaded, so that after a crash it is replayed again,
+    minus any points already uploaded.
     """
 
     def __init__(self, settings_registry, settings_binding="device cloud"):
         logger.info("Initializing DeviceCloudReporter")
 
+        positive = lambda x: x > 0
+        non_negative = lambda x: x >= 0
+
         settings_list = [
             # Should serial data be base64-encoded before upload?
             Setting(name="encode serial", type=bool, required=False,
-                    default_value=False)
+                    default_value=False),
+            Setting(name="encoding", type=str, required=False,
+                    default_value="csv",
+                    verify_function=lambda x: x in ENCODERS,
+                    restart_required=True),
+            Setting(name="compress", type=bool, required=False,
+                    default_value=False, restart_required=True),
+            # Default value is for DC Free/Developer tier.  Standard tier
+            # and above can change this to one second
+            Setting(name="rate limit", type=float, required=False,
+                    default_value=5.0, verify_function=non_negative),
+            Setting(name="burst uploads", type=int, required=False,
+                    default_value=1, verify_function=positive),
+            # 249 because DC counts the header line, while we only count
+            # the DataPoints, leading to an off-by-one disagreement
+            Setting(name="max per upload", type=int, required=False,
+                    default_value=249, verify_function=positive),
+            Setting(name="max upload bytes", type=int, required=False,
+                    default_value=65536, verify_function=non_negative),
+            Setting(name="max queue size", type=int, required=False,
+                    default_value=5000, verify_function=positive),
+            Setting(name="flush count", type=int, required=False,
+                    default_value=0, verify_function=non_negative),
+            Setting(name="flush age", type=float, required=False,
+                    default_value=0.0, verify_function=non_negative),
+            # Seconds to wait upon upload failure, doubled per failure
+            Setting(name="retry time", type=float, required=False,
+                    default_value=5.0, verify_function=non_negative),
+            Setting(name="max backoff", type=float, required=False,
+                    default_value=300.0, verify_function=non_negative),
+            Setting(name="breaker threshold", type=int, required=False,
+                    default_value=5, verify_function=positive),
+            Setting(name="breaker cooldown", type=float, required=False,
+                    default_value=60.0, verify_function=non_negative),
+            Setting(name="upload workers", type=int, required=False,
+                    default_value=1, verify_function=positive,
+                    restart_required=True),
+            Setting(name="transport", type=str, required=False,
+                    default_value="idigidata",
+                    verify_function=lambda x: x in TRANSPORTS,
+                    restart_required=True),
+            Setting(name="transport options", type=dict, required=False,
+                    default_value={}, restart_required=True),
+            Setting(name="aggregation", type=list, required=False,
+                    default_value=[], verify_function=parse_rules,
+                    restart_required=True),
+            Setting(name="report by exception", type=list, required=False,
+                    default_value=[], verify_function=parse_exception_rules,
+                    restart_required=True),
+            Setting(name="lanes", type=list, required=False,
+                    default_value=[], verify_function=parse_lanes,
+                    restart_required=True),
+            Setting(name="metrics interval", type=float, required=False,
+                    default_value=0.0, verify_function=non_negative),
+            Setting(name="shutdown timeout", type=float, required=False,
+                    default_value=10.0, verify_function=non_negative),
+            Setting(name="spool file", type=str, required=False,
+                    default_value="xbgw_spool.dat"),
+            Setting(name="sequence file", type=str, required=False,
+                    default_value="xbgw_sequence.json"),
+            Setting(name="sinks", type=list, required=False,
+                    default_value=[], verify_function=verify_sinks,
+                    restart_required=True),
         ]
 
         # Necessary before calling register_settings to initialize state.
@@ -123,27 +362,108 @@ class DeviceCloudReporter(SettingsMixin):
         self.register_settings(settings_registry, settings_binding,
                                settings_list)
 
+        options = self.get_setting("transport options")
+        try:
+            self._transport = create_transport(self.get_setting("transport"),
+                                               options)
+        except ValueError, e:
+            raise BadSettings("Settings rejected: %s" % e,
+                              rejected={"transport options":
+                                        (options, str(e))})
+
+        self._encoder = get_encoder(self.get_setting("encoding"))
+        self._compress = self.get_setting("compress")
+        if self._compress and not getattr(self._transport, "supports_gzip",
+                                          False):
+            raise BadSettings("Settings rejected: transport does not accept "
+                              "compressed uploads",
+                              rejected={"compress": (True, "Not supported "
+                                                     "by transport")})
+
+        sinks = self.get_setting("sinks")
+        try:
+            self._sinks = parse_sinks(sinks)
+        except ValueError, e:
+            raise BadSettings("Settings rejected: %s" % e,
+                              rejected={"sinks": (sinks, str(e))})
+
         self._topic_registry = {}
-        self._work = deque()
+        self._work = LaneQueue(self.get_setting("lanes"),
+                               lambda: self.get_setting("max queue size"))
+        self._stream_ids = StreamIdCache(topic_to_stream)
+        self._aggregator = StreamAggregator(self.get_setting("aggregation"))
+        self._changes = ChangeFilter(self.get_setting("report by exception"))
         self._work_event = threading.Event()
         self._work_lock = threading.RLock()
-        self._last_upload = 0
+        self._limiter = RateLimiter()
 
-        self._RETRY_TIME = 5  # seconds to wait upon upload failure
-        self._RETRY_COUNT = 3  # Will attempt upload this many times
-        # Below value is for DC Free/Developer tier.  Standard tier
-        # and above can change this to one second
-        self._RATE_LIMIT = 5  # seconds between uploads to DC, per DC throttles
-        self._MAX_QUEUE_SIZE = 5000  # items
+        # Set when the reporting thread should re-evaluate whether it may
+        # upload, e.g. after an upload result arrives
+        self._wake = threading.Event()
+        self._health_lock = threading.RLock()
+        self._backoff = Backoff()
+        self._breaker = CircuitBreaker()
+        self._rate = AdaptiveRate()
+        # Notified when an upload result arrives, for upload workers
+        # waiting to send
+        self._health_changed = threading.Condition(self._health_lock)
+        # Formatted bodies for the upload workers. A body withdrawn after a
+        # failed upload stays until a worker takes and discards it.
+        self._ready = Queue.Queue()
+        # Keys (as in _in_flight) of the batches formatted but not yet
+        # sent, guarded by _health_lock
+        self._waiting = set()
 
-        # 249 because DC counts the header line, while we only count
-        # the DataPoints, leading to an off-by-one disagreement
-        self._MAX_PER_UPLOAD = 249  # datapoints per upload
+        # Metrics. The queued and oversized counts are guarded by
+        # _work_lock, the rest by _health_lock.
+        self._queued = 0
+        self._oversized = 0
+        self._counters = dict.fromkeys(
+            ("uploads", "uploaded_points", "uploaded_bytes", "failures",
+             "throttled"), 0)
+        self._histograms = {
+            "upload_latency": Histogram(LATENCY_BUCKETS),
+            "points_per_upload": Histogram(POINTS_BUCKETS),
+            "bytes_per_upload": Histogram(BYTES_BUCKETS),
+        }
+        self._next_metrics = None
+
+        # Batches taken from _work whose upload has not completed, guarded
+        # by _work_lock
+        self._in_flight = {}
+        # Set once shutdown begins, and once it has finished
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+
+        # Serializes writes of the sequence file, which are made without
+        # holding _work_lock. Time of the last write, or None.
+        self._sequence_file_lock = threading.Lock()
+        self._sequence_saved = None
+        # Highest sequence number of the spooled data being uploaded, or
+        # None once it has all been recorded. Guarded by _work_lock.
+        self._replay_until = None
+        # Sequence numbers of queued points, guarded by _work_lock
+        path = self.get_setting("sequence file")
+        if path:
+            self._sequence = SequenceTracker.load(path)
+        else:
+            self._sequence = SequenceTracker()
+        self._load_spool()
+
+        self._upload_threads = []
+        for _ in xrange(self.get_setting("upload workers")):
+            upload_thread = threading.Thread(target=self.__upload_fn)
+            upload_thread.daemon = True
+            upload_thread.start()
+            self._upload_threads.append(upload_thread)
 
         self._thread = threading.Thread(target=self.__thread_fn)
         self._thread.daemon = True
         self._thread.start()
 
+        for sink in self._sinks:
+            sink.start()
+
     def start_reporting(self, topic):
         """Subscribe to pubsub data on the given topic name
 
@@ -176,100 +496,610 @@ class DeviceCloudReporter(SettingsMixin):
             "Topic %s, ident %s, value %s with extra data %s",
             topic, ident, value, kwargs)
 
+        timestamp = int(time.time() * 1000)
+
         with self._work_lock:
-            if len(self._work) >= self._MAX_QUEUE_SIZE:
-                self._purge_work()
+            stream_id = self._stream_ids.get(topic, ident)
+            points = self._aggregator.process(stream_id, value, timestamp)
+            if points is None:
+                if self._changes.process(stream_id, value, timestamp):
+                    self._enqueue(stream_id, value, timestamp)
+            else:
+                self._report(points)
 
-            self._work.append((topic, ident, value, kwargs, time.time()))
-            self._work_event.set()
+    def _report(self, points):
+        # Caller must hold _work_lock. Queues the points which pass the
+        # report-by-exception stage.
+        for point in points:
+            if self._changes.process(*point):
+                self._enqueue(*point)
+
+    def _enqueue(self, stream_id, value, timestamp):
+        # Caller must hold _work_lock. The lane the point is assigned to
+        # applies its own capacity and drop policy.
+        dropped = self._work.append(stream_id, value, timestamp,
+                                    self._sequence.next())
+        if dropped:
+            self._sequence.settle(dropped)
+        self._queued += 1
+        self._work_event.set()
 
-    def _purge_work(self):
-        logger.error("Max queue size exceeded, purging queue")
-        self._work.clear()
+        # Encode at most once per encoding, sharing the fragment between
+        # sinks
+        fragments = None
+        for sink in self._sinks:
+            if sink.matches(stream_id):
+                if fragments is None:
+                    fragments = {}
+                fragment = fragments.get(sink.encoder)
+                if fragment is None:
+                    fragment = sink.encoder.fragment(
+                        stream_id, value, timestamp,
+                        self.get_setting("encode serial"))
+                    fragments[sink.encoder] = fragment
+                sink.append(fragment)
+
+    def _close_windows(self):
+        # Queue points for expired aggregation windows and due heartbeats,
+        # and return the number of seconds until the next window closes or
+        # heartbeat is due (or None)
+        now = time.time()
+        now_ms = int(now * 1000)
+        with self._work_lock:
+            self._report(self._aggregator.close_expired(now_ms))
+            for point in self._changes.heartbeats(now_ms):
+                self._enqueue(*point)
+            deadline = earliest(self._aggregator.next_deadline(),
+                                self._changes.next_deadline())
+
+        if deadline is None:
+            return None
+        return max(0, deadline / 1000.0 - now)
 
     def __thread_fn(self):
-        while True:
+        while not self._stopped.is_set():
+            # Clear before inspecting the queue, so that data arriving after
+            # the inspection wakes the wait below.
+            self._work_event.clear()
+            self._wake.clear()
+            window_wait = earliest(self._close_windows(),
+                                   self._report_metrics())
+
             if len(self._work) == 0:
-                self._work_event.wait()
+                self._work_event.wait(window_wait)
+                continue
+
+            if self._body_waiting():
+                # Format the next body once a worker has started sending
+                # this one
+                self._sleep(window_wait)
+                continue
 
-            # Avoid throttling
-            next_report = self._last_upload + self._RATE_LIMIT - time.time()
-            if next_report > 0:
+            # Avoid throttling, and hold off while backing off
+            next_report = self._next_report()
+            if next_report is None:
+                # Waiting on the result of a trial upload
+                self._sleep(window_wait)
+                continue
+            elif next_report > 0:
+                # Wake up in time to close aggregation windows and report
+                # metrics while backing off
                 logger.debug("Sleeping for %f", next_report)
-                time.sleep(next_report)
+                self._sleep(earliest(next_report, window_wait))
+                continue
 
-            if len(self._work) == 0:
-                logger.warning("Lost expected data while sleeping.")
+            # Rate limit window is open, check whether a flush is due
+            delay = self._flush_delay()
+            if window_wait is not None and (delay is None or
+                                            window_wait < delay):
+                # Wake up in time to close the next aggregation window
+                delay = window_wait
+
+            if delay is None:
+                self._work_event.wait()
+            elif delay > 0:
+                self._work_event.wait(delay)
             else:
                 self._publish_stream()
 
-            with self._work_lock:
-                if len(self._work) == 0:
-                    # Exhausted the work available
-                    self._work_event.clear()
+    def _sleep(self, seconds):
+        # Wait without becoming unresponsive to upload results
+        self._wake.wait(seconds)
+
+    def _body_waiting(self):
+        with self._health_lock:
+            return bool(self._waiting)
+
+    def _rate_interval(self):
+        return self._rate.interval(self.get_setting("rate limit"))
+
+    def _next_report(self):
+        # Seconds until the rate limit and backoff state permit another
+        # upload, or None while a trial upload is in progress. Uploads
+        # may only follow each other within a window while full batches
+        # are waiting.
+        settings = self.get_settings()
+        burst = 1
+        if len(self._work) >= settings["max per upload"]:
+            burst = settings["burst uploads"]
+
+        now = time.time()
+        with self._health_lock:
+            breaker_wait = self._breaker.remaining(now)
+            if breaker_wait is None:
+                return None
+            backoff_wait = self._backoff.remaining(now)
+
+        rate_wait = self._limiter.delay(
+            self._rate.interval(settings["rate limit"]), burst, now)
+        return max(rate_wait, backoff_wait, breaker_wait)
+
+    def _flush_delay(self):
+        with self._work_lock:
+            count = len(self._work)
+            if count == 0:
+                return None
+            if self._work.urgent() or self._stopping.is_set():
+                return 0
+            oldest_age = time.time() - self._work.oldest_timestamp() / 1000.0
+
+        return flush_delay(count, oldest_age,
+                           self.get_setting("max per upload"),
+                           self.get_setting("flush count"),
+                           self.get_setting("flush age"))
 
     def _publish_stream(self):
-        # Performs an upload of all data, honoring limits
-        filename = "DataPoint/upload.csv"
-        logger.info("Uploading data to %s", filename)
+        # Formats the next upload body and hands it to an upload worker,
+        # honoring limits
+        lines = []
+        with self._work_lock:
+            points = self._take_batch(lines)
+            if not points:
+                # Every point was dropped as oversized
+                return
+            self._in_flight[id(points)] = points
+        body = self._build_body(points, lines)
+        if self._compress:
+            body = gzip_body(body)
+        # The next body is formatted once a worker has started sending this
+        # one, so that it holds everything queued by the time it can be
+        # sent.
+        with self._health_lock:
+            self._waiting.add(id(points))
+        self._ready.put((body, points))
+
+    def __upload_fn(self):
+        while True:
+            body, points = self._ready.get()
+            if not self._claim_upload_slot(points):
+                # Withdrawn, its points have been queued again
+                continue
 
-        body = self._build_body()
+            filename = self._encoder.filename(self._compress)
+            logger.info("Uploading sequences %s to %s",
+                        format_ranges(point[3] for point in points),
+                        filename)
+            started = time.time()
+            success, errmsg = self._upload(body, filename)
+            self._record_upload(len(points), len(body),
+                                time.time() - started)
+            self._upload_done(points, success, errmsg)
 
-        self._upload(body, filename)
-        self._last_upload = time.time()
+    def _claim_upload_slot(self, points):
+        # Blocks until the breaker, backoff and rate limit allow the upload
+        # of the batch 'points', and records it. Returns False if the batch
+        # was withdrawn in the meantime, after an upload failed.
+        key = id(points)
+        with self._health_lock:
+            while True:
+                if key not in self._waiting:
+                    return False
+                now = time.time()
+                wait = self._breaker.remaining(now)
+                if wait == 0:
+                    wait = self._backoff.remaining(now)
+                if wait == 0:
+                    burst = self.get_setting("burst uploads")
+                    wait = self._limiter.reserve(self._rate_interval(), burst,
+                                                 limit=burst, now=now)
+                if wait == 0:
+                    self._waiting.remove(key)
+                    self._breaker.dispatched()
+                    break
+                logger.debug("Upload waiting %s before sending", wait)
+                # Without a timeout while a trial upload is in progress
+                self._health_changed.wait(wait)
 
-    def _build_body(self):
-        lines = ['#TIMESTAMP,DATA,DATATYPE,STREAMID']
-        count = 0
+        # Let the reporting thread format the next body
+        self._wake.set()
+        return True
 
-        # pylint: disable=maybe-no-member
-        while len(self._work) != 0 and count < self._MAX_PER_UPLOAD:
-            # deque append and popleft are thread safe
-            topic, ident, value, kwargs, timestamp = self._work.popleft()
-            stream_id = "{}/{}".format(topic, id_to_stream(ident))
-            logger.debug("stream_id: %s", stream_id)
+    def _take_batch(self, lines=None):
+        # Take the next batch of points, limited by count and by the size
+        # of the (uncompressed) upload body. Each point is encoded once,
+        # and its fragment is appended to 'lines' if given, for
+        # _build_body.
+        max_per_upload = self.get_setting("max per upload")
+        budget = self.get_setting("max upload bytes")
+        encode_serial = self.get_setting("encode serial")
+        encoder = self._encoder
+        separator = len(encoder.separator)
+        if lines is None:
+            lines = []
 
-            logger.debug("data: %s", (stream_id, value, kwargs))
+        points = []
+        # Counts one separator too many, which the first fragment omits
+        size = encoder.overhead() - separator
+        with self._work_lock:
+            while len(self._work) and len(points) < max_per_upload:
+                point = self._work.popleft()
+                line = encoder.fragment(point[0], point[1], point[2],
+                                        encode_serial)
+                if budget and size + separator + len(line) > budget:
+                    if points:
+                        # Leave it for the next batch
+                        self._work.requeue([point])
+                        break
+                    logger.error("Dropping %d byte data point on %s, larger "
+                                 "than max upload bytes", len(line), point[0])
+                    self._oversized += 1
+                    self._sequence.settle([point[3]])
+                    continue
 
-            datatype = get_type(value)
-            if type(value) == bool:  # Bools are special, report them as ints
-                value = int(value)
-            elif type(value) == str:
-                if self.get_setting("encode serial"):
-                    value = base64.b64encode(value)
+                size += separator + len(line)
+                points.append(point)
+                lines.append(line)
 
-            lines.append("{},{},{},{}".format(
-                int(timestamp * 1000),
-                value,
-                datatype,
-                stream_id))
+        return points
 
-            count = count + 1
+    def _build_body(self, points, lines=None):
+        # 'lines' holds the points already encoded by _take_batch
+        encoder = self._encoder
+        if lines is None:
+            encode_serial = self.get_setting("encode serial")
+            lines = [encoder.fragment(stream_id, value, timestamp,
+                                      encode_serial)
+                     for stream_id, value, timestamp, _ in points]
 
-        logger.info("Upload contains %d datapoints", count)
-        upload_body = '\n'.join(lines)
-        return upload_body
+        logger.info("Upload contains %d datapoints", len(points))
+        return encoder.join(lines, [point[0] for point in points])
 
     def _upload(self, body, filename):
-        loop_count = 0
-        while True:
-            success, _, errmsg = idigidata.send_to_idigi(body, filename)
+        success, errmsg = self._transport.send(body, filename)
 
+        if success:
+            # transmitted successfully
+            logger.info("Upload successful")
+        elif errmsg.startswith(THROTTLED):
+            logger.error("Device Cloud throttling, will retry")
+        else:
+            logger.warning("Unexpected upload error, will retry: %s", errmsg)
+
+        return success, errmsg
+
+    def _upload_done(self, points, success, errmsg):
+        # Update the backoff state from an upload result. Data from failed
+        # uploads is returned to the queue to be retried, once the backoff
+        # state has been updated.
+        rate_limit = self.get_setting("rate limit")
+        max_backoff = self.get_setting("max backoff")
+        with self._health_lock:
+            was_backing_off = self._backoff.failures > 0
+            if success:
+                self._backoff.success()
+                self._rate.succeeded()
+                recovered = self._breaker.success()
+                changed = was_backing_off or recovered
+            else:
+                self._counters["failures"] += 1
+                if errmsg.startswith(THROTTLED):
+                    self._counters["throttled"] += 1
+                    self._breaker.throttled()
+                    if rate_limit > 0:
+                        self._rate.throttled(max(1.0, max_backoff /
+                                                 rate_limit))
+                else:
+                    if self._breaker.failure(
+                            self.get_setting("breaker threshold"),
+                            self.get_setting("breaker cooldown")):
+                        logger.error("Uploads failing, pausing uploads")
+                self._backoff.failure(self.get_setting("retry time"),
+                                      max_backoff)
+                changed = True
+
+            withdrawn = ()
+            if not success:
+                # A body waiting to be sent holds newer data, which must
+                # not go ahead of the failed batch
+                withdrawn, self._waiting = self._waiting, set()
+            self._health_changed.notify_all()
+            state = self.backoff_state()
+
+        with self._work_lock:
+            self._in_flight.pop(id(points), None)
             if success:
-                # transmitted successfully
-                logger.info("Upload successful")
-                break
-
-            if errmsg.startswith("Request throttled."):
-                logger.error("Device Cloud throttling, waiting")
-                # Wait to try again
-                time.sleep(self._RETRY_TIME)
+                self._sequence.settle(point[3] for point in points)
             else:
-                logger.warning("Unexpected Device Cloud error, data lost: %s",
-                               errmsg)
-                break
-
-            if loop_count >= self._RETRY_COUNT:
-                logger.error("Exceeded retries, data lost")
-                break
-            loop_count = loop_count + 1
+                for key in withdrawn:
+                    waiting = self._in_flight.pop(key, None)
+                    if waiting is not None:
+                        self._work.requeue(waiting)
+                self._work.requeue(points)
+                self._work_event.set()
+        if success:
+            self._save_sequence(force=False)
+
+        self._wake.set()
+        if changed:
+            self._publish_backoff(state)
+
+    def _record_upload(self, points, size, latency):
+        with self._health_lock:
+            self._counters["uploads"] += 1
+            self._counters["uploaded_points"] += points
+            self._counters["uploaded_bytes"] += size
+            self._histograms["upload_latency"].observe(latency)
+            self._histograms["points_per_upload"].observe(points)
+            self._histograms["bytes_per_upload"].observe(size)
+
+    def stats(self):
+        """Return a dictionary of the reporter's metrics
+
+        The dictionary holds the following keys:
+
+            * queue_depth: number of data points waiting for upload
+            * oldest_age: age in seconds of the oldest queued data point
+            * queued: data points queued since startup
+            * dropped: data points dropped because their lane was full
+            * suppressed: values not reported because they had not changed
+            * oversized: data points dropped for exceeding max upload bytes
+            * purges: number of times a lane was purged when full
+            * uploads: uploads attempted
+            * uploaded_points, uploaded_bytes: totals over all uploads
+            * failures: failed uploads, including throttled ones
+            * throttled: uploads refused due to throttling
+            * backoff_failures: current number of consecutive failures
+            * rate_limit: effective seconds between uploads
+            * sequence_high_water: sequence number up to which every data
+                                   point has been uploaded or dropped
+            * upload_latency: Histogram of upload durations in seconds
+            * points_per_upload, bytes_per_upload: Histograms of upload
+                                                   sizes
+        """
+        with self._work_lock:
+            stats = {
+                "queue_depth": len(self._work),
+                "queued": self._queued,
+                "dropped": sum(lane.dropped for lane in self._work.lanes),
+                "purges": sum(lane.purges for lane in self._work.lanes),
+                "sequence_high_water": self._sequence.high_water,
+                "suppressed": self._changes.suppressed,
+                "oversized": self._oversized,
+            }
+            oldest = self._work.oldest_timestamp()
+
+        if oldest is None:
+            stats["oldest_age"] = 0.0
+        else:
+            stats["oldest_age"] = max(0.0, time.time() - oldest / 1000.0)
+
+        with self._health_lock:
+            stats.update(self._counters)
+            for name, histogram in self._histograms.iteritems():
+                stats[name] = histogram.snapshot()
+            stats["backoff_failures"] = self._backoff.failures
+            stats["rate_limit"] = self._rate_interval()
+
+        return stats
+
+    def _report_metrics(self):
+        # Queue the reporter's metrics as data points when due, and return
+        # the number of seconds until the next report (or None if disabled)
+        interval = self.get_setting("metrics interval")
+        if not interval:
+            self._next_metrics = None
+            return None
+
+        now = time.time()
+        if self._next_metrics is None:
+            self._next_metrics = now + interval
+        elif now >= self._next_metrics:
+            self._next_metrics = now + interval
+            timestamp = int(now * 1000)
+            with self._work_lock:
+                for name, value in sorted(self.stats().iteritems()):
+                    if isinstance(value, Histogram):
+                        name, value = name + "/mean", value.mean()
+                    self._enqueue("{}/{}".format(METRICS_STREAM, name),
+                                  value, timestamp)
+
+        return max(0, self._next_metrics - now)
+
+    def shutdown(self, timeout=None):
+        """Stop reporting, uploading or spooling all queued data
+
+        Unsubscribes from every topic and closes open aggregation windows.
+        Queued data is then uploaded, without waiting for flush triggers,
+        for up to 'timeout' seconds (Default: the "shutdown timeout"
+        setting). Anything still queued or in flight after that is written
+        to the spool file, to be queued again on the next start. Data which
+        was in flight is spooled too, and skipped on the next start if its
+        upload completed.
+
+        Sinks are given until the same deadline to send their queued data;
+        whatever they hold after that is discarded.
+        """
+        if timeout is None:
+            timeout = self.get_setting("shutdown timeout")
+        deadline = time.time() + timeout
+        logger.info("Shutting down, draining for up to %f seconds", timeout)
+
+        self._topic_registry.clear()
+        with self._work_lock:
+            self._report(self._aggregator.close_all())
+            self._stopping.set()
+            self._work_event.set()
+        self._wake.set()
+
+        while time.time() < deadline and not self._drained():
+            time.sleep(0.1)
+
+        with self._work_lock:
+            self._stopped.set()
+            leftover = []
+            for points in self._in_flight.itervalues():
+                leftover.extend(points)
+            self._in_flight.clear()
+            while len(self._work):
+                leftover.append(self._work.popleft())
+        # Bodies not sent yet are spooled instead
+        with self._health_lock:
+            self._waiting.clear()
+            self._health_changed.notify_all()
+        # Release the reporting thread if it is waiting
+        self._work_event.set()
+        self._wake.set()
+
+        self._spill(leftover)
+
+        # Sinks have been sending alongside, give them what time is left
+        for sink in self._sinks:
+            unsent = sink.drain(deadline)
+            if unsent:
+                logger.warning("Sink %s discarding %d data points",
+                               sink.name, unsent)
+
+    def _drained(self):
+        with self._work_lock:
+            return len(self._work) == 0 and not self._in_flight
+
+    def _spill(self, points):
+        # Replace the spool file with the given points, or remove it if
+        # there are none
+        path = self.get_setting("spool file")
+        spooled = False
+        if not path:
+            if points:
+                logger.error("No spool file, discarding %d data points",
+                             len(points))
+        elif not points:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError, e:
+                logger.error("Could not remove spool file %s: %s", path, e)
+        else:
+            logger.warning("Spooling %d data points", len(points))
+            temp_path = path + ".tmp"
+            try:
+                with open(temp_path, "wb") as spool:
+                    cPickle.dump(points, spool, cPickle.HIGHEST_PROTOCOL)
+                os.rename(temp_path, path)
+                spooled = True
+            except (IOError, OSError), e:
+                logger.error("Could not write spool file %s: %s", path, e)
+
+        if points and not spooled:
+            # Lost for good, so they must not hold up the sequence
+            with self._work_lock:
+                self._sequence.settle(point[3] for point in points)
+        self._save_sequence()
+
+    def _load_spool(self):
+        # Queue data spooled at the last shutdown, ahead of any new data,
+        # skipping points already uploaded. The file is left in place until
+        # the next shutdown replaces it, so that it is replayed again after
+        # a crash.
+        path = self.get_setting("spool file")
+        spooled = self._read_spool(path) if path else []
+
+        points = []
+        with self._work_lock:
+            for point in spooled:
+                if len(point) == 3:
+                    # Spooled before sequence numbers were kept
+                    point = tuple(point) + (self._sequence.next(),)
+                elif self._sequence.is_settled(point[3]):
+                    continue
+                self._sequence.reserve(point[3])
+                points.append(point)
+
+            # Points queued before a crash and not spooled are lost; settle
+            # them so that the high-water mark can advance
+            self._sequence.settle_except(point[3] for point in points)
+
+            if points:
+                logger.info("Queueing %d spooled data points", len(points))
+                self._work.requeue(points)
+                self._work_event.set()
+                self._replay_until = max(point[3] for point in points)
+
+    def _save_sequence(self, force=True):
+        # Writes the sequence file. Unless 'force' is set, it is only
+        # written while spooled data is being uploaded, since only the
+        # replay of the spool file after a crash reads it, and at most
+        # every SEQUENCE_SAVE_INTERVAL. Caller must not hold _work_lock, so
+        # that the file is not written while data is queued.
+        path = self.get_setting("sequence file")
+        if not path:
+            return
+
+        with self._sequence_file_lock:
+            now = time.time()
+            with self._work_lock:
+                if not force:
+                    if self._replay_until is None:
+                        return
+                    if (self._sequence_saved is not None and
+                            now - self._sequence_saved <
+                            SEQUENCE_SAVE_INTERVAL):
+                        return
+                state = self._sequence.state()
+                if (self._replay_until is not None and
+                        self._sequence.high_water >= self._replay_until):
+                    # The spooled data has been uploaded
+                    self._replay_until = None
+            self._sequence_saved = now
+            save_state(state, path)
+
+    def _read_spool(self, path):
+        try:
+            with open(path, "rb") as spool:
+                return list(cPickle.load(spool))
+        except IOError:
+            # No spool file
+            return []
+        except Exception, e:
+            logger.error("Discarding unreadable spool file %s: %s", path, e)
+            return []
+
+    def backoff_state(self):
+        """Return a dictionary describing the current backoff state
+
+        The dictionary holds the following keys:
+
+            * state: "closed" when uploading normally, "open" while uploads
+                     are paused after repeated failures, "half-open" while a
+                     trial upload is allowed
+            * failures: number of consecutive failed uploads
+            * delay: seconds until the next upload attempt is allowed
+            * rate_limit: effective seconds between uploads, which grows
+                          while uploads are being throttled
+        """
+        with self._health_lock:
+            delay = self._backoff.remaining()
+            breaker_wait = self._breaker.remaining()
+            if breaker_wait:
+                delay = max(delay, breaker_wait)
+
+            return {
+                "state": self._breaker.state,
+                "failures": self._backoff.failures,
+                "delay": delay,
+                "rate_limit": self._rate_interval(),
+            }
+
+    def _publish_backoff(self, state):
+        # MDS: state, failures, delay, rate_limit (see backoff_state)
+        logger.info("Backoff state: %s", state)
+        pubsub.pub.sendMessage(BACKOFF_TOPIC, **state)
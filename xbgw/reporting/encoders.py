@@ -0,0 +1,192 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define upload body encodings for reporting managers
+
+An encoder turns each data point into a "fragment" of text, and joins a
+batch of fragments into an upload body. Encoding point by point lets
+reporters track the size of a batch as it is filled, and lets a point be
+encoded once and shared by every destination using the same encoding.
+
+The following encoders are available by name through `get_encoder`:
+
+    * "csv": Device Cloud CSV, one line per data point. String values
+             containing commas, quotes or line breaks are quoted.
+    * "xml": Device Cloud XML DataPoint list
+    * "json": Device Cloud JSON DataPoint list
+
+The XML and JSON encoders group the points of a batch by stream, which
+helps compression. Any body may additionally be compressed with `gzip_body`
+for transports which accept compressed bodies (see the "supports_gzip"
+attribute of transports). To compare encodings on representative data, run
+tools/encoder_benchmark.py.
+"""
+
+import base64
+import json
+import zlib
+from xml.sax.saxutils import escape
+
+
+def data_type(value):
+    """Return Device Cloud data point type for the given Python object"""
+    t = type(value)
+    if t == int or t == bool:
+        return "INTEGER"
+    elif t == str:
+        return "STRING"
+    elif t == float:
+        return "DOUBLE"
+
+    return "UNKNOWN"
+
+
+def prepare_value(value, encode_serial=False):
+    """Return (value, datatype) as uploaded to Device Cloud"""
+    datatype = data_type(value)
+    if type(value) == bool:  # Bools are special, report them as ints
+        value = int(value)
+    elif type(value) == str:
+        if encode_serial:
+            value = base64.b64encode(value)
+    return value, datatype
+
+
+def group_by_stream(fragments, streams):
+    """
+    Reorder fragments so that those of each stream are adjacent, keeping
+    the order of streams by first appearance and of points within each
+    stream.
+    """
+    index = {}
+    groups = []
+    for stream_id, fragment in zip(streams, fragments):
+        position = index.get(stream_id)
+        if position is None:
+            index[stream_id] = len(groups)
+            groups.append([fragment])
+        else:
+            groups[position].append(fragment)
+    return [fragment for group in groups for fragment in group]
+
+
+class Encoder(object):
+    """Base class of encoders
+
+    A body consists of 'prefix', the fragments joined by 'separator', and
+    'suffix'. Subclasses implement `fragment`.
+    """
+
+    name = None
+    extension = None
+    prefix = ""
+    separator = ""
+    suffix = ""
+    grouped = False
+
+    def fragment(self, stream_id, value, timestamp, encode_serial=False):
+        raise NotImplementedError
+
+    def join(self, fragments, streams=None, framed=True):
+        """
+        Join fragments into a body.
+
+        With 'streams' given (the stream id of each fragment), grouping
+        encoders reorder the fragments by stream. With 'framed' false, line
+        oriented encoders leave out their header, for appending to logs
+        and streams.
+        """
+        if streams is not None and self.grouped:
+            fragments = group_by_stream(fragments, streams)
+        return (self.body_prefix(framed) + self.separator.join(fragments) +
+                self.suffix)
+
+    def body_prefix(self, framed=True):
+        return self.prefix
+
+    def overhead(self, framed=True):
+        """Return the size of an empty body"""
+        return len(self.body_prefix(framed)) + len(self.suffix)
+
+    def filename(self, compressed=False):
+        name = "DataPoint/upload." + self.extension
+        if compressed:
+            name += ".gz"
+        return name
+
+
+class CsvEncoder(Encoder):
+    name = "csv"
+    extension = "csv"
+    prefix = "#TIMESTAMP,DATA,DATATYPE,STREAMID\n"
+    separator = "\n"
+
+    def fragment(self, stream_id, value, timestamp, encode_serial=False):
+        value, datatype = prepare_value(value, encode_serial)
+        value = str(value)
+        if (',' in value or '"' in value or '\n' in value or
+                '\r' in value):
+            value = '"%s"' % value.replace('"', '""')
+        return "%d,%s,%s,%s" % (timestamp, value, datatype, stream_id)
+
+    def body_prefix(self, framed=True):
+        if framed:
+            return self.prefix
+        return ""
+
+
+class XmlEncoder(Encoder):
+    name = "xml"
+    extension = "xml"
+    prefix = "<list>"
+    suffix = "</list>"
+    grouped = True
+
+    def fragment(self, stream_id, value, timestamp, encode_serial=False):
+        value, datatype = prepare_value(value, encode_serial)
+        return ("<DataPoint><streamId>%s</streamId><data>%s</data>"
+                "<streamType>%s</streamType><timestamp>%d</timestamp>"
+                "</DataPoint>" % (escape(stream_id), escape(str(value)),
+                                  datatype, timestamp))
+
+
+class JsonEncoder(Encoder):
+    name = "json"
+    extension = "json"
+    prefix = "["
+    separator = ","
+    suffix = "]"
+    grouped = True
+
+    def fragment(self, stream_id, value, timestamp, encode_serial=False):
+        value, datatype = prepare_value(value, encode_serial)
+        if datatype == "UNKNOWN":
+            value = str(value)
+        return json.dumps({"streamId": stream_id, "data": value,
+                           "streamType": datatype, "timestamp": timestamp},
+                          sort_keys=True, separators=(',', ':'))
+
+
+ENCODERS = {
+    "csv": CsvEncoder(),
+    "xml": XmlEncoder(),
+    "json": JsonEncoder(),
+}
+
+
+def get_encoder(name):
+    """Return the encoder of the given name, or raise ValueError"""
+    try:
+        return ENCODERS[name]
+    except KeyError:
+        raise ValueError("Unknown encoding '%s'" % name)
+
+
+def gzip_body(body, level=6):
+    """Compress a body into gzip format"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
@@ -0,0 +1,306 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Keep recent history of numeric data streams on the gateway
+
+The StreamHistory component subscribes to data topics (with the same MDS
+as the Device Cloud reporter) and keeps the latest samples of every
+numeric stream in a fixed-size ring of timestamp and value columns. The
+history can be read back with the "stream_history" RCI command, without a
+round trip through Device Cloud:
+
+    <do_command target="xbgw">
+        <stream_history stream="xbee.analog/[00:13:a2:00:40:a1:b2:c3]!/AD1"
+                        last="600" interval="60" limit="10"/>
+    </do_command>
+
+The command accepts the following attributes, all optional:
+
+    * "stream": Stream id to read. Without it, the response lists the
+                known streams and their number of samples.
+    * "start", "end": Only return samples with timestamps (milliseconds
+                      since the epoch) in this range
+    * "last": Only return samples from this many seconds before now
+    * "interval": Downsample into buckets of this many seconds. Each bucket
+                  is returned as one sample holding the mean, with the
+                  count, minimum and maximum as attributes.
+    * "limit": Return at most this many (of the most recent) samples
+
+and responds with, for example,
+
+    <response stream="xbee.analog/[00:13:a2:00:40:a1:b2:c3]!/AD1">
+        <sample t="1400000000000">512</sample>
+        ...
+    </response>
+
+Only numeric (including boolean) values are kept; serial data is skipped.
+"""
+
+import logging
+import math
+import threading
+import time
+from array import array
+from xml.etree.ElementTree import Element, SubElement
+
+import pubsub.pub
+
+from xbgw.command.rci import ErrorResponse
+from xbgw.command.registry import register_command
+from xbgw.reporting.device_cloud import topic_to_stream, wrap
+from xbgw.reporting.records import StreamIdCache
+from xbgw.settings import Setting, SettingsMixin
+
+logger = logging.getLogger(__name__)
+
+errors = {
+    'history.bad_argument': "Invalid stream_history argument",
+    'history.unknown_stream': "No history for stream",
+}
+
+
+class StreamRing(object):
+    """Fixed-capacity ring of (timestamp, value) samples of one stream
+
+    Timestamps (milliseconds) and values are packed into arrays of
+    doubles, which grow as samples arrive until 'capacity' is reached.
+    After that each new sample replaces the oldest. StreamRing is not
+    thread safe.
+    """
+
+    __slots__ = ('capacity', 'integer', '_times', '_values', '_head')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # True while every sample has been an integer, so that values can
+        # be returned as they were reported
+        self.integer = True
+        self._times = array('d')
+        self._values = array('d')
+        # Index of the oldest sample once the ring is full
+        self._head = 0
+
+    def __len__(self):
+        return len(self._times)
+
+    def append(self, timestamp, value):
+        if type(value) not in (int, long, bool):
+            self.integer = False
+
+        if len(self._times) < self.capacity:
+            self._times.append(timestamp)
+            self._values.append(value)
+        else:
+            head = self._head
+            self._times[head] = timestamp
+            self._values[head] = value
+            self._head = (head + 1) % self.capacity
+
+    def samples(self, start=None, end=None):
+        """Return [(timestamp, value)] in time order, oldest first"""
+        head = self._head
+        times = self._times[head:] + self._times[:head]
+        values = self._values[head:] + self._values[:head]
+        return [(t, v) for t, v in zip(times, values)
+                if (start is None or t >= start) and
+                (end is None or t <= end)]
+
+
+def downsample(samples, interval):
+    """
+    Reduce (timestamp, value) samples into one per 'interval' milliseconds.
+
+    Returns [(bucket start, mean, count, minimum, maximum)], oldest first.
+    """
+    buckets = []
+    for t, value in samples:
+        bucket = t - t % interval
+        if buckets and buckets[-1][0] == bucket:
+            entry = buckets[-1]
+            entry[1] += value
+            entry[2] += 1
+            entry[3] = min(entry[3], value)
+            entry[4] = max(entry[4], value)
+        else:
+            buckets.append([bucket, value, 1, value, value])
+    return [(bucket, total / count, count, low, high)
+            for bucket, total, count, low, high in buckets]
+
+
+class StreamHistory(SettingsMixin):
+    """Records recent samples of data streams and answers RCI queries
+
+    Settings:
+
+        * "points per stream": Number of samples kept per stream
+                               (Default: 600)
+        * "max streams": Number of streams to keep history for. Samples on
+                         further streams are ignored. (Default: 256)
+
+    Subscribe to data topics with `start_recording`. See the module
+    docstring for the "stream_history" RCI command.
+    """
+
+    HISTORY_COMMAND = "stream_history"
+
+    def __init__(self, settings_registry, settings_binding="history"):
+        settings_list = [
+            Setting(name="points per stream", type=int, required=False,
+                    default_value=600, verify_function=lambda x: x > 0),
+            Setting(name="max streams", type=int, required=False,
+                    default_value=256, verify_function=lambda x: x > 0),
+        ]
+        SettingsMixin.__init__(self)
+        self.register_settings(settings_registry, settings_binding,
+                               settings_list)
+
+        self._topic_registry = {}
+        self._stream_ids = StreamIdCache(topic_to_stream)
+        # stream id -> StreamRing, guarded by _lock
+        self._rings = {}
+        self._lock = threading.Lock()
+        # Samples not recorded, being non-numeric or over "max streams"
+        self.skipped = 0
+
+        register_command(self.HISTORY_COMMAND, self.history_listener)
+
+    def start_recording(self, topic):
+        """Subscribe to pubsub data on the given topic name"""
+        listener = wrap(self.__my_listener)
+        self._topic_registry[topic] = listener
+        pubsub.pub.subscribe(listener, topic)
+
+    def stop_recording(self, topic):
+        """Unsubscribe from pubsub data on the given topic name
+
+        Will raise KeyError if the topic has not been subscribed to.
+        """
+        del self._topic_registry[topic]
+
+    def __my_listener(self, topic=pubsub.pub.AUTO_TOPIC, ident=None,
+                      value=None, **kwargs):
+        topic = topic.getName()  # pylint: disable=maybe-no-member
+        stream_id = self._stream_ids.get(topic, ident)
+        self.record(stream_id, value, int(time.time() * 1000))
+
+    def record(self, stream_id, value, timestamp):
+        """Add a sample (timestamp in milliseconds) to a stream's history"""
+        if type(value) not in (int, long, float, bool):
+            self.skipped += 1
+            return
+
+        with self._lock:
+            ring = self._rings.get(stream_id)
+            if ring is None:
+                if len(self._rings) >= self.get_setting("max streams"):
+                    self.skipped += 1
+                    return
+                ring = StreamRing(self.get_setting("points per stream"))
+                self._rings[stream_id] = ring
+            ring.append(timestamp, value)
+
+    def streams(self):
+        """Return {stream id: number of samples}"""
+        with self._lock:
+            return dict((stream_id, len(ring))
+                        for stream_id, ring in self._rings.iteritems())
+
+    def query(self, stream_id, start=None, end=None, interval=None,
+              limit=None):
+        """
+        Return the samples of a stream, oldest first.
+
+        Times are in milliseconds. Without 'interval', samples are
+        (timestamp, value) pairs; with it, they are tuples as returned by
+        `downsample`. With 'limit', only the most recent samples are
+        returned. Raises KeyError for streams without history.
+        """
+        with self._lock:
+            ring = self._rings[stream_id]
+            samples = ring.samples(start, end)
+            integer = ring.integer
+
+        if interval:
+            samples = downsample(samples, interval)
+        elif integer:
+            samples = [(t, int(value)) for t, value in samples]
+        if limit is not None:
+            samples = samples[-limit:] if limit else []
+        return samples
+
+    def history_listener(self, element, response):
+        try:
+            args = parse_query(element.attrib, time.time())
+        except ValueError, e:
+            response.put(ErrorResponse("history.bad_argument", errors,
+                                       hint=str(e)))
+            return
+
+        stream_id = args.pop("stream_id")
+        if stream_id is None:
+            root = Element("response")
+            for name, count in sorted(self.streams().iteritems()):
+                SubElement(root, "stream", id=name, samples=str(count))
+            response.put(root)
+            return
+
+        try:
+            samples = self.query(stream_id, **args)
+        except KeyError:
+            response.put(ErrorResponse("history.unknown_stream", errors,
+                                       hint=stream_id))
+            return
+
+        root = Element("response", stream=stream_id)
+        for sample in samples:
+            elem = SubElement(root, "sample", t="%d" % sample[0])
+            elem.text = str(sample[1])
+            if len(sample) > 2:
+                elem.set("n", str(sample[2]))
+                elem.set("min", str(sample[3]))
+                elem.set("max", str(sample[4]))
+        response.put(root)
+
+
+def parse_query(attrib, now):
+    """
+    Convert "stream_history" attributes into `StreamHistory.query`
+    arguments, plus "stream_id". 'now' is the current time in seconds.
+
+    Raises ValueError for invalid attributes.
+    """
+    def number(name):
+        value = attrib.get(name)
+        if value is None:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError("%s must be a number" % name)
+        if math.isinf(value) or math.isnan(value):
+            raise ValueError("%s must be finite" % name)
+        if value < 0:
+            raise ValueError("%s must not be negative" % name)
+        return value
+
+    start = number("start")
+    end = number("end")
+    last = number("last")
+    interval = number("interval")
+    limit = number("limit")
+
+    if last is not None:
+        since = (now - last) * 1000
+        start = since if start is None else max(start, since)
+
+    return {
+        "stream_id": attrib.get("stream"),
+        "start": start,
+        "end": end,
+        "interval": interval * 1000 if interval else None,
+        "limit": int(limit) if limit is not None else None,
+    }
@@ -0,0 +1,240 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Sequence-numbered journal of recent data events
+
+The ChangeJournal component subscribes to data topics and gives every
+event a sequence number, counting up from 1, keeping the most recent
+events in a bounded journal. Clients poll for the events after the last
+one they have seen with the "changes" RCI command, rather than fetching
+full state or waiting for uploads to Device Cloud:
+
+    <do_command target="xbgw">
+        <changes since="1200" limit="100"/>
+    </do_command>
+
+The command accepts the following attributes, all optional:
+
+    * "since": Return events with sequence numbers after this one. Without
+               it, every event in the journal is returned.
+    * "limit": Return at most this many events, and never more than the
+               "max results" setting
+
+and responds with, for example,
+
+    <response first="1201" last="1202" next="1202">
+        <e s="1201" id="xbee.analog/[00:13:a2:00:40:a1:b2:c3]!/AD1"
+           t="1400000000000">512</e>
+        <e s="1202" id="xbee.serialIn/[00:13:a2:00:40:a1:b2:c3]!"
+           t="1400000000000" enc="base64">aGk=</e>
+    </response>
+
+"first" and "last" are the oldest and newest sequence numbers in the
+journal, and "next" the value of "since" to use for the next poll. "t" is
+the time the event was received, in milliseconds since the epoch, and
+string values are base64-encoded.
+
+If events after "since" have already been dropped from the journal, or
+"since" is beyond the newest event because the journal has restarted (with
+the application), the response has the attribute gap="true" and starts
+from the oldest event still kept. The client must then fetch the current
+state some other way, for example with the "last_values" command.
+"""
+
+import base64
+import logging
+import threading
+import time
+from xml.etree.ElementTree import Element, SubElement
+
+import pubsub.pub
+
+from xbgw.command.rci import ErrorResponse
+from xbgw.command.registry import register_command
+from xbgw.reporting.device_cloud import topic_to_stream, wrap
+from xbgw.reporting.records import StreamIdCache
+from xbgw.settings import Setting, SettingsMixin
+
+logger = logging.getLogger(__name__)
+
+errors = {
+    'changes.bad_argument': "Invalid changes argument",
+}
+
+
+class ChangeJournal(SettingsMixin):
+    """Numbers data events and answers "changes since" queries
+
+    Settings:
+
+        * "max events": Number of events kept in the journal
+                        (Default: 1024)
+        * "max results": Largest number of events returned by one query
+                         (Default: 256)
+
+    Subscribe to data topics with `start_recording`. See the module
+    docstring for the "changes" RCI command.
+    """
+
+    CHANGES_COMMAND = "changes"
+
+    def __init__(self, settings_registry, settings_binding="journal"):
+        settings_list = [
+            Setting(name="max events", type=int, required=False,
+                    default_value=1024, verify_function=lambda x: x > 0),
+            Setting(name="max results", type=int, required=False,
+                    default_value=256, verify_function=lambda x: x > 0),
+        ]
+        SettingsMixin.__init__(self)
+        self.register_settings(settings_registry, settings_binding,
+                               settings_list)
+
+        self._topic_registry = {}
+        self._stream_ids = StreamIdCache(topic_to_stream)
+        # Ring of (sequence, stream id, value, timestamp), guarded by
+        # _lock. Grows up to "max events", after which each event replaces
+        # the oldest, at index _head. If "max events" shrinks, the ring
+        # keeps its size.
+        self._events = []
+        self._head = 0
+        # Sequence number of the newest event
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+        register_command(self.CHANGES_COMMAND, self.changes_listener)
+
+    def start_recording(self, topic):
+        """Subscribe to pubsub data on the given topic name"""
+        listener = wrap(self.__my_listener)
+        self._topic_registry[topic] = listener
+        pubsub.pub.subscribe(listener, topic)
+
+    def stop_recording(self, topic):
+        """Unsubscribe from pubsub data on the given topic name
+
+        Will raise KeyError if the topic has not been subscribed to.
+        """
+        del self._topic_registry[topic]
+
+    def __my_listener(self, topic=pubsub.pub.AUTO_TOPIC, ident=None,
+                      value=None, **kwargs):
+        topic = topic.getName()  # pylint: disable=maybe-no-member
+        stream_id = self._stream_ids.get(topic, ident)
+        self.record(stream_id, value, int(time.time() * 1000))
+
+    def record(self, stream_id, value, timestamp):
+        """
+        Add an event (timestamp in milliseconds) to the journal and return
+        its sequence number.
+        """
+        with self._lock:
+            self._sequence += 1
+            event = (self._sequence, stream_id, value, timestamp)
+            if len(self._events) < self.get_setting("max events"):
+                if self._head:
+                    # "max events" grew after the ring wrapped. Unroll it,
+                    # so that appending keeps the events in order.
+                    self._events = (self._events[self._head:] +
+                                    self._events[:self._head])
+                    self._head = 0
+                self._events.append(event)
+            else:
+                self._events[self._head] = event
+                self._head = (self._head + 1) % len(self._events)
+            return self._sequence
+
+    def _bounds(self):
+        # Caller must hold _lock. Before the first event, "first" is the
+        # sequence number the next event will get.
+        if not self._events:
+            return self._sequence + 1, self._sequence
+        return self._events[self._head][0], self._sequence
+
+    def changes(self, since=None, limit=None):
+        """
+        Return (gap, first, last, [(sequence, stream id, value, timestamp)])
+        for the events after 'since', oldest first. 'first' and 'last' are
+        the sequence numbers of the oldest and newest events in the journal.
+
+        'gap' is True if events after 'since' are no longer in the journal,
+        or 'since' is newer than any event; the events returned then start
+        from the oldest kept. At most 'limit' events, and no more than the
+        "max results" setting, are returned.
+        """
+        max_results = self.get_setting("max results")
+        if limit is None or limit > max_results:
+            limit = max_results
+
+        with self._lock:
+            first, last = self._bounds()
+            gap = False
+            if since is None:
+                since = first - 1
+            elif since > last or since < first - 1:
+                gap = True
+                since = first - 1
+
+            # Sequence numbers are contiguous, so the first event wanted is
+            # found by its offset from the oldest
+            count = min(last - since, limit)
+            start = self._head + (since + 1 - first)
+            size = len(self._events)
+            events = [self._events[(start + i) % size]
+                      for i in xrange(count)]
+        return gap, first, last, events
+
+    def changes_listener(self, element, response):
+        try:
+            args = parse_query(element.attrib)
+        except ValueError, e:
+            response.put(ErrorResponse("changes.bad_argument", errors,
+                                       hint=str(e)))
+            return
+
+        since = args["since"]
+        gap, first, last, events = self.changes(**args)
+        if events:
+            next_since = events[-1][0]
+        elif gap or since is None:
+            next_since = first - 1
+        else:
+            next_since = since
+
+        root = Element("response", first=str(first), last=str(last),
+                       next=str(next_since))
+        if gap:
+            root.set("gap", "true")
+        for sequence, stream_id, value, timestamp in events:
+            elem = SubElement(root, "e", s=str(sequence), id=stream_id,
+                              t="%d" % timestamp)
+            if isinstance(value, basestring):
+                elem.set("enc", "base64")
+                elem.text = base64.b64encode(value)
+            else:
+                elem.text = str(value)
+        response.put(root)
+
+
+def parse_query(attrib):
+    """
+    Convert "changes" attributes into `ChangeJournal.changes` arguments.
+
+    Raises ValueError for invalid attributes.
+    """
+    def integer(name):
+        value = attrib.get(name)
+        if value is None:
+            return None
+        try:
+            value = int(value)
+        except ValueError:
+            raise ValueError("%s must be an integer" % name)
+        if value < 0:
+            raise ValueError("%s must not be negative" % name)
+        return value
+
+    return {"since": integer("since"), "limit": integer("limit")}
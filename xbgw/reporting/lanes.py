@@ -0,0 +1,200 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define prioritized queueing of data points awaiting upload
+
+Lanes are configured as a list of dictionaries, highest priority first.
+Each lane has the following keys:
+
+    * "name": Name of the lane, used in log messages (required)
+    * "streams": A shell-style pattern (see the fnmatch module), or list of
+                 patterns, matched against stream ids. Use a pattern such as
+                 "xbee.digitalIn/*" to select every stream of a topic.
+                 (required)
+    * "capacity": Maximum number of points held in the lane (required)
+    * "drop policy": What to do when a point arrives at a full lane:
+                     "purge" empties the lane, "oldest" drops the oldest
+                     point in the lane, "newest" drops the arriving point.
+                     (Default: "oldest")
+    * "urgent": If true, points in this lane are uploaded as soon as the
+                rate limit allows, without waiting for flush triggers.
+                (Default: false)
+
+Streams not matching any lane go to a default lane of lowest priority,
+which purges itself when full.
+"""
+
+import fnmatch
+import logging
+
+from xbgw.reporting.records import PointQueue
+
+logger = logging.getLogger(__name__)
+
+DROP_POLICIES = ("purge", "oldest", "newest")
+
+
+class Lane(object):
+    """A bounded queue of data points with its own drop policy"""
+
+    def __init__(self, name, streams, capacity, drop_policy="oldest",
+                 urgent=False):
+        if isinstance(streams, basestring):
+            streams = [streams]
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError("Unknown drop policy '%s'" % drop_policy)
+        capacity = int(capacity)
+        if capacity <= 0:
+            raise ValueError("Lane capacity must be positive")
+
+        self.name = str(name)
+        self.patterns = [str(pattern) for pattern in streams]
+        self.capacity = capacity
+        self.drop_policy = str(drop_policy)
+        self.urgent = bool(urgent)
+        self.points = PointQueue()
+        # Number of points dropped due to overflow, and of purges
+        self.dropped = 0
+        self.purges = 0
+
+    def matches(self, stream_id):
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(stream_id, pattern):
+                return True
+        return False
+
+    def append(self, stream_id, value, timestamp, seq=0):
+        """
+        Add a data point, applying the drop policy if the lane is full.
+
+        Returns None, or a list of the sequence numbers of dropped points.
+        """
+        dropped = None
+        if len(self.points) >= self.capacity:
+            if self.drop_policy == "newest":
+                self.dropped += 1
+                return [seq]
+            elif self.drop_policy == "oldest":
+                dropped = [self.points.popleft()[3]]
+                self.dropped += 1
+            else:
+                logger.error("Max queue size exceeded, purging %s lane",
+                             self.name)
+                dropped = self.points.sequences()
+                self.dropped += len(dropped)
+                self.purges += 1
+                self.points.clear()
+
+        self.points.append(stream_id, value, timestamp, seq)
+        return dropped
+
+
+def parse_lanes(lanes):
+    """
+    Parse a list of lane dictionaries into Lane objects.
+
+    Raises ValueError if any lane is invalid.
+    """
+    parsed = []
+    for lane in lanes:
+        if not isinstance(lane, dict):
+            raise ValueError("Lane must be a dictionary")
+        # Setting names use spaces, keyword arguments use underscores
+        kwargs = dict((str(key).replace(' ', '_'), value)
+                      for key, value in lane.iteritems())
+        try:
+            parsed.append(Lane(**kwargs))
+        except TypeError, e:
+            raise ValueError("Invalid lane %r: %s" % (lane, e))
+    return parsed
+
+
+class LaneQueue(object):
+    """Queue of data points served from prioritized lanes
+
+    Points are assigned to the first configured lane whose patterns match
+    their stream id, or to the default lane otherwise. `popleft` always
+    serves the highest priority non-empty lane, so an upload batch fills
+    from the most important data first.
+
+    Arguments:
+        - lanes: list of lane dictionaries (see module docstring)
+        - default_capacity: function returning the capacity of the default
+                            lane, so that it may follow a live setting
+
+    LaneQueue is not thread safe.
+    """
+
+    def __init__(self, lanes, default_capacity):
+        self.lanes = parse_lanes(lanes)
+        self.default = Lane("default", [], 1, "purge")
+        self.lanes.append(self.default)
+        self._default_capacity = default_capacity
+        # stream id -> Lane, cached
+        self._assignments = {}
+
+    def __len__(self):
+        return sum(len(lane.points) for lane in self.lanes)
+
+    def lane_for(self, stream_id):
+        lane = self._assignments.get(stream_id)
+        if lane is None:
+            lane = self.default
+            for candidate in self.lanes[:-1]:
+                if candidate.matches(stream_id):
+                    lane = candidate
+                    break
+            if len(self._assignments) >= 4096:
+                self._assignments.clear()
+            self._assignments[stream_id] = lane
+        return lane
+
+    def append(self, stream_id, value, timestamp, seq=0):
+        """Queue a data point, returning any dropped sequence numbers"""
+        lane = self.lane_for(stream_id)
+        if lane is self.default:
+            lane.capacity = self._default_capacity()
+        return lane.append(stream_id, value, timestamp, seq)
+
+    def requeue(self, points):
+        """
+        Return points taken by `popleft` to the heads of their lanes.
+
+        Used when an upload fails, so that its data is retried before newer
+        data. Lane capacities are not applied, since at most one batch per
+        failed upload is returned.
+        """
+        for point in reversed(points):
+            self.lane_for(point[0]).points.appendleft(*point)
+
+    def popleft(self):
+        """Remove and return the next point from the highest priority lane"""
+        for lane in self.lanes:
+            if len(lane.points):
+                return lane.points.popleft()
+        raise IndexError("pop from an empty LaneQueue")
+
+    def oldest_timestamp(self):
+        """Return the timestamp of the oldest point in any lane, or None"""
+        oldest = None
+        for lane in self.lanes:
+            timestamp = lane.points.oldest_timestamp()
+            if timestamp is not None and (oldest is None or
+                                          timestamp < oldest):
+                oldest = timestamp
+        return oldest
+
+    def urgent(self):
+        """Return True if any urgent lane holds points"""
+        for lane in self.lanes:
+            if lane.urgent and len(lane.points):
+                return True
+        return False
+
+    def clear(self):
+        for lane in self.lanes:
+            lane.points.clear()
@@ -0,0 +1,254 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Keep the latest value of every data stream on the gateway
+
+The LastValueTable component subscribes to data topics and keeps the most
+recent value reported by each node on each pin, indexed by node, by pin
+name and by topic. The current values can be read with the "last_values"
+RCI command, rather than waiting for them to be uploaded to Device Cloud:
+
+    <do_command target="xbgw">
+        <last_values node="[00:13:a2:00:40:a1:b2:c3]!" pin="AD"/>
+    </do_command>
+
+The command accepts the following attributes, all optional:
+
+    * "node": Only return values from this node (e.g.
+              "[00:13:a2:00:40:a1:b2:c3]!")
+    * "pin": Only return values of pins whose names start with this prefix
+             (e.g. "AD", "DIO1")
+    * "topic": Only return values published on this topic (e.g.
+               "xbee.digitalIn")
+    * "limit": Return at most this many values, and never more than the
+               "max results" setting
+
+and responds with the matching values, grouped by node:
+
+    <response matches="2">
+        <node id="[00:13:a2:00:40:a1:b2:c3]!">
+            <v p="AD1" t="1400000000000">512</v>
+            <v p="AD2" t="1400000000000">0</v>
+        </node>
+    </response>
+
+"t" is the time the value was received, in milliseconds since the epoch.
+Messages without a pin name, such as serial data, are listed under the
+last part of their topic name ("serialIn"), and string values are
+base64-encoded, with the attribute enc="base64". "matches" counts every
+matching value, including those left out because of the limit.
+
+Each filter is answered from an index, so a query only visits the values
+it could match.
+"""
+
+import base64
+import bisect
+import logging
+import threading
+import time
+from xml.etree.ElementTree import Element, SubElement
+
+import pubsub.pub
+
+from xbgw.command.rci import ErrorResponse
+from xbgw.command.registry import register_command
+from xbgw.reporting.device_cloud import wrap
+from xbgw.settings import Setting, SettingsMixin
+
+logger = logging.getLogger(__name__)
+
+errors = {
+    'last_values.bad_argument': "Invalid last_values argument",
+}
+
+
+class LastValueTable(SettingsMixin):
+    """Records the latest value of each node and pin and answers queries
+
+    Settings:
+
+        * "max entries": Number of (node, pin) values to keep. Values of
+                         further pins are ignored. (Default: 4096)
+        * "max results": Largest number of values returned by one query
+                         (Default: 256)
+
+    Subscribe to data topics with `start_recording`. See the module
+    docstring for the "last_values" RCI command.
+    """
+
+    LAST_VALUES_COMMAND = "last_values"
+
+    def __init__(self, settings_registry, settings_binding="last_values"):
+        settings_list = [
+            Setting(name="max entries", type=int, required=False,
+                    default_value=4096, verify_function=lambda x: x > 0),
+            Setting(name="max results", type=int, required=False,
+                    default_value=256, verify_function=lambda x: x > 0),
+        ]
+        SettingsMixin.__init__(self)
+        self.register_settings(settings_registry, settings_binding,
+                               settings_list)
+
+        self._topic_registry = {}
+        # Indexes, guarded by _lock. Each entry is a list
+        # [node, pin, topic, value, timestamp], shared by every index and
+        # updated in place.
+        self._entries = {}  # (node, pin) -> entry
+        self._by_node = {}  # node -> {pin: entry}
+        self._by_pin = {}  # pin -> {node: entry}
+        self._by_topic = {}  # topic -> {(node, pin): entry}
+        self._pins = []  # sorted keys of _by_pin, for prefix lookups
+        self._lock = threading.Lock()
+        # Values not recorded because the table was full
+        self.skipped = 0
+
+        register_command(self.LAST_VALUES_COMMAND, self.last_values_listener)
+
+    def start_recording(self, topic):
+        """Subscribe to pubsub data on the given topic name"""
+        listener = wrap(self.__my_listener)
+        self._topic_registry[topic] = listener
+        pubsub.pub.subscribe(listener, topic)
+
+    def stop_recording(self, topic):
+        """Unsubscribe from pubsub data on the given topic name
+
+        Will raise KeyError if the topic has not been subscribed to.
+        """
+        del self._topic_registry[topic]
+
+    def __my_listener(self, topic=pubsub.pub.AUTO_TOPIC, ident=None,
+                      value=None, **kwargs):
+        topic = topic.getName()  # pylint: disable=maybe-no-member
+        self.record(topic, ident, value, int(time.time() * 1000))
+
+    def record(self, topic, ident, value, timestamp):
+        """
+        Store 'value', published on 'topic' with identity 'ident', as the
+        latest value of its node and pin. 'timestamp' is in milliseconds.
+        """
+        if type(ident) not in (tuple, list):
+            logger.warn("Got non-tuple, non-list ID: %s", ident)
+            ident = (ident,)
+        node = str(ident[0])
+        if len(ident) > 1:
+            pin = "/".join(str(part) for part in ident[1:])
+        else:
+            pin = topic.rsplit(".", 1)[-1]
+        key = (node, pin)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[2] != topic:
+                    del self._by_topic[entry[2]][key]
+                    self._by_topic.setdefault(topic, {})[key] = entry
+                    entry[2] = topic
+                entry[3] = value
+                entry[4] = timestamp
+                return
+
+            if len(self._entries) >= self.get_setting("max entries"):
+                self.skipped += 1
+                return
+
+            entry = [node, pin, topic, value, timestamp]
+            self._entries[key] = entry
+            self._by_node.setdefault(node, {})[pin] = entry
+            self._by_topic.setdefault(topic, {})[key] = entry
+            nodes = self._by_pin.get(pin)
+            if nodes is None:
+                nodes = self._by_pin[pin] = {}
+                bisect.insort(self._pins, pin)
+            nodes[node] = entry
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _candidates(self, node, pin, topic):
+        # Caller must hold _lock. Returns the entries of the most selective
+        # index for the given filters.
+        if node is not None:
+            return self._by_node.get(node, {}).values()
+        if topic is not None:
+            return self._by_topic.get(topic, {}).values()
+        if pin is not None:
+            entries = []
+            index = bisect.bisect_left(self._pins, pin)
+            while (index < len(self._pins) and
+                   self._pins[index].startswith(pin)):
+                entries.extend(self._by_pin[self._pins[index]].itervalues())
+                index += 1
+            return entries
+        return self._entries.values()
+
+    def query(self, node=None, pin=None, topic=None, limit=None):
+        """
+        Return (number of matches, [(node, pin, topic, value, timestamp)])
+        for the values matching every given filter, sorted by node and pin.
+        'pin' is a prefix of pin names. At most 'limit' values, and no more
+        than the "max results" setting, are returned.
+        """
+        with self._lock:
+            matches = [tuple(entry)
+                       for entry in self._candidates(node, pin, topic)
+                       if (node is None or entry[0] == node) and
+                       (pin is None or entry[1].startswith(pin)) and
+                       (topic is None or entry[2] == topic)]
+
+        max_results = self.get_setting("max results")
+        if limit is None or limit > max_results:
+            limit = max_results
+        matches.sort()
+        return len(matches), matches[:limit]
+
+    def last_values_listener(self, element, response):
+        try:
+            args = parse_query(element.attrib)
+        except ValueError, e:
+            response.put(ErrorResponse("last_values.bad_argument", errors,
+                                       hint=str(e)))
+            return
+
+        count, values = self.query(**args)
+        root = Element("response", matches=str(count))
+        node_el = None
+        for node, pin, _, value, timestamp in values:
+            if node_el is None or node_el.get("id") != node:
+                node_el = SubElement(root, "node", id=node)
+            elem = SubElement(node_el, "v", p=pin, t="%d" % timestamp)
+            if isinstance(value, basestring):
+                elem.set("enc", "base64")
+                elem.text = base64.b64encode(value)
+            else:
+                elem.text = str(value)
+        response.put(root)
+
+
+def parse_query(attrib):
+    """
+    Convert "last_values" attributes into `LastValueTable.query`
+    arguments.
+
+    Raises ValueError for invalid attributes.
+    """
+    limit = attrib.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError("limit must be an integer")
+        if limit < 0:
+            raise ValueError("limit must not be negative")
+
+    return {
+        "node": attrib.get("node"),
+        "pin": attrib.get("pin"),
+        "topic": attrib.get("topic"),
+        "limit": limit,
+    }
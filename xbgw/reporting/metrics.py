@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define health and throughput metrics for reporting managers
+
+Reporters keep plain integer counters and fixed-bucket histograms,
+updated under locks they already hold, so that recording a metric costs
+no more than an addition. The ReporterStatsCommand class makes a
+reporter's metrics available through the "reporter_stats" RCI command:
+
+    <do_command target="xbgw">
+        <reporter_stats/>
+    </do_command>
+
+which responds with an element holding one child per metric, e.g.
+
+    <response>
+        <queue_depth>12</queue_depth>
+        <uploads>340</uploads>
+        ...
+        <upload_latency count="340" sum="81.5">
+            <bucket le="0.1">20</bucket>
+            ...
+            <bucket le="inf">0</bucket>
+        </upload_latency>
+    </response>
+"""
+
+import logging
+from bisect import bisect_left
+from xml.etree.ElementTree import Element, SubElement
+
+from xbgw.command.registry import register_command
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram(object):
+    """Counts observations into fixed buckets
+
+    Arguments:
+        - bounds: sorted upper bounds of the buckets. Observations larger
+                  than the last bound are counted in a final overflow
+                  bucket.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return float(self.total) / self.count
+
+    def snapshot(self):
+        """Return a copy which is not affected by later observations"""
+        copy = Histogram(self.bounds)
+        copy.counts = list(self.counts)
+        copy.count = self.count
+        copy.total = self.total
+        return copy
+
+
+def metrics_element(metrics, tag="response"):
+    """
+    Build an ElementTree Element from a dictionary of metrics.
+
+    Numeric values become text of an element named after the metric, and
+    Histogram values become elements with one 'bucket' child per bucket.
+    """
+    root = Element(tag)
+    for name in sorted(metrics):
+        value = metrics[name]
+        elem = SubElement(root, name)
+        if isinstance(value, Histogram):
+            elem.set("count", str(value.count))
+            elem.set("sum", str(value.total))
+            bounds = [str(bound) for bound in value.bounds] + ["inf"]
+            for bound, count in zip(bounds, value.counts):
+                bucket = SubElement(elem, "bucket")
+                bucket.set("le", bound)
+                bucket.text = str(count)
+        else:
+            elem.text = str(value)
+    return root
+
+
+class ReporterStatsCommand(object):
+    """Implements the "reporter_stats" RCI command
+
+    Responds with the metrics returned by the reporter's `stats` method.
+    """
+
+    STATS_COMMAND = "reporter_stats"
+
+    def __init__(self, reporter):
+        self._reporter = reporter
+        register_command(self.STATS_COMMAND, self.stats_listener)
+
+    def stats_listener(self, element, response):
+        logger.debug("Reporting stats")
+        response.put(metrics_element(self._reporter.stats()))
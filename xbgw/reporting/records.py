@@ -0,0 +1,162 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define compact storage for data points queued by reporting managers
+"""
+
+from array import array
+
+
+class StreamIdCache(object):
+    """Maps (topic, ident) pairs to shared, interned stream id strings
+
+    Building a stream id involves joining and escaping the message identity,
+    and every data point would otherwise hold its own copy of the resulting
+    string. The cache builds each stream id once and hands out the same
+    string object for every later data point on that stream.
+
+    The cache is bounded; once 'max_entries' streams are known it is
+    emptied and starts over. Identities which cannot be used as dictionary
+    keys are converted on every call.
+
+    Arguments:
+        - convert: function taking (topic, ident) and returning a stream id
+        - max_entries: number of streams to remember (Default: 1024)
+    """
+
+    def __init__(self, convert, max_entries=1024):
+        self._convert = convert
+        self._max_entries = max_entries
+        self._cache = {}
+
+    def get(self, topic, ident):
+        if isinstance(ident, list):
+            ident = tuple(ident)
+
+        key = (topic, ident)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable identity, cannot cache
+            return self._convert(topic, ident)
+
+        stream_id = self._convert(topic, ident)
+        if isinstance(stream_id, str):
+            stream_id = intern(stream_id)
+
+        if len(self._cache) >= self._max_entries:
+            self._cache.clear()
+        self._cache[key] = stream_id
+        return stream_id
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class PointQueue(object):
+    """FIFO queue of data points, stored column-wise in a ring buffer
+
+    Each data point consists of a stream id, a value, an integer
+    timestamp in milliseconds and an integer sequence number (see
+    xbgw.reporting.sequence). Rather than holding a tuple (and its
+    contents) per point, the queue keeps one column per field: stream ids
+    and values are references in Python lists, and timestamps and sequence
+    numbers are packed into arrays of doubles. With interned stream ids
+    (see StreamIdCache), a queued point costs four slots plus its value
+    object, roughly a tenth of a tuple-based queue entry.
+
+    The ring doubles in size when full and returns to its initial size when
+    cleared. It does not limit its own length; callers are expected to do
+    so. PointQueue is not thread safe.
+    """
+
+    def __init__(self, capacity=64):
+        self._initial_capacity = capacity
+        self._reset(capacity)
+
+    def _reset(self, capacity):
+        self._streams = [None] * capacity
+        self._values = [None] * capacity
+        self._times = array('d', [0.0]) * capacity
+        self._seqs = array('d', [0.0]) * capacity
+        self._head = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self):
+        # Unroll the ring so that the head is at index 0, then double it
+        capacity = len(self._streams)
+        head = self._head
+        self._streams = (self._streams[head:] + self._streams[:head] +
+                         [None] * capacity)
+        self._values = (self._values[head:] + self._values[:head] +
+                        [None] * capacity)
+        self._times = (self._times[head:] + self._times[:head] +
+                       array('d', [0.0]) * capacity)
+        self._seqs = (self._seqs[head:] + self._seqs[:head] +
+                      array('d', [0.0]) * capacity)
+        self._head = 0
+
+    def append(self, stream_id, value, timestamp, seq=0):
+        """Add a data point (timestamp in milliseconds) at the tail"""
+        if self._size == len(self._streams):
+            self._grow()
+
+        index = (self._head + self._size) % len(self._streams)
+        self._streams[index] = stream_id
+        self._values[index] = value
+        self._times[index] = timestamp
+        self._seqs[index] = seq
+        self._size += 1
+
+    def appendleft(self, stream_id, value, timestamp, seq=0):
+        """Add a data point (timestamp in milliseconds) at the head"""
+        if self._size == len(self._streams):
+            self._grow()
+
+        index = (self._head - 1) % len(self._streams)
+        self._streams[index] = stream_id
+        self._values[index] = value
+        self._times[index] = timestamp
+        self._seqs[index] = seq
+        self._head = index
+        self._size += 1
+
+    def popleft(self):
+        """Remove and return the oldest (stream_id, value, timestamp, seq)"""
+        if not self._size:
+            raise IndexError("pop from an empty PointQueue")
+
+        index = self._head
+        point = (self._streams[index], self._values[index],
+                 int(self._times[index]), int(self._seqs[index]))
+        # Drop references so that values can be freed
+        self._streams[index] = None
+        self._values[index] = None
+
+        self._head = (index + 1) % len(self._streams)
+        self._size -= 1
+        return point
+
+    def oldest_timestamp(self):
+        """Return the timestamp of the oldest point, or None if empty"""
+        if not self._size:
+            return None
+        return int(self._times[self._head])
+
+    def sequences(self):
+        """Return the sequence numbers of all queued points, oldest first"""
+        capacity = len(self._seqs)
+        return [int(self._seqs[(self._head + i) % capacity])
+                for i in xrange(self._size)]
+
+    def clear(self):
+        self._reset(self._initial_capacity)
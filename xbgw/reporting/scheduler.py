@@ -0,0 +1,145 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define upload scheduling helpers for reporting managers
+"""
+
+import threading
+import time
+from collections import deque
+
+
+class RateLimiter(object):
+    """Sliding window limiter for uploads to a throttled service
+
+    Device Cloud throttles uploads on a per-device basis (one upload every
+    five seconds on the Free/Developer tiers, one every second on Standard
+    tier and above). RateLimiter remembers when recent uploads happened and
+    reports how long to wait before the next one is allowed.
+
+    The window length and the number of uploads permitted within one
+    window ('burst') are given on each call rather than at construction,
+    so that callers can read them from live settings.
+    """
+
+    def __init__(self):
+        self._history = deque()
+        self._lock = threading.Lock()
+
+    def delay(self, period, burst=1, now=None):
+        """
+        Return the number of seconds until another upload is allowed.
+
+        Returns 0 if an upload may be performed right away.
+
+        Arguments:
+            - period: length of the rate limit window, in seconds
+            - burst: number of uploads allowed within one window
+            - now: current time (Default: time.time())
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if len(self._history) < burst:
+                return 0
+            # The upload 'burst' places back in history must have left the
+            # window before another upload is allowed.
+            oldest = self._history[-burst]
+
+        return max(0, oldest + period - now)
+
+    def reserve(self, period, burst=1, limit=64, now=None):
+        """
+        Claim an upload slot if one is available right away.
+
+        Returns 0 and records the upload if the rate limit allows it,
+        otherwise returns the number of seconds until a slot opens. Checking
+        and recording happen atomically, so that concurrent uploaders cannot
+        claim the same slot.
+        """
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if len(self._history) >= burst:
+                wait = self._history[-burst] + period - now
+                if wait > 0:
+                    return wait
+
+            self._history.append(now)
+            while len(self._history) > limit:
+                self._history.popleft()
+
+        return 0
+
+    def record(self, when=None, limit=64):
+        """
+        Record that an upload has occurred.
+
+        Arguments:
+            - when: time of the upload (Default: time.time())
+            - limit: maximum number of uploads to remember. This should be at
+                     least as large as any 'burst' value passed to `delay`.
+        """
+        if when is None:
+            when = time.time()
+
+        with self._lock:
+            self._history.append(when)
+            while len(self._history) > limit:
+                self._history.popleft()
+
+    def last(self):
+        """Return the time of the most recent upload, or None if none."""
+        with self._lock:
+            if not self._history:
+                return None
+            return self._history[-1]
+
+
+def flush_delay(count, oldest_age, batch_size, flush_count=0, flush_age=0):
+    """
+    Determine how long to wait before queued data should be uploaded.
+
+    Queued data is ready to upload when any of the following is true:
+
+        * a full batch ('batch_size' points) is queued
+        * 'flush_count' is non-zero and at least that many points are queued
+        * 'flush_age' is non-zero and the oldest queued point is at least
+          'flush_age' seconds old
+        * neither 'flush_count' nor 'flush_age' is set, in which case data is
+          uploaded as soon as the rate limit window allows
+
+    Returns 0 if the data is ready, the number of seconds until the age
+    trigger fires, or None if only more data can make the queue ready.
+
+    >>> flush_delay(3, 1.0, 249)
+    0
+    >>> flush_delay(3, 1.0, 249, flush_count=10) is None
+    True
+    >>> flush_delay(3, 1.0, 249, flush_count=10, flush_age=5)
+    4.0
+    >>> flush_delay(10, 1.0, 249, flush_count=10, flush_age=5)
+    0
+    """
+    if count <= 0:
+        return None
+
+    if count >= batch_size:
+        return 0
+
+    if not flush_count and not flush_age:
+        return 0
+
+    if flush_count and count >= flush_count:
+        return 0
+
+    if flush_age:
+        return max(0, flush_age - oldest_age)
+
+    return None
@@ -0,0 +1,146 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define tracking of data point sequence numbers for reporting managers
+
+Every queued data point is given a sequence number, increasing by one per
+point. Once a point has been uploaded (or deliberately dropped), its
+sequence number is "settled". The SequenceTracker keeps the high-water
+mark, below which every sequence number is settled, plus the settled
+numbers above it. Points may be settled out of order, since priority lanes
+and concurrent uploads do not preserve queueing order.
+
+The tracker's state can be saved to a small JSON file, so that data
+replayed after a restart (see the reporter's spool file) can skip every
+point that was already uploaded.
+"""
+
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def ranges(seqs):
+    """
+    Compress sequence numbers into a sorted list of [first, last] ranges.
+
+    >>> ranges([5, 1, 2, 3, 7, 8])
+    [[1, 3], [5, 5], [7, 8]]
+    """
+    result = []
+    for seq in sorted(seqs):
+        if result and seq <= result[-1][1] + 1:
+            result[-1][1] = max(result[-1][1], seq)
+        else:
+            result.append([seq, seq])
+    return result
+
+
+def format_ranges(seqs):
+    """Return sequence numbers as a short string, e.g. "1-3,5,7-8"."""
+    return ','.join(str(first) if first == last else "%d-%d" % (first, last)
+                    for first, last in ranges(seqs))
+
+
+class SequenceTracker(object):
+    """Hands out sequence numbers and records which are settled
+
+    SequenceTracker is not thread safe.
+    """
+
+    def __init__(self, high_water=0, settled=()):
+        self.high_water = high_water
+        # Settled sequence numbers above the high-water mark
+        self._above = set()
+        self._next = high_water + 1
+        self.settle(settled)
+
+    def __len__(self):
+        return len(self._above)
+
+    def next(self):
+        """Return a new sequence number"""
+        seq = self._next
+        self._next += 1
+        return seq
+
+    def reserve(self, seq):
+        """Ensure sequence numbers handed out from now on exceed 'seq'"""
+        if seq >= self._next:
+            self._next = seq + 1
+
+    def settle(self, seqs):
+        """Record that the given sequence numbers need not be sent again"""
+        high_water = self.high_water
+        above = self._above
+        for seq in seqs:
+            if seq > high_water:
+                above.add(seq)
+                self.reserve(seq)
+
+        while high_water + 1 in above:
+            high_water += 1
+            above.remove(high_water)
+        self.high_water = high_water
+
+    def settle_except(self, pending):
+        """
+        Settle every sequence number handed out or seen so far, except those
+        in 'pending', e.g. after a restart, when only the replayed points
+        can still be sent.
+        """
+        pending = set(pending)
+        self.settle(seq for seq in xrange(self.high_water + 1, self._next)
+                    if seq not in pending)
+
+    def is_settled(self, seq):
+        return seq <= self.high_water or seq in self._above
+
+    def state(self):
+        """Return the tracker state as a JSON-compatible dictionary"""
+        return {"high water": self.high_water,
+                "settled": ranges(self._above)}
+
+    @classmethod
+    def from_state(cls, state):
+        settled = []
+        for first, last in state.get("settled", []):
+            settled.extend(xrange(int(first), int(last) + 1))
+        return cls(int(state.get("high water", 0)), settled)
+
+    def save(self, path):
+        """Write the tracker state to 'path', replacing it atomically"""
+        save_state(self.state(), path)
+
+    @classmethod
+    def load(cls, path):
+        """Read a tracker saved by `save`, or return a new one"""
+        try:
+            with open(path) as state_file:
+                return cls.from_state(json.load(state_file))
+        except IOError:
+            # No saved state
+            return cls()
+        except (ValueError, TypeError, AttributeError), e:
+            logger.error("Ignoring unreadable sequence file %s: %s", path, e)
+            return cls()
+
+
+def save_state(state, path):
+    """
+    Write a state returned by `SequenceTracker.state` to 'path', replacing
+    it atomically. Errors are logged.
+    """
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "w") as out:
+            json.dump(state, out)
+        os.rename(temp_path, path)
+    except (IOError, OSError), e:
+        logger.error("Could not write sequence file %s: %s", path, e)
@@ -0,0 +1,308 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define additional destinations ("sinks") for reported data
+
+Besides uploading to Device Cloud, a reporter may deliver its data points
+to further sinks. Sinks are configured as a list of dictionaries, each
+with the following keys:
+
+    * "name": Name of the sink, used in log messages (required)
+    * "transport": Name of the transport delivering the data, e.g.
+                   "rotating file", "udp" or "tcp" (see
+                   xbgw.reporting.transport) (required)
+    * "transport options": Dictionary of options for the transport
+                           (Default: {})
+    * "encoding": Format of the data, "csv", "xml" or "json" (see
+                  xbgw.reporting.encoders). The "udp" transport sends each
+                  line separately, and only accepts "csv". (Default: "csv")
+    * "compress": If true, gzip compress each send. Only transports which
+                  accept compressed bodies may be used. (Default: false)
+    * "streams": A shell-style pattern, or list of patterns, selecting the
+                 stream ids delivered to this sink (Default: "*")
+    * "capacity": Maximum number of data points held for the sink. The
+                  oldest point is dropped when it is full. (Default: 5000)
+    * "max per upload": Maximum number of data points per send
+                        (Default: 249)
+    * "max upload bytes": If non-zero, maximum size of a send in bytes. A
+                          single data point too large to fit is dropped.
+                          (Default: 65536)
+    * "rate limit": Minimum number of seconds between sends (Default: 0)
+    * "retry time": Seconds to wait after the first failed send, doubled
+                    with each consecutive failure (Default: 5)
+    * "max backoff": Longest wait between send attempts (Default: 300)
+
+Every sink has its own queue, thread and backoff state, so a slow or
+failing sink does not hold up any other. Data points are handed to sinks
+already encoded. Each point is encoded once per encoding, and the same
+fragment object is shared by every sink using that encoding. CSV sinks
+send one line per point, in the same column order as Device Cloud uploads
+(TIMESTAMP,DATA,DATATYPE,STREAMID) but without the header line, so that
+sends can be appended to logs and streams.
+"""
+
+import fnmatch
+import logging
+import threading
+import time
+from collections import deque
+
+from xbgw.reporting.backoff import Backoff
+from xbgw.reporting.encoders import ENCODERS, get_encoder, gzip_body
+from xbgw.reporting.scheduler import RateLimiter
+from xbgw.reporting.transport import TRANSPORTS, create_transport
+
+logger = logging.getLogger(__name__)
+
+
+class Sink(object):
+    """Delivers encoded data points to one destination
+
+    Arguments:
+        - name: name used in log messages
+        - transport: transport object (see xbgw.reporting.transport)
+        - streams: pattern or list of patterns of stream ids to accept
+        - encoding, compress, capacity, max_per_upload, max_upload_bytes,
+          rate_limit, retry_time, max_backoff: see module docstring
+        - filename: file name passed to the transport (Default: as for
+                    Device Cloud uploads, e.g. "DataPoint/upload.csv")
+
+    The sink's thread is started by `start`.
+    """
+
+    def __init__(self, name, transport, streams="*", encoding="csv",
+                 compress=False, capacity=5000, max_per_upload=249,
+                 max_upload_bytes=65536, rate_limit=0.0, retry_time=5.0,
+                 max_backoff=300.0, filename=None):
+        if isinstance(streams, basestring):
+            streams = [streams]
+        capacity = int(capacity)
+        max_per_upload = int(max_per_upload)
+        if capacity <= 0 or max_per_upload <= 0:
+            raise ValueError("Sink capacity and max per upload must be "
+                             "positive")
+        for value in (max_upload_bytes, rate_limit, retry_time,
+                      max_backoff):
+            if float(value) < 0:
+                raise ValueError("Sink sizes and times must not be negative")
+        compress = bool(compress)
+        if compress and not getattr(transport, "supports_gzip", False):
+            raise ValueError("Transport does not accept compressed data")
+        if encoding != "csv" and getattr(transport, "line_oriented", False):
+            raise ValueError("Transport sends each line separately, and "
+                             "only accepts CSV")
+
+        self.name = str(name)
+        self.patterns = [str(pattern) for pattern in streams]
+        self.encoder = get_encoder(encoding)
+        self.compress = compress
+        self.capacity = capacity
+        self.max_per_upload = max_per_upload
+        self.max_upload_bytes = int(max_upload_bytes)
+        self.rate_limit = float(rate_limit)
+        self.retry_time = float(retry_time)
+        self.max_backoff = float(max_backoff)
+        self._transport = transport
+        self._filename = filename or self.encoder.filename(compress)
+
+        self._lines = deque()
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._in_flight = 0
+        self._limiter = RateLimiter()
+        self._backoff = Backoff()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        # Counters, guarded by _lock
+        self.dropped = 0
+        self.oversized = 0
+        self.uploads = 0
+        self.failures = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+    def matches(self, stream_id):
+        for pattern in self.patterns:
+            if fnmatch.fnmatchcase(stream_id, pattern):
+                return True
+        return False
+
+    def append(self, line):
+        """Queue an encoded data point. Never blocks on the transport."""
+        with self._lock:
+            if len(self._lines) >= self.capacity:
+                self._lines.popleft()
+                self.dropped += 1
+            self._lines.append(line)
+            self._event.set()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                if not self._lines:
+                    self._event.clear()
+            self._event.wait()
+            if self._stopped.is_set():
+                return
+
+            now = time.time()
+            wait = max(self._limiter.delay(self.rate_limit, now=now),
+                       self._backoff.remaining(now))
+            if wait > 0:
+                self._stopped.wait(wait)
+                continue
+
+            self._send_batch()
+
+    def _take_batch(self):
+        # Caller must hold _lock
+        budget = self.max_upload_bytes
+        separator = len(self.encoder.separator)
+        lines = []
+        # Counts one separator too many, which the first fragment omits
+        size = self.encoder.overhead(framed=False) - separator
+        while self._lines and len(lines) < self.max_per_upload:
+            line = self._lines[0]
+            if budget and size + separator + len(line) > budget:
+                if lines:
+                    break
+                logger.error("Sink %s dropping %d byte data point, larger "
+                             "than max upload bytes", self.name, len(line))
+                self._lines.popleft()
+                self.oversized += 1
+                continue
+            size += separator + len(line)
+            lines.append(self._lines.popleft())
+        return lines
+
+    def _send_batch(self):
+        with self._lock:
+            lines = self._take_batch()
+            if not lines:
+                return
+            self._in_flight += 1
+
+        body = self.encoder.join(lines, framed=False)
+        if self.compress:
+            body = gzip_body(body)
+
+        self._limiter.record()
+        try:
+            success, errmsg = self._transport.send(body, self._filename)
+        except Exception, e:
+            success, errmsg = False, str(e)
+
+        with self._lock:
+            self._in_flight -= 1
+            self.uploads += 1
+            if success:
+                self._backoff.success()
+            else:
+                self.failures += 1
+                # Retry the same data first
+                self._lines.extendleft(reversed(lines))
+                delay = self._backoff.failure(self.retry_time,
+                                              self.max_backoff)
+                logger.warning("Sink %s failed, retrying in %f: %s",
+                               self.name, delay, errmsg)
+
+    def drain(self, deadline):
+        """
+        Wait until all queued data is sent or time.time() passes
+        'deadline', then stop the sink.
+
+        Returns the number of data points left unsent.
+        """
+        while time.time() < deadline:
+            with self._lock:
+                if not self._lines and not self._in_flight:
+                    break
+            time.sleep(0.1)
+
+        self._stopped.set()
+        self._event.set()
+        with self._lock:
+            return len(self._lines)
+
+
+# Keys of a sink dictionary, see the module docstring
+SINK_KEYS = ("name", "transport", "transport options", "encoding",
+             "compress", "streams", "capacity", "max per upload",
+             "max upload bytes", "rate limit", "retry time", "max backoff",
+             "filename")
+
+
+def verify_sinks(sinks):
+    """
+    Check a list of sink dictionaries, without creating any transports.
+
+    Suitable as a Setting 'verify_function'. Raises ValueError describing
+    the first invalid sink.
+    """
+    for sink in sinks:
+        if not isinstance(sink, dict):
+            raise ValueError("Sink must be a dictionary")
+        unknown = [key for key in sink if key not in SINK_KEYS]
+        if unknown:
+            raise ValueError("Unknown sink keys: %s" % ", ".join(unknown))
+        if "name" not in sink:
+            raise ValueError("Sink needs a name")
+        transport = TRANSPORTS.get(sink.get("transport"))
+        if transport is None:
+            raise ValueError("Unknown transport '%s'" % sink.get("transport"))
+        if not isinstance(sink.get("transport options", {}), dict):
+            raise ValueError("Transport options must be a dictionary")
+        if sink.get("encoding", "csv") not in ENCODERS:
+            raise ValueError("Unknown encoding '%s'" % sink["encoding"])
+        if sink.get("compress") and not transport.supports_gzip:
+            raise ValueError("Transport does not accept compressed data")
+        if (sink.get("encoding", "csv") != "csv" and
+                getattr(transport, "line_oriented", False)):
+            raise ValueError("Transport '%s' only sends CSV" %
+                             sink["transport"])
+
+        try:
+            for key in ("capacity", "max per upload"):
+                if int(sink.get(key, 1)) <= 0:
+                    raise ValueError("Sink %s must be positive" % key)
+            for key in ("max upload bytes", "rate limit", "retry time",
+                        "max backoff"):
+                if float(sink.get(key, 0)) < 0:
+                    raise ValueError("Sink %s must not be negative" % key)
+        except TypeError, e:
+            raise ValueError("Invalid sink %r: %s" % (sink, e))
+    return True
+
+
+def parse_sinks(sinks):
+    """
+    Parse a list of sink dictionaries into Sink objects, without starting
+    them.
+
+    Raises ValueError if any sink is invalid.
+    """
+    parsed = []
+    for sink in sinks:
+        if not isinstance(sink, dict):
+            raise ValueError("Sink must be a dictionary")
+        # Setting names use spaces, keyword arguments use underscores
+        kwargs = dict((str(key).replace(' ', '_'), value)
+                      for key, value in sink.iteritems())
+        try:
+            transport = create_transport(kwargs.pop("transport"),
+                                         kwargs.pop("transport_options", {}))
+            parsed.append(Sink(transport=transport, **kwargs))
+        except (KeyError, TypeError), e:
+            raise ValueError("Invalid sink %r: %s" % (sink, e))
+    return parsed
@@ -0,0 +1,374 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (c) 2016 Digi International Inc. All Rights Reserved.
+
+"""
+Define upload transports used by reporting managers
+
+A transport takes a fully formatted upload body and delivers it somewhere.
+Every transport implements a single method:
+
+    send(body, filename) -> (success, errmsg)
+
+where 'filename' is the Device Cloud file name the body would be uploaded
+to (e.g. "DataPoint/upload.csv"). On success, 'errmsg' is ignored. A
+transport which is being throttled should return an error message starting
+with THROTTLED, which reporters treat as a signal to back off and retry.
+
+Transports which can deliver gzip compressed bodies (with a file name
+ending in ".gz") set the class attribute 'supports_gzip' to True.
+Transports which deliver each line of a body separately, and so only
+suit CSV bodies, set the class attribute 'line_oriented' to True.
+
+The following transports are available by name through `create_transport`:
+
+    * "idigidata": Upload to Device Cloud using the XBee Gateway idigidata
+                   module (the default)
+    * "http": POST each body to a local HTTP server, e.g. a historian
+    * "file": Write each body to its own file in a directory
+    * "memory": Keep bodies in memory, with optional simulated latency and
+                throttling, for load testing off-device
+    * "rotating file": Append each body to a file which is rotated by size
+    * "udp": Send each line of a body as a datagram, optionally as syslog
+             messages
+    * "tcp": Stream bodies over a persistent TCP connection
+
+The last three suit the line-oriented bodies produced by reporting sinks
+(see xbgw.reporting.sink).
+"""
+
+import httplib
+import logging
+import os
+import socket
+import threading
+import time
+import urlparse
+from collections import deque
+
+try:
+    import idigidata  # Provided by XBee Gateway
+except ImportError:
+    idigidata = None
+
+logger = logging.getLogger(__name__)
+
+# Prefix of the error message returned for throttled uploads. Matches the
+# message given by idigidata.send_to_idigi.
+THROTTLED = "Request throttled."
+
+
+class IdigidataTransport(object):
+    """Upload to Device Cloud using the XBee Gateway idigidata module"""
+
+    supports_gzip = False
+
+    def __init__(self):
+        if idigidata is None:
+            raise ValueError("idigidata module is not available")
+
+    def send(self, body, filename):
+        # pylint: disable=maybe-no-member
+        success, _, errmsg = idigidata.send_to_idigi(body, filename)
+        return success, errmsg
+
+
+class HttpTransport(object):
+    """POST upload bodies to an HTTP server
+
+    The file name is appended to the path of the configured URL, so with a
+    URL of "http://127.0.0.1:8080/upload", bodies destined for
+    "DataPoint/upload.csv" are sent to "/upload/DataPoint/upload.csv".
+    Responses of 429 or 503 are reported as throttling. Compressed bodies
+    are sent with a "Content-Encoding: gzip" header.
+
+    Options:
+        - url: URL of the server (required)
+        - timeout: seconds to wait for the server (Default: 30)
+    """
+
+    supports_gzip = True
+
+    def __init__(self, url, timeout=30):
+        parsed = urlparse.urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc:
+            raise ValueError("Invalid HTTP transport URL: %r" % url)
+
+        self._scheme = parsed.scheme
+        self._netloc = parsed.netloc
+        self._path = parsed.path.rstrip('/')
+        self._timeout = float(timeout)
+
+    def send(self, body, filename):
+        if self._scheme == "https":
+            conn_cls = httplib.HTTPSConnection
+        else:
+            conn_cls = httplib.HTTPConnection
+
+        path = '/'.join((self._path, filename.lstrip('/')))
+        headers = {"Content-Type": "text/plain"}
+        if filename.endswith(".gz"):
+            headers["Content-Encoding"] = "gzip"
+        conn = conn_cls(self._netloc, timeout=self._timeout)
+        try:
+            conn.request("POST", path, body, headers)
+            response = conn.getresponse()
+            response.read()
+        except Exception, e:
+            return False, "HTTP transport error: %s" % e
+        finally:
+            conn.close()
+
+        if 200 <= response.status < 300:
+            return True, ""
+        if response.status in (429, 503):
+            return False, "%s HTTP %d" % (THROTTLED, response.status)
+        return False, "HTTP %d %s" % (response.status, response.reason)
+
+
+class FileTransport(object):
+    """Write each upload body to its own file in a directory
+
+    Files are named after the upload time, a sequence number and the base
+    name of the Device Cloud file name, e.g.
+    "1400000000123-000001-upload.csv". Each file is written under a
+    temporary name and renamed when complete, so that a process watching
+    the directory never sees partial files.
+
+    Options:
+        - directory: directory in which to place files (required). It is
+                     created if it does not exist.
+    """
+
+    supports_gzip = True
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._count = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def send(self, body, filename):
+        with self._lock:
+            self._count += 1
+            count = self._count
+
+        name = "%d-%06d-%s" % (int(time.time() * 1000), count,
+                               os.path.basename(filename))
+        path = os.path.join(self._directory, name)
+        try:
+            with open(path + ".tmp", "wb") as out:
+                out.write(body)
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError), e:
+            return False, "File transport error: %s" % e
+
+        return True, ""
+
+
+class MemoryTransport(object):
+    """Keep upload bodies in memory, simulating a remote service
+
+    Intended for exercising and benchmarking reporters off-device.
+
+    Options:
+        - latency: seconds each send takes (Default: 0)
+        - min_interval: if non-zero, sends arriving less than this many
+                        seconds after the previous accepted send are
+                        refused as throttled (Default: 0)
+        - max_uploads: number of accepted uploads to remember (Default: 1000)
+
+    Accepted uploads are available as (filename, body) tuples in the
+    'uploads' attribute. The 'throttled' attribute counts refused sends.
+    """
+
+    supports_gzip = True
+
+    def __init__(self, latency=0, min_interval=0, max_uploads=1000):
+        self.latency = float(latency)
+        self.min_interval = float(min_interval)
+        self.uploads = deque(maxlen=int(max_uploads))
+        self.throttled = 0
+        self._last = None
+        self._lock = threading.Lock()
+
+    def send(self, body, filename):
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            now = time.time()
+            if (self.min_interval and self._last is not None and
+                    now - self._last < self.min_interval):
+                self.throttled += 1
+                return False, "%s Simulated" % THROTTLED
+
+            self._last = now
+            self.uploads.append((filename, body))
+
+        return True, ""
+
+
+class RotatingFileTransport(object):
+    """Append upload bodies to a file, rotating it by size
+
+    Once the file grows beyond 'max_bytes', it is renamed with the suffix
+    ".1", any previous ".1" file becomes ".2", and so on up to 'backups'
+    files; older files are deleted.
+
+    Options:
+        - path: file to append to (required). Its directory is created if
+                it does not exist.
+        - max_bytes: size at which the file is rotated (Default: 1048576)
+        - backups: number of rotated files to keep (Default: 3)
+    """
+
+    supports_gzip = False
+
+    def __init__(self, path, max_bytes=1048576, backups=3):
+        self._path = path
+        self._max_bytes = int(max_bytes)
+        self._backups = int(backups)
+        if self._max_bytes <= 0:
+            raise ValueError("max_bytes must be positive")
+        self._lock = threading.Lock()
+
+    def send(self, body, filename):
+        with self._lock:
+            try:
+                directory = os.path.dirname(self._path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                with open(self._path, "ab") as out:
+                    out.write(body)
+                    out.write('\n')
+                    size = out.tell()
+                if size >= self._max_bytes:
+                    self._rotate()
+            except (IOError, OSError), e:
+                return False, "Rotating file transport error: %s" % e
+
+        return True, ""
+
+    def _rotate(self):
+        if self._backups <= 0:
+            os.remove(self._path)
+            return
+
+        for index in xrange(self._backups - 1, 0, -1):
+            older = "%s.%d" % (self._path, index)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self._path, index + 1))
+        os.rename(self._path, self._path + ".1")
+
+
+class UdpTransport(object):
+    """Send each line of an upload body as a UDP datagram
+
+    Lines starting with '#' (headers) are skipped. With 'syslog' set, each
+    line is sent as a syslog (RFC 3164 style) message of informational
+    severity, e.g. "<14>xbgw: 1400000000123,5,INTEGER,stream".
+
+    Options:
+        - host: destination host name or address (required)
+        - port: destination port (Default: 514)
+        - syslog: add a syslog header to each line (Default: false)
+        - facility: syslog facility number (Default: 1, "user")
+        - tag: syslog tag (Default: "xbgw")
+    """
+
+    supports_gzip = False
+    line_oriented = True
+
+    def __init__(self, host, port=514, syslog=False, facility=1, tag="xbgw"):
+        self._address = (str(host), int(port))
+        if syslog:
+            self._prefix = "<%d>%s: " % (int(facility) * 8 + 6, tag)
+        else:
+            self._prefix = ""
+        self._socket = None
+
+    def send(self, body, filename):
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET,
+                                             socket.SOCK_DGRAM)
+            for line in body.split('\n'):
+                if line and not line.startswith('#'):
+                    self._socket.sendto(self._prefix + line, self._address)
+        except socket.error, e:
+            return False, "UDP transport error: %s" % e
+
+        return True, ""
+
+
+class TcpTransport(object):
+    """Stream upload bodies over a persistent TCP connection
+
+    Each body is sent followed by a newline. The connection is opened on
+    the first send, and re-opened on the next send after an error.
+
+    Options:
+        - host: destination host name or address (required)
+        - port: destination port (required)
+        - timeout: seconds to wait when connecting or sending (Default: 10)
+    """
+
+    supports_gzip = False
+
+    def __init__(self, host, port, timeout=10):
+        self._address = (str(host), int(port))
+        self._timeout = float(timeout)
+        self._socket = None
+        self._lock = threading.Lock()
+
+    def send(self, body, filename):
+        with self._lock:
+            try:
+                if self._socket is None:
+                    self._socket = socket.create_connection(self._address,
+                                                            self._timeout)
+                self._socket.sendall(body + '\n')
+            except socket.error, e:
+                self.close()
+                return False, "TCP transport error: %s" % e
+
+        return True, ""
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+TRANSPORTS = {
+    "idigidata": IdigidataTransport,
+    "http": HttpTransport,
+    "file": FileTransport,
+    "memory": MemoryTransport,
+    "rotating file": RotatingFileTransport,
+    "udp": UdpTransport,
+    "tcp": TcpTransport,
+}
+
+
+def create_transport(name, options=None):
+    """
+    Create a transport by name, passing 'options' as keyword arguments.
+
+    Raises ValueError if the name is unknown or the options are invalid.
+    """
+    if name not in TRANSPORTS:
+        raise ValueError("Unknown transport '%s'" % name)
+
+    options = options or {}
+    # JSON keys come back as unicode, which are not valid keyword names
+    kwargs = dict((str(key), value) for key, value in options.iteritems())
+    try:
+        return TRANSPORTS[name](**kwargs)
+    except TypeError, e:
+        raise ValueError("Invalid options for transport '%s': %s" %
+                         (name, e))
@@ -6,4 +6,4 @@
 
 from .settings_base import (BadSettings, SettingNotFound, Setting,
                             SettingsMixin)
-from .registry import SettingsRegistry
+from .registry import SettingsRegistry, SettingsWatcher
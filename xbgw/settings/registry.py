@@ -8,13 +8,26 @@
 Define settings registry abstraction for application configuration
 """
 
+import copy
 import json
+import logging
+import os
+import threading
+
+import pubsub.pub
+
+from .settings_base import BadSettings
+
+logger = logging.getLogger(__name__)
 
 
 # Specifies the character (or character sequence) used to delimit sections of a
 # settings "binding", e.g. "reporting.device cloud".
 BINDING_JOINER = '.'
 
+# Topic on which SettingsRegistry.reload_from_json announces changed settings
+SETTINGS_CHANGED_TOPIC = "settings.changed"
+
 
 def _binding_to_tuple(binding):
     """
@@ -71,11 +84,25 @@ class SettingsRegistry(object):
     tree['settings']['general'], which in this case is the dictionary holding
     keys "setting1" and "setting2".
 
+    Reloading
+    =========
+
+    Components using SettingsMixin are recorded with the binding they
+    registered. `reload_from_json` re-validates the bindings whose contents
+    changed in the file using those components' settings, and applies the
+    new values only if all of them are accepted. See also SettingsWatcher.
+
     """
 
     def __init__(self):
         self.__settings_registry = {}
         self.__stop_traversal_on_missing = False
+        # binding -> components registered with it, see `bind`
+        self.__components = {}
+        # Contents of the settings file as last loaded, to find which
+        # bindings a reload changes
+        self.__loaded = {}
+        self.__reload_lock = threading.Lock()
 
     def set_stop_traversal_on_missing(self, value=True):
         """
@@ -154,6 +181,18 @@ class SettingsRegistry(object):
 
         return obj
 
+    def bind(self, binding, component):
+        """
+        Record that 'component' (a SettingsMixin) uses the settings at
+        'binding', so that `reload_from_json` validates changes to them.
+
+        It is not necessary to call `bind` yourself. Calls will be made by
+        `SettingsMixin.register_settings`.
+        """
+        components = self.__components.setdefault(binding, [])
+        if component not in components:
+            components.append(component)
+
     def load_from_json(self, filename):
         """
         Load a JSON file and read its contents into the settings registry.
@@ -171,15 +210,209 @@ class SettingsRegistry(object):
             # start using registry
             reporter = DeviceCloudReporter(registry)
 
-        while use in the following manner is discouraged:
-
-            registry = SettingsRegistry()
-            # start using registry
-            reporter = DeviceCloudReporter(registry)
-            # load settings
-            registry.load_from_json('settings.json')
-
+        Components keep a reference to the settings at their binding, which
+        loading replaces. To pick up changes to the file once components are
+        using the registry, call `reload_from_json` instead.
         """
         with open(filename, 'r') as settings_file:
             settings = json.load(settings_file, encoding='utf-8')
             self.__settings_registry.update(settings)
+        # Components fill in defaults in the registry, which must not look
+        # like changes to the file
+        self.__loaded = copy.deepcopy(settings)
+
+    def reload_from_json(self, filename):
+        """
+        Apply changes to a JSON file loaded by `load_from_json`.
+
+        Every binding whose contents differ from the previous load is
+        validated by the components bound to it (see `bind`). If any
+        setting is rejected or missing, BadSettings is raised and no
+        settings are changed. Otherwise the new values are applied, and a
+        message is published on the "settings.changed" topic for each
+        binding whose values changed, with arguments 'binding' and
+        'changed' (a list of setting names).
+
+        Settings which their component only reads at startup (see
+        `Setting`) keep their current values; a warning is logged instead,
+        and they are not reported as changed.
+
+        Each binding's settings are replaced by a new dictionary in a
+        single step, so `SettingsMixin.get_settings` returns either all old
+        or all new values. Separate `get_setting` calls, and different
+        bindings, may still see the change at different times.
+
+        Changes to sections which no component is bound to are not
+        applied; they take effect when the application restarts.
+
+        Raises ValueError if the file is not valid JSON, and IOError if it
+        cannot be read. Returns the list of changed bindings.
+        """
+        with open(filename, 'r') as settings_file:
+            settings = json.load(settings_file, encoding='utf-8')
+        if not isinstance(settings, dict):
+            raise ValueError("Settings file must hold a JSON object")
+
+        with self.__reload_lock:
+            updates = self._validate_changes(settings)
+
+            changes = []
+            postponed = []
+            for binding, values, accepted in updates:
+                current = self.get_by_binding(binding)
+                changed = sorted(name for name, value in accepted.iteritems()
+                                 if current.get(name) != value)
+                new_values = dict(values)
+                new_values.update(accepted)
+
+                restart = set()
+                for component in self.__components[binding]:
+                    restart.update(component.restart_settings())
+                deferred = [name for name in changed if name in restart]
+                if deferred:
+                    # Keep what the components are running with
+                    for name in deferred:
+                        if name in current:
+                            new_values[name] = current[name]
+                        else:
+                            del new_values[name]
+                    changed = [name for name in changed
+                               if name not in restart]
+                    postponed.append((binding, deferred))
+
+                # Replace the binding's dictionary as a whole, rather than
+                # updating it key by key, so that no reader sees a mix of
+                # old and new values of the binding
+                chunks = _binding_to_tuple(binding)
+                parent = self.get_by_binding(
+                    BINDING_JOINER.join(chunks[:-1]))
+                parent[chunks[-1]] = new_values
+                for component in self.__components[binding]:
+                    component.replace_settings(new_values)
+                if changed:
+                    changes.append((binding, changed))
+
+            self.__loaded = settings
+
+        for binding, deferred in postponed:
+            logger.warning("Settings in '%s' only take effect after a "
+                           "restart, not applied: %s", binding,
+                           ", ".join(deferred))
+        for binding, changed in changes:
+            logger.info("Settings changed in '%s': %s", binding,
+                        ", ".join(changed))
+            pubsub.pub.sendMessage(SETTINGS_CHANGED_TOPIC, binding=binding,
+                                   changed=changed)
+        return [binding for binding, _ in changes]
+
+    def _validate_changes(self, settings):
+        """
+        Validate the bindings changed between the last loaded settings and
+        'settings'. Returns [(binding, new values, accepted values)], or
+        raises BadSettings.
+        """
+        updates = []
+        rejected, missing = {}, {}
+        for binding, components in self.__components.iteritems():
+            values = _lookup(settings, binding)
+            if values == _lookup(self.__loaded, binding):
+                continue
+            if not isinstance(values, dict):
+                rejected[binding] = (values, "Not a JSON object")
+                continue
+
+            accepted = {}
+            for component in components:
+                ok, bad, absent = component.check_settings(values)
+                accepted.update(ok)
+                for name, reason in bad.iteritems():
+                    rejected[binding + BINDING_JOINER + name] = reason
+                for name, reason in absent.iteritems():
+                    missing[binding + BINDING_JOINER + name] = reason
+            updates.append((binding, values, accepted))
+
+        if rejected or missing:
+            msg = "Settings rejected/missing: %s/%s" % (rejected, missing)
+            raise BadSettings(msg, rejected, missing)
+        return updates
+
+
+def _lookup(tree, binding):
+    """
+    Return the value at 'binding' in a settings tree, or an empty dictionary
+    if it is missing, without modifying the tree.
+
+    >>> _lookup({"a": {"b": {"c": 1}}}, "a.b")
+    {'c': 1}
+    >>> _lookup({"a": 1}, "a.b")
+    {}
+    """
+    for chunk in _binding_to_tuple(binding):
+        if not isinstance(tree, dict) or chunk not in tree:
+            return {}
+        tree = tree[chunk]
+    return tree
+
+
+class SettingsWatcher(object):
+    """
+    Reloads a settings file into a SettingsRegistry when it changes
+
+    A thread checks the file's modification time and size every 'interval'
+    seconds, and calls `SettingsRegistry.reload_from_json` when either has
+    changed. Invalid files are logged and otherwise ignored, leaving the
+    running settings as they were; the file is checked again once it
+    changes.
+
+        watcher = SettingsWatcher(registry, "xbgw_settings.json")
+        watcher.start()
+    """
+
+    def __init__(self, registry, filename, interval=5):
+        self.registry = registry
+        self.filename = filename
+        self.interval = interval
+        self._signature = self._stat()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="settings-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def check(self):
+        """
+        Reload the settings file if it has changed since the last check.
+        Returns True if the file was reloaded.
+        """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+
+        try:
+            self.registry.reload_from_json(self.filename)
+        except BadSettings, e:
+            logger.error("Ignoring changes to %s: %s", self.filename,
+                         e.message)
+            return False
+        except (IOError, ValueError), e:
+            logger.error("Ignoring changes to %s: %s", self.filename, e)
+            return False
+        return True
@@ -69,20 +69,26 @@ class Setting:
         - verify_function: a function to verify that the value is valid, e.g.
                            within range, correct size, etc. Default:
                            `lambda x: True` (always verified)
+        - restart_required: a boolean specifying that the setting is only
+                            read at startup. Changes made by reloading the
+                            settings file are not applied until the
+                            application restarts. Default: False
     """
 
     def __init__(self, name, type, parser=None, required=False,
-                 default_value=None, verify_function=lambda x: True):
+                 default_value=None, verify_function=lambda x: True,
+                 restart_required=False):
         self.name = name
         self.type = type
         self.parser = parser
         self.required = required
         self.default_value = default_value
         self.verify_function = verify_function
+        self.restart_required = restart_required
 
     def __repr__(self):
         kwargs = ('parser', 'required', 'default_value',
-                  'verify_function')
+                  'verify_function', 'restart_required')
 
         # Build a reasonable string representation of the arguments used to
         # construct this Setting object. This will look like:
@@ -234,6 +240,7 @@ class SettingsMixin(object):
             self.__settings_definitions[setting.name] = setting
 
         self.__settings = registry.get_by_binding(binding)
+        registry.bind(binding, self)
 
         accepted, rejected, missing = self.check_settings()
         if len(rejected) or len(missing):
@@ -254,10 +261,23 @@ class SettingsMixin(object):
         """
         self.__settings.update(accepted_settings)
 
-    def check_settings(self):
+    def replace_settings(self, settings):
+        """
+        Switch to a new dictionary of verified settings, which the
+        registry now holds at this object's binding.
+
+        It is not necessary to call `replace_settings` yourself. Calls will
+        be made by `SettingsRegistry.reload_from_json`.
+        """
+        self.__settings = settings
+
+    def check_settings(self, values=None):
         """
         Verify the current settings, and apply default or parsed values.
 
+        If 'values' is given, verify that dictionary of settings instead of
+        the current settings, e.g. before they are reloaded.
+
         If a setting is missing but not required, it will be added to the
         registry with the default value specified in its declaration.
 
@@ -278,9 +298,12 @@ class SettingsMixin(object):
                         found in the registry. Each key is a setting name, and
                         each value is the string "Required setting not given."
         """
+        if values is None:
+            values = self.__settings
+
         accepted, rejected, missing = {}, {}, {}
 
-        for setting_name, value in self.__settings.iteritems():
+        for setting_name, value in values.iteritems():
             if setting_name not in self.__settings_definitions:
                 # Skip unknown settings for now. We may revisit this later and
                 # decide to do something here, such as rejecting the setting.
@@ -304,6 +327,14 @@ class SettingsMixin(object):
 
         return accepted, rejected, missing
 
+    def restart_settings(self):
+        """
+        Return the names of the declared settings which are only read at
+        startup (see Setting).
+        """
+        return [name for name, defn in self.__settings_definitions.iteritems()
+                if defn.restart_required]
+
     def get_setting(self, name):
         """
         Look up and return the current value of a setting.
@@ -324,3 +355,16 @@ class SettingsMixin(object):
             return self.__settings[name]
 
         raise SettingNotFound("Setting '%s' not found" % name)
+
+    def get_settings(self):
+        """
+        Return a dictionary of every declared setting and its current value.
+
+        Use this rather than several `get_setting` calls when the values
+        must be consistent with each other: the settings file may be
+        reloaded between calls.
+        """
+        settings = self.__settings
+        return dict((name, settings[name])
+                    for name in self.__settings_definitions
+                    if name in settings)
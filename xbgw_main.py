@@ -9,6 +9,7 @@ import os.path
 import fcntl
 import sys
 import atexit
+import signal
 
 sys.path.append("xbgw.zip")
 
@@ -19,8 +20,14 @@ from pubsub import pub
 from xbgw.xbee.manager import XBeeEventManager
 from xbgw.xbee.ddo_manager import DDOEventManager
 from xbgw.reporting.device_cloud import DeviceCloudReporter
-from xbgw.command.rci import RCICommandProcessor
-from xbgw.settings import SettingsRegistry
+from xbgw.reporting.history import StreamHistory
+from xbgw.reporting.journal import ChangeJournal
+from xbgw.reporting.last_values import LastValueTable
+from xbgw.reporting.metrics import ReporterStatsCommand
+from xbgw.command.rci import RCICommandProcessor, rci_stats_listener
+from xbgw.command.registry import register_command
+from xbgw.command.workers import worker_stats_listener
+from xbgw.settings import SettingsRegistry, SettingsWatcher
 
 from xbgw.debug.echo import EchoCommand
 
@@ -71,18 +78,46 @@ def main():
     XBeeEventManager(settings, "xbee_manager")
     DDOEventManager()
     dcrep = DeviceCloudReporter(settings, "devicecloud")
-    rciproc = RCICommandProcessor()
+    stats_cmd = ReporterStatsCommand(dcrep)
+    history = StreamHistory(settings, "history")
+    last_values = LastValueTable(settings, "last_values")
+    journal = ChangeJournal(settings, "journal")
+    rciproc = RCICommandProcessor(settings, "rci")
+    register_command("rci_stats", rci_stats_listener)
+    register_command("worker_stats", worker_stats_listener)
     echo_cmd = EchoCommand()
 
     # Subscribe to all topics that XBeeEventManager publishes
     for topic in XBeeEventManager.data_topics:
         dcrep.start_reporting(topic)
+        history.start_recording(topic)
+        last_values.start_recording(topic)
+        journal.start_recording(topic)
+
+    # Apply edits to the settings file without restarting
+    SettingsWatcher(settings, SETTINGS_FILE).start()
+
+    # Upload or spool queued data when asked to stop
+    install_shutdown_handler([dcrep])
 
     # timeout is 30 seconds by default, but that is far too slow for our
     # purposes. Set the timeout to 100 ms. (Value may be fine tuned later)
     asyncore.loop(timeout=0.1)
 
 
+def install_shutdown_handler(reporters):
+    def on_signal(signum, frame):
+        logging.getLogger().info("Received signal %d, shutting down", signum)
+        # Runs on the main thread, so no further data is published while
+        # the reporters drain
+        for reporter in reporters:
+            reporter.shutdown()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+
 def setup_logging():
     FORMAT = '%(asctime)-15s %(levelname)s %(name)s: %(message)s'
     logging.basicConfig(format=FORMAT)